@@ -7,14 +7,35 @@
 
 # -*- coding: utf-8 -*-
 
-from .config import Config
+import os
+
+from .config import CONFIGS
+from .database import install_slow_query_log
+from . import instrument, metrics
 
 from flask import Flask
 
 APP = Flask(__name__)
-APP.config.from_object(Config)
+APP.config.from_object(CONFIGS[os.environ.get('STI_MSN_CONFIG', 'development')])
+
+# cookies signed with a random key are rejected by the other processes
+# and after a restart
+if not APP.config['JWT_KEYS_CONFIGURED']:
+    if APP.config['REQUIRE_KEYS']:
+        raise RuntimeError(
+            'No signing key configured, set STI_MSN_SECRET_KEY, '
+            'STI_MSN_SECRET_KEYS or STI_MSN_SECRET_KEYS_FILE'
+        )
+    APP.logger.warning('No signing key configured, using a random key for this process only')
+
+if APP.config['REQUIRE_METRICS_TOKEN'] and not APP.config['METRICS_TOKEN']:
+    raise RuntimeError('No metrics token configured, set STI_MSN_METRICS_TOKEN')
 
 from flask_sqlalchemy import SQLAlchemy
 DB = SQLAlchemy(APP)
 
-from messenger import views
+install_slow_query_log(APP.config['SLOW_QUERY_MS'], APP.config['SLOW_QUERY_SAMPLE'])
+instrument.install(APP)
+metrics.install(APP)
+
+from messenger import views, cli
@@ -0,0 +1,84 @@
+# ---------------------------
+#Fichier : auth.py
+#Date : 14.10.2020
+#But : résolution JWT -> session -> utilisateur une seule fois par requête
+#Remarque : le résultat est conservé dans flask.g
+#------------------------------
+
+import datetime as dt
+
+from flask import g, request
+
+from messenger import APP
+from messenger.models import Session, User, Revocation
+from messenger.jwt import jwt_decode
+
+def resolve_auth():
+    """
+    Resolve the session and user tied to the `auth` cookie of the
+    current request.
+
+    The JWT is decoded and the session and its owner are fetched with
+    a single joined query the first time this is called during a
+    request; later calls reuse the result stored on `flask.g`.
+
+    In stateless mode (`AUTH_STATELESS`), the session is rebuilt from
+    the JWT claims and only checked against the revocation set.
+
+    :return: (Session, User) tuple, or (None, None) if the request
+             carries no valid session
+    """
+    if 'auth' not in g:
+        g.auth = (None, None)
+
+        # check if a valid JWT came in the session cookie
+        cookie = request.cookies.get('auth')
+        payload = jwt_decode(cookie) if cookie else None
+
+        if payload and APP.config['AUTH_STATELESS'] and 'sub' in payload:
+            g.auth = resolve_stateless(payload)
+        # check if the named session exists
+        elif payload:
+            g.auth = Session.select_with_user(payload['session']) or (None, None)
+
+    return g.auth
+
+def resolve_stateless(payload: dict):
+    """
+    Rebuild the session described by the given JWT claims
+
+    :param payload: verified JWT payload
+    :return: (Session, User) tuple, or (None, None) if the session has
+             been revoked or its owner no longer exists
+    """
+    if Revocation.is_revoked(payload['session']):
+        return None, None
+
+    user = User.select(payload['sub'])
+    if not user:
+        return None, None
+
+    session = Session(
+        payload['session'], user.username, payload['exp'],
+        request.remote_addr, request.user_agent.string
+    )
+    return session, user
+
+def current_session():
+    """
+    Return the session of the current request, if any, even if expired
+
+    :return: Session if present, else None
+    """
+    return resolve_auth()[0]
+
+def current_user():
+    """
+    Return the user logged in for the current request
+
+    :return: User if the request has a valid, unexpired session, else None
+    """
+    session, user = resolve_auth()
+    if not session or session.expiry <= dt.datetime.now():
+        return None
+    return user
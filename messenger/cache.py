@@ -0,0 +1,126 @@
+# ---------------------------
+#Fichier : cache.py
+#Date : 14.10.2020
+#But : cache LRU en mémoire avec durée de vie (TTL)
+#Remarque : propre à chaque processus, l'invalidation ne concerne que
+#           le processus courant, les autres attendent l'expiration
+#------------------------------
+
+import threading, time
+from collections import OrderedDict
+
+CACHES = {}
+
+class TTLCache(object):
+    """
+    Bounded, thread-safe LRU cache whose entries expire after a fixed
+    time to live.
+
+    Hit, miss and eviction counters are kept to help tune its size.
+    """
+
+    def __init__(self, name: str, max_size: int, ttl: float):
+        """
+        :param name: name under which the cache statistics are reported
+        :param max_size: maximum number of entries, 0 disables the cache
+        :param ttl: time to live of an entry, in seconds
+        """
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+        CACHES[name] = self
+
+    def get(self, key, default=None):
+        """
+        Return the value cached under the given key
+
+        :param key: key to look for
+        :param default: value to return on miss
+        :return: cached value if present and fresh, else `default`
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] <= time.monotonic():
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value) -> None:
+        """
+        Cache the given value, evicting the least recently used entry
+        if the cache is full
+
+        :param key: key to cache the value under
+        :param value: value to cache
+        """
+        if self.max_size <= 0:
+            return
+
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key) -> None:
+        """
+        Remove the given key from the cache
+
+        :param key: key to remove
+        """
+        with self._lock:
+            self._data.pop(key, None)
+
+    def invalidate_where(self, predicate) -> None:
+        """
+        Remove every entry whose value matches the given predicate
+
+        :param predicate: function taking a cached value, returning True
+                          if its entry must be removed
+        """
+        with self._lock:
+            for key in [k for k, (_, v) in self._data.items() if predicate(v)]:
+                del self._data[key]
+
+    def clear(self) -> None:
+        """
+        Remove every entry from the cache
+        """
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        """
+        Return the cache counters
+
+        :return: dict of size, capacity, hits, misses and evictions
+        """
+        with self._lock:
+            return {
+                'size': len(self._data),
+                'max_size': self.max_size,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+def stats() -> dict:
+    """
+    Return the counters of every cache of the current process
+
+    :return: mapping of cache names to their counters
+    """
+    return {name: cache.stats() for name, cache in CACHES.items()}
@@ -0,0 +1,85 @@
+# ---------------------------
+#Fichier : cli.py
+#Date : 14.10.2020
+#But : commandes de maintenance (flask <commande>)
+#Remarque :
+#------------------------------
+
+import time
+
+import click
+from sqlalchemy import inspect
+
+from messenger import APP, DB, outbox
+from messenger.models import MODELS, Session, Revocation, RateLimit, Delivery, Notification, MailboxStats, MessageIndex
+
+@APP.cli.command('init-db')
+def init_db():
+    """
+    Create the missing tables and indexes, keeping the existing data.
+    """
+    # search index keyed by the rowid of the messages, built again
+    if MessageIndex.outdated():
+        MessageIndex.drop_table()
+
+    existing = set(inspect(DB.engine).get_table_names())
+    for model in MODELS:
+        model.create_table()
+
+    # derived tables added to a database that already has messages
+    if MailboxStats.__tablename__ not in existing:
+        click.echo('Rebuilt {} inbox summaries'.format(MailboxStats.rebuild()))
+    if MessageIndex.backend() == 'fts5' and MessageIndex.__tablename__ not in existing:
+        click.echo('Indexed {} messages'.format(MessageIndex.rebuild()))
+    click.echo('Database schema is up to date')
+
+@APP.cli.command('purge-sessions')
+@click.option('--batch-size', default=1000, show_default=True,
+              help='Maximum number of rows deleted per statement.')
+@click.option('--every', default=0, type=float,
+              help='Keep running and purge every given number of seconds.')
+def purge_sessions(batch_size, every):
+    """
+    Delete expired sessions, revocations, rate limit counters, finished
+    deliveries and old notifications.
+    """
+    while True:
+        sessions = Session.purge_expired(batch_size)
+        revocations = Revocation.purge_expired(batch_size)
+        rate_limits = RateLimit.purge_expired(batch_size)
+        deliveries = Delivery.purge_expired(batch_size)
+        notifications = Notification.purge_expired(batch_size)
+        click.echo('Purged {} sessions, {} revocations, {} rate limit counters, {} deliveries '
+                   'and {} notifications'.format(
+            sessions, revocations, rate_limits, deliveries, notifications
+        ))
+
+        if not every:
+            return
+        time.sleep(every)
+
+@APP.cli.command('deliver')
+@click.option('--once', is_flag=True, help='Stop when no delivery is due.')
+def deliver(once):
+    """
+    Deliver the messages waiting in the outbox.
+    """
+    processed = outbox.run(once)
+    click.echo('Processed {} deliveries'.format(processed))
+
+@APP.cli.command('rebuild-stats')
+def rebuild_stats():
+    """
+    Compute again the inbox summaries from the messages.
+    """
+    MailboxStats.create_table()
+    rebuilt = MailboxStats.rebuild()
+    click.echo('Rebuilt {} inbox summaries'.format(rebuilt))
+
+@APP.cli.command('rebuild-search')
+def rebuild_search():
+    """
+    Index again every message for the search.
+    """
+    indexed = MessageIndex.rebuild()
+    click.echo('Indexed {} messages'.format(indexed))
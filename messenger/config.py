@@ -6,9 +6,165 @@
 #------------------------------
 import os
 from messenger.security import gen_rand_string
+from messenger.database import engine_options
+
+KEY_VARIABLES = ('STI_MSN_SECRET_KEYS_FILE', 'STI_MSN_SECRET_KEYS', 'STI_MSN_SECRET_KEY')
+
+def keys_configured() -> bool:
+    """
+    Check whether the JWT signing keys are set in the environment
+
+    :return: False if `load_keyring` falls back to a random key
+    """
+    return any(os.environ.get(x) for x in KEY_VARIABLES)
+
+def load_keyring() -> list:
+    """
+    Load the JWT signing keys from the environment
+
+    Keys are read, in order of precedence, from:
+
+    - `STI_MSN_SECRET_KEYS_FILE`: file with one `kid:secret` per line,
+    - `STI_MSN_SECRET_KEYS`: comma-separated `kid:secret` pairs,
+    - `STI_MSN_SECRET_KEY`: single secret, with kid `default`.
+
+    The first key signs new tokens, the others are only used to verify
+    tokens signed before a rotation. Without any of these, a random key
+    is generated, which is then specific to the current process and is
+    only accepted by the development profile.
+
+    :return: list of (kid, secret) tuples, active key first
+    """
+    if os.environ.get('STI_MSN_SECRET_KEYS_FILE'):
+        with open(os.environ['STI_MSN_SECRET_KEYS_FILE']) as f:
+            entries = f.read().splitlines()
+    elif os.environ.get('STI_MSN_SECRET_KEYS'):
+        entries = os.environ['STI_MSN_SECRET_KEYS'].split(',')
+    elif os.environ.get('STI_MSN_SECRET_KEY'):
+        entries = ['default:' + os.environ['STI_MSN_SECRET_KEY']]
+    else:
+        entries = [gen_rand_string('local') + ':' + gen_rand_string()]
+
+    keyring = []
+    for entry in entries:
+        if not entry.strip():
+            continue
+        kid, sep, secret = entry.strip().partition(':')
+        if not sep or not kid or not secret:
+            raise ValueError('Malformed key entry, expected kid:secret')
+        keyring.append((kid, secret))
+
+    if not keyring:
+        raise ValueError('No JWT signing key configured')
+    return keyring
 
 class Config:
-    SECRET_KEY = gen_rand_string()
+    JWT_KEYS = load_keyring()
+    SECRET_KEY = JWT_KEYS[0][1]
+    # refuse to start with a random, per-process key
+    JWT_KEYS_CONFIGURED = keys_configured()
+    REQUIRE_KEYS = False
     SQLALCHEMY_DATABASE_URI = os.environ.get('STI_MSN_DB') or 'sqlite:///db.sqlite'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
-    SQLALCHEMY_ECHO = True # enable to see SQL commands that are issued
+    # enable to see SQL commands that are issued
+    SQLALCHEMY_ECHO = os.environ.get('STI_MSN_SQL_ECHO', '').lower() in ('1', 'true', 'yes')
+
+    # statements slower than this many ms are logged, for the given
+    # fraction of them
+    SLOW_QUERY_MS = float(os.environ.get('STI_MSN_SLOW_QUERY_MS', 100))
+    SLOW_QUERY_SAMPLE = float(os.environ.get('STI_MSN_SLOW_QUERY_SAMPLE', 1))
+
+    # per-request query count, database and rendering time, sent in a
+    # Server-Timing header and logged as one JSON line per request; a
+    # fraction of the requests can be profiled
+    INSTRUMENT = os.environ.get('STI_MSN_INSTRUMENT', '1').lower() in ('1', 'true', 'yes')
+    REQUEST_LOG = os.environ.get('STI_MSN_REQUEST_LOG', '').lower() in ('1', 'true', 'yes')
+    PROFILE_SAMPLE = float(os.environ.get('STI_MSN_PROFILE_SAMPLE', 0))
+    PROFILE_DIR = os.environ.get('STI_MSN_PROFILE_DIR')
+
+    # Prometheus metrics at /metrics; with several worker processes, a
+    # directory shared by them, to be emptied before the application
+    # starts (the processes do not know which files are stale)
+    METRICS_DIR = os.environ.get('STI_MSN_METRICS_DIR')
+    METRICS_FLUSH = float(os.environ.get('STI_MSN_METRICS_FLUSH', 1))
+    # bearer token required by /metrics, which is otherwise only served
+    # to local clients; behind a reverse proxy every client looks local
+    METRICS_TOKEN = os.environ.get('STI_MSN_METRICS_TOKEN')
+    REQUIRE_METRICS_TOKEN = False
+
+    # per-process cache of session and user rows, and of verified tokens
+    CACHE_MAX_SIZE = int(os.environ.get('STI_MSN_CACHE_SIZE', 1024))
+    CACHE_TTL = float(os.environ.get('STI_MSN_CACHE_TTL', 30))
+    # session and user rows decide who may do what (sessions, password
+    # hashes, active and admin flags), and their invalidation only
+    # reaches the current process: the other ones trust them this long
+    AUTH_CACHE_TTL = float(os.environ.get('STI_MSN_AUTH_CACHE_TTL', 2))
+
+    # trust the signed JWT and a periodically refreshed revocation set
+    # instead of looking the session up on every request
+    AUTH_STATELESS = os.environ.get('STI_MSN_AUTH_STATELESS', '').lower() in ('1', 'true', 'yes')
+    REVOCATION_REFRESH = float(os.environ.get('STI_MSN_REVOCATION_REFRESH', 10))
+
+    # password hashing pool, requests beyond its queue get a 503
+    PW_WORKERS = int(os.environ.get('STI_MSN_PW_WORKERS', os.cpu_count() or 1))
+    PW_QUEUE_MAX = int(os.environ.get('STI_MSN_PW_QUEUE_MAX', 16))
+    PW_TIMEOUT = float(os.environ.get('STI_MSN_PW_TIMEOUT', 30))
+
+    # rate limit counters are kept in the database by default so that
+    # they are shared by all worker processes
+    RATELIMIT_ENABLED = os.environ.get('STI_MSN_RATELIMIT', '1').lower() in ('1', 'true', 'yes')
+    RATELIMIT_STORAGE_URL = os.environ.get('STI_MSN_RATELIMIT_STORAGE', 'sql://')
+    LOGIN_RATE_LIMIT = os.environ.get('STI_MSN_LOGIN_RATE_LIMIT', '5 per minute')
+    SIGNUP_RATE_LIMIT = os.environ.get('STI_MSN_SIGNUP_RATE_LIMIT', '5 per minute')
+    COMPOSE_RATE_LIMIT = os.environ.get('STI_MSN_COMPOSE_RATE_LIMIT', '30 per minute')
+
+    # messages are delivered through the outbox by chunks of this many
+    # recipients, each committed separately; deliveries fitting in one
+    # chunk are made during the request
+    OUTBOX_CHUNK_SIZE = int(os.environ.get('STI_MSN_OUTBOX_CHUNK_SIZE', 1000))
+    OUTBOX_LEASE = 60
+    OUTBOX_MAX_ATTEMPTS = 5
+    OUTBOX_RETRY_DELAY = 10
+    OUTBOX_POLL_INTERVAL = 5
+    OUTBOX_RETENTION = 24 * 3600
+    # run a delivery thread in each worker process, disable when
+    # running `flask deliver` separately
+    OUTBOX_WORKER = os.environ.get('STI_MSN_OUTBOX_WORKER', '1').lower() in ('1', 'true', 'yes')
+
+    # the inbox page follows new messages through /inbox/stream when
+    # enabled, otherwise it polls /inbox/status every INBOX_POLL_INTERVAL
+    # seconds; each open stream holds a worker thread or greenlet, see
+    # the gevent mode in the README
+    SSE_ENABLED = os.environ.get('STI_MSN_SSE', '').lower() in ('1', 'true', 'yes')
+    SSE_HEARTBEAT = 25
+    INBOX_POLL_INTERVAL = int(os.environ.get('STI_MSN_INBOX_POLL_INTERVAL', 30))
+
+    # new message events of the streams, read from the database by a
+    # single thread per process, which also ends the streams of logged
+    # out sessions every NOTIFY_SESSION_CHECK seconds
+    NOTIFY_POLL_INTERVAL = float(os.environ.get('STI_MSN_NOTIFY_POLL_INTERVAL', 1))
+    NOTIFY_MAX_SUBSCRIBERS = int(os.environ.get('STI_MSN_NOTIFY_MAX_SUBSCRIBERS', 10000))
+    NOTIFY_SESSION_CHECK = 10
+
+class ProductionConfig(Config):
+    """
+    Profile selected with `STI_MSN_CONFIG=production`
+    """
+    REQUIRE_KEYS = True
+    REQUIRE_METRICS_TOKEN = True
+    SQLALCHEMY_ECHO = False
+    SQLALCHEMY_ENGINE_OPTIONS = engine_options(
+        Config.SQLALCHEMY_DATABASE_URI,
+        pool_size=int(os.environ.get('STI_MSN_POOL_SIZE', 5)),
+        max_overflow=int(os.environ.get('STI_MSN_POOL_MAX_OVERFLOW', 10)),
+        pool_timeout=float(os.environ.get('STI_MSN_POOL_TIMEOUT', 10)),
+        # below MariaDB's wait_timeout so idle connections are not dropped
+        pool_recycle=int(os.environ.get('STI_MSN_POOL_RECYCLE', 1800)),
+    )
+    SLOW_QUERY_SAMPLE = float(os.environ.get('STI_MSN_SLOW_QUERY_SAMPLE', 0.1))
+    REQUEST_LOG = os.environ.get('STI_MSN_REQUEST_LOG', '1').lower() in ('1', 'true', 'yes')
+
+CONFIGS = {
+    'development': Config,
+    'production': ProductionConfig,
+}
@@ -0,0 +1,115 @@
+# ---------------------------
+#Fichier : database.py
+#Date : 14.10.2020
+#But : pool de connexions instrumenté et journal des requêtes lentes
+#Remarque : ne dépend pas de l'application pour pouvoir être utilisé
+#           depuis la configuration
+#------------------------------
+
+import logging, random, threading, time
+
+from sqlalchemy import event, exc
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+
+LOGGER = logging.getLogger('messenger.sql')
+
+class TimedQueuePool(QueuePool):
+    """
+    Connection pool measuring how long checkouts wait for a connection
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            return super().connect()
+        except exc.TimeoutError:
+            with self._stats_lock:
+                self.timeouts += 1
+            raise
+        finally:
+            wait = time.perf_counter() - start
+            with self._stats_lock:
+                self.checkouts += 1
+                self.wait_total += wait
+                self.wait_max = max(self.wait_max, wait)
+
+    def stats(self) -> dict:
+        """
+        Return the pool gauges and checkout wait counters
+
+        :return: dict of pool statistics, durations in seconds
+        """
+        with self._stats_lock:
+            return {
+                'size': self.size(),
+                'checked_out': self.checkedout(),
+                'checked_in': self.checkedin(),
+                'overflow': self.overflow(),
+                'checkouts': self.checkouts,
+                'timeouts': self.timeouts,
+                'wait_total': self.wait_total,
+                'wait_max': self.wait_max,
+            }
+
+def pool_stats(pool) -> dict:
+    """
+    Return the statistics of the given connection pool
+
+    :param pool: SQLAlchemy connection pool
+    :return: dict of pool statistics, only the pool class for pools
+             that are not instrumented
+    """
+    if isinstance(pool, TimedQueuePool):
+        return dict(pool.stats(), pool=type(pool).__name__)
+    return {'pool': type(pool).__name__}
+
+def engine_options(uri: str, pool_size: int, max_overflow: int, pool_timeout: float, pool_recycle: int) -> dict:
+    """
+    Build the SQLAlchemy engine options of a server database
+
+    SQLite databases are left with their default pool, as their
+    connections may not be shared between threads.
+
+    :param uri: database URI
+    :param pool_size: connections kept open
+    :param max_overflow: connections opened on top of `pool_size` under load
+    :param pool_timeout: seconds to wait for a connection before failing
+    :param pool_recycle: seconds after which a connection is reopened
+    :return: engine options
+    """
+    if uri.startswith('sqlite'):
+        return {}
+    return {
+        'poolclass': TimedQueuePool,
+        'pool_size': pool_size,
+        'max_overflow': max_overflow,
+        'pool_timeout': pool_timeout,
+        'pool_recycle': pool_recycle,
+        'pool_pre_ping': True,
+    }
+
+def install_slow_query_log(threshold_ms: float, sample_rate: float) -> None:
+    """
+    Log the statements that take longer than the given threshold
+
+    :param threshold_ms: minimum duration of a logged statement, in ms
+    :param sample_rate: fraction of the slow statements that are logged
+    """
+    @event.listens_for(Engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        context._query_start = time.perf_counter()
+
+    @event.listens_for(Engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = (time.perf_counter() - context._query_start) * 1000
+        if elapsed >= threshold_ms and random.random() < sample_rate:
+            LOGGER.warning('slow query (%.1f ms): %s', elapsed, ' '.join(statement.split()))
@@ -8,37 +8,38 @@
 import datetime as dt
 from functools import wraps
 
-from flask import request, redirect, flash
+from flask import redirect, flash
 
-from messenger.models import Session, User
-from messenger.jwt import jwt_decode
+from messenger.models import Session
+from messenger.auth import resolve_auth
 
-def is_logged_in(f):
-    @wraps(f)
-    def decorated_function(*args, **kwargs):
-        # check if session cookie is present
-        cookie = request.cookies.get('auth')
-        if not cookie:
-            flash('You must log in first to access this page.', 'alert-danger')
-            return redirect('/login')
+def check_session():
+    """
+    Check that the current request carries a valid, unexpired session
 
-        # check if a valid JWT came in the cookie
-        payload = jwt_decode(cookie)
-        if not payload:
-            flash('You must log in first to access this page.', 'alert-danger')
-            return redirect('/login')
+    :return: redirect response if the check failed, else None
+    """
+    session, _ = resolve_auth()
 
-        # check if the named session exists
-        session = Session.select(payload['session'])
-        if not session:
-            flash('You must log in first to access this page.', 'alert-danger')
-            return redirect('/login')
+    # check if the named session exists
+    if not session:
+        flash('You must log in first to access this page.', 'alert-danger')
+        return redirect('/login')
 
-        # check if the session has expired
-        if session.expiry <= dt.datetime.now():
-            flash('Session expired, please log in again.', 'alert-danger')
-            Session.delete(session.id)
-            return redirect('/login')
+    # check if the session has expired
+    if session.expiry <= dt.datetime.now():
+        flash('Session expired, please log in again.', 'alert-danger')
+        Session.delete(session.id)
+        return redirect('/login')
+
+    return None
+
+def is_logged_in(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        res = check_session()
+        if res:
+            return res
 
         return f(*args, **kwargs)
     return decorated_function
@@ -46,34 +47,12 @@ def is_logged_in(f):
 def is_admin(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        # What is GEN ? Baby don't duplicate me, don't duplicate me, oh no
-
-        # check if session cookie is present
-        cookie = request.cookies.get('auth')
-        if not cookie:
-            flash('You must log in first to access this page.', 'alert-danger')
-            return redirect('/login')
-
-        # check if a valid JWT came in the cookie
-        payload = jwt_decode(cookie)
-        if not payload:
-            flash('You must log in first to access this page.', 'alert-danger')
-            return redirect('/login')
-
-        # check if the named session exists
-        session = Session.select(payload['session'])
-        if not session:
-            flash('You must log in first to access this page.', 'alert-danger')
-            return redirect('/login')
-
-        # check if the session has expired
-        if session.expiry <= dt.datetime.now():
-            flash('Session expired, please log in again.', 'alert-danger')
-            Session.delete(session.id)
-            return redirect('/login')
+        res = check_session()
+        if res:
+            return res
 
-        # check if the named session exists
-        user = User.select(session.username)
+        # check if the session owner is an admin
+        _, user = resolve_auth()
         if not user.admin:
             flash('This resource is currently unavailable.', 'alert-danger')
             return redirect('/inbox')
@@ -0,0 +1,146 @@
+# ---------------------------
+#Fichier : instrument.py
+#Date : 14.10.2020
+#But : mesures par requête (requêtes SQL, temps base de données et
+#      rendu), en-tête Server-Timing, journal et profilage échantillonné
+#Remarque : les requêtes SQL des threads d'arrière-plan ne sont pas
+#           comptées
+#------------------------------
+
+import cProfile, io, json, logging, os, pstats, random, time
+
+from flask import Flask, g, request, has_request_context
+from jinja2 import Template
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+LOGGER = logging.getLogger('messenger.requests')
+
+class RequestStats(object):
+    """
+    Measurements of the current request
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.db_ms = 0.0
+        self.render_ms = 0.0
+        self.profiler = None
+
+    @property
+    def total_ms(self) -> float:
+        return (time.perf_counter() - self.start) * 1000
+
+def current_stats():
+    """
+    Return the measurements of the current request, if it is measured
+    """
+    if has_request_context():
+        return g.get('request_stats')
+    return None
+
+class TimedTemplate(Template):
+    """
+    Jinja template adding its rendering time to the current request
+    """
+
+    def render(self, *args, **kwargs):
+        stats = current_stats()
+        if stats is None:
+            return super().render(*args, **kwargs)
+
+        start = time.perf_counter()
+        try:
+            return super().render(*args, **kwargs)
+        finally:
+            stats.render_ms += (time.perf_counter() - start) * 1000
+
+def install(app: Flask) -> None:
+    """
+    Measure the requests of the given application
+
+    Adds a `Server-Timing` header to every response and, if
+    `REQUEST_LOG` is set, logs a JSON line per request. A fraction
+    `PROFILE_SAMPLE` of the requests is run under cProfile, whose
+    results are saved to `PROFILE_DIR` or logged.
+
+    :param app: application to instrument
+    """
+    if not app.config['INSTRUMENT']:
+        return
+
+    if app.config['REQUEST_LOG'] and not LOGGER.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        LOGGER.addHandler(handler)
+        LOGGER.setLevel(logging.INFO)
+        LOGGER.propagate = False
+
+    app.jinja_env.template_class = TimedTemplate
+
+    @event.listens_for(Engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        context._request_query_start = time.perf_counter()
+
+    @event.listens_for(Engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        stats = current_stats()
+        if stats is not None:
+            stats.queries += 1
+            stats.db_ms += (time.perf_counter() - context._request_query_start) * 1000
+
+    @app.before_request
+    def start_measures():
+        g.request_stats = stats = RequestStats()
+        if random.random() < app.config['PROFILE_SAMPLE']:
+            stats.profiler = cProfile.Profile()
+            stats.profiler.enable()
+
+    @app.after_request
+    def report_measures(res):
+        stats = current_stats()
+        if stats is None:
+            return res
+        if stats.profiler:
+            stats.profiler.disable()
+            save_profile(app, stats.profiler)
+
+        total_ms = stats.total_ms
+        res.headers.add('Server-Timing', 'db;dur={:.1f};desc="{} queries"'.format(stats.db_ms, stats.queries))
+        res.headers.add('Server-Timing', 'render;dur={:.1f}'.format(stats.render_ms))
+        res.headers.add('Server-Timing', 'app;dur={:.1f}'.format(total_ms))
+
+        if app.config['REQUEST_LOG']:
+            LOGGER.info(json.dumps({
+                'method': request.method,
+                'path': request.path,
+                'endpoint': request.endpoint,
+                'status': res.status_code,
+                'ms': round(total_ms, 1),
+                'queries': stats.queries,
+                'db_ms': round(stats.db_ms, 1),
+                'render_ms': round(stats.render_ms, 1),
+                'profiled': stats.profiler is not None,
+            }))
+        return res
+
+def save_profile(app: Flask, profiler: cProfile.Profile) -> None:
+    """
+    Save the profile of the current request to `PROFILE_DIR`, or log its
+    most expensive functions if unset
+
+    :param app: profiled application
+    :param profiler: disabled profiler of the request
+    """
+    directory = app.config['PROFILE_DIR']
+    if directory:
+        name = '{:.0f}-{}-{}.prof'.format(
+            time.time() * 1000, request.endpoint or 'none', os.getpid()
+        )
+        profiler.dump_stats(os.path.join(directory, name))
+        return
+
+    out = io.StringIO()
+    pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(25)
+    LOGGER.info('profile of %s %s\n%s', request.method, request.path, out.getvalue())
@@ -10,8 +10,7 @@ import json, base64, hmac
 from flask import request
 
 from messenger import APP
-
-# TODO handle malformed jwt
+from messenger.cache import TTLCache
 
 ENCODING = 'ascii'
 HEADER = {
@@ -19,55 +18,130 @@ HEADER = {
   'typ': 'JWT'
 }
 
-def jwt_encode(payload: dict, header=HEADER) -> str:
+# length of a base64-encoded HMAC-SHA256 digest
+SIGNATURE_LEN = 44
+# longest token accepted, ours are well below
+MAX_JWT_LEN = 2048
+
+# recently verified tokens, mapped to their payload
+VERIFIED_CACHE = TTLCache('jwt', APP.config['CACHE_MAX_SIZE'], APP.config['CACHE_TTL'])
+
+_keyring = {'keys': None, 'headers': None}
+
+def keyring() -> dict:
+    """
+    Return the verification keys indexed by the encoded JWT header
+    that designates them
+
+    Headers carry the `kid` of their key, headers without `kid` are
+    verified with the active key. Mapping the encoded header directly
+    avoids parsing it on every verification.
+
+    :return: mapping of base64 headers (bytes) to HMAC keys (bytes)
+    """
+    keys = APP.config['JWT_KEYS']
+    if _keyring['keys'] is not keys:
+        headers = {b64pack(HEADER).encode(ENCODING): keys[0][1].encode(ENCODING)}
+        for kid, secret in keys:
+            headers[b64pack(dict(HEADER, kid=kid)).encode(ENCODING)] = secret.encode(ENCODING)
+
+        VERIFIED_CACHE.clear()
+        _keyring['headers'], _keyring['keys'] = headers, keys
+    return _keyring['headers']
+
+def jwt_encode(payload: dict, header=None) -> str:
     """
     Create an RFC7519-compliant JWT (JSON Web Token)
     using the given payload and header.
 
-    Uses `APP.secret_key` as HMAC key.
+    Signed with the active key of `APP.config['JWT_KEYS']`, whose
+    `kid` is added to the default header.
 
     :param payload: JWT payload
     :param header: JWT header
     :return: corresponding JWT
     """
+    if header is None:
+        header = dict(HEADER, kid=APP.config['JWT_KEYS'][0][0])
+
     signature_message = '{}.{}'.format(
         b64pack(header),
         b64pack(payload)
-    )
+    ).encode(ENCODING)
 
-    signature = base64.b64encode(
-        hmac.new(
-            key=APP.secret_key.encode(ENCODING),
-            msg=signature_message.encode(ENCODING),
-            digestmod='SHA256'
-        ).digest()
-    ).decode('ascii')
+    key = keyring().get(signature_message.split(b'.')[0])
+    if key is None:
+        raise ValueError('No signing key for the given header')
 
     return '{}.{}'.format(
-        signature_message,
-        signature
+        signature_message.decode(ENCODING),
+        sign(signature_message, key).decode(ENCODING)
     )
 
 def jwt_decode(jwt: str) -> dict:
     """
-    Verifies that the given JWT has been signed with
-    `APP.secret_key`
+    Verifies that the given JWT has been signed with one of the keys
+    of `APP.config['JWT_KEYS']`, selected by the header's `kid`
+
+    The signature is checked against the signing input exactly as
+    received, before any JSON parsing, so that forged or malformed
+    tokens are rejected cheaply. Verified tokens are memoized.
 
     :param jwt: JWT to verify
     :return: JWT payload if signature is valid, else None
     """
-    # TODO handle malformed jwt
-
-    header, payload, signature = jwt.split('.')
-
-    header = b64unpack(header)
-    payload = b64unpack(payload)
-
-    own_jwt = jwt_encode(payload, header)
+    if not isinstance(jwt, str) or len(jwt) > MAX_JWT_LEN:
+        return None
+
+    # resolving the keyring first drops memoized tokens after a rotation
+    headers = keyring()
+
+    payload = VERIFIED_CACHE.get(jwt)
+    if payload is not None:
+        return dict(payload)
+
+    signature_message, _, signature = jwt.rpartition('.')
+    if signature_message.count('.') != 1 or len(signature) != SIGNATURE_LEN:
+        return None
+
+    try:
+        signature_message = signature_message.encode(ENCODING)
+        signature = signature.encode(ENCODING)
+    except UnicodeEncodeError:
+        return None
+
+    header, payload = signature_message.split(b'.')
+    key = headers.get(header)
+    if key is None or not hmac.compare_digest(sign(signature_message, key), signature):
+        return None
+
+    # the token is ours, its payload can be parsed safely
+    try:
+        payload = b64unpack(payload)
+    except ValueError:
+        return None
+    if not isinstance(payload, dict):
+        return None
+
+    VERIFIED_CACHE.set(jwt, payload)
+    return dict(payload)
+
+def sign(signature_message: bytes, key: bytes) -> bytes:
+    """
+    Computes the base64-encoded HMAC-SHA256 signature of the given
+    JWT signing input
 
-    if hmac.compare_digest(own_jwt, jwt):
-        return payload
-    return None
+    :param signature_message: JWT signing input (header.payload)
+    :param key: HMAC key
+    :return: base64-encoded signature
+    """
+    return base64.b64encode(
+        hmac.new(
+            key=key,
+            msg=signature_message,
+            digestmod='SHA256'
+        ).digest()
+    )
 
 def b64pack(data: dict) -> str:
     """
@@ -0,0 +1,334 @@
+# ---------------------------
+#Fichier : metrics.py
+#Date : 14.10.2020
+#But : métriques au format texte de Prometheus (/metrics)
+#Remarque : chaque processus écrit ses compteurs dans un fichier du
+#           répertoire METRICS_DIR, additionnés lors de la lecture
+#------------------------------
+
+import json, logging, os, threading, time
+
+from flask import Flask, g, request
+
+LOGGER = logging.getLogger('messenger.metrics')
+
+# request durations, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+REGISTRY = []
+
+class Metric(object):
+    """
+    Metric of the current process, with a value per set of labels
+    """
+    kind = None
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        """
+        :param name: metric name
+        :param help: description of the metric
+        :param labels: label names
+        """
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def key(self, labels: dict) -> str:
+        return json.dumps([labels[x] for x in self.labels])
+
+class Counter(Metric):
+    """
+    Monotonic counter, summed over the processes
+    """
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        """
+        Increment the counter of the given labels
+        """
+        key = self.key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def set_total(self, value: float, **labels) -> None:
+        """
+        Set the counter of the given labels to a total counted elsewhere,
+        such as the hits of a cache
+        """
+        key = self.key(labels)
+        with self._lock:
+            self.values[key] = value
+
+class Histogram(Metric):
+    """
+    Distribution of observed values, summed over the processes
+    """
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels) -> None:
+        """
+        Record a value for the given labels
+        """
+        key = self.key(labels)
+        with self._lock:
+            # one count per bucket, then +Inf, sum and total count
+            entry = self.values.setdefault(key, [0] * (len(self.buckets) + 3))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[i] += 1
+                    break
+            else:
+                entry[len(self.buckets)] += 1
+            entry[-2] += value
+            entry[-1] += 1
+
+class Gauge(Metric):
+    """
+    Current value, reported separately by each live process
+    """
+    kind = 'gauge'
+
+    def set(self, value: float, **labels) -> None:
+        """
+        Set the value of the given labels
+        """
+        with self._lock:
+            self.values[self.key(labels)] = value
+
+REQUESTS = Counter('messenger_requests_total', 'HTTP requests', ('endpoint', 'method', 'status'))
+LATENCY = Histogram('messenger_request_duration_seconds', 'HTTP request duration', ('endpoint', 'method'))
+LOGINS = Counter('messenger_logins_total', 'Log in attempts', ('result',))
+MESSAGES = Counter('messenger_messages_sent_total', 'Messages composed', ('target',))
+RECIPIENTS = Counter('messenger_message_recipients_total', 'Recipients of the composed messages')
+CACHE_HITS = Counter('messenger_cache_hits_total', 'Row cache hits', ('cache',))
+CACHE_MISSES = Counter('messenger_cache_misses_total', 'Row cache misses', ('cache',))
+CACHE_EVICTIONS = Counter('messenger_cache_evictions_total', 'Row cache evictions', ('cache',))
+POOL = Gauge('messenger_db_pool', 'Database connection pool gauges', ('pid', 'stat'))
+STREAMS = Gauge('messenger_inbox_streams', 'Open /inbox/stream connections', ('pid',))
+
+# refreshed right before the state of the process is written
+_snapshots = []
+
+def snapshot(fn):
+    """
+    Register a function updating metrics from the state of the process,
+    called before each dump
+    """
+    _snapshots.append(fn)
+    return fn
+
+def process_state() -> dict:
+    """
+    Return the metrics of the current process
+    """
+    for fn in _snapshots:
+        try:
+            fn()
+        except Exception:
+            LOGGER.exception('Metrics snapshot failed')
+
+    state = {'pid': os.getpid(), 'metrics': {}}
+    for metric in REGISTRY:
+        with metric._lock:
+            state['metrics'][metric.name] = {
+                k: list(v) if isinstance(v, list) else v for k, v in metric.values.items()
+            }
+    return state
+
+class Store(object):
+    """
+    Shares the metrics of the worker processes through one file per
+    process in a directory, rewritten at most every `interval` seconds
+    """
+
+    def __init__(self, directory: str, interval: float):
+        self.directory = directory
+        self.interval = interval
+        self._written_at = 0
+        self._lock = threading.Lock()
+
+    def path(self, pid: int) -> str:
+        return os.path.join(self.directory, 'metrics-{}.json'.format(pid))
+
+    def write(self, force: bool = False) -> None:
+        """
+        Write the state of the current process, unless done recently
+        """
+        now = time.monotonic()
+        if not force and now - self._written_at < self.interval:
+            return
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            self._written_at = now
+            path = self.path(os.getpid())
+            tmp = '{}.{}.tmp'.format(path, threading.get_ident())
+            with open(tmp, 'w') as f:
+                json.dump(process_state(), f)
+            os.replace(tmp, path)
+        finally:
+            self._lock.release()
+
+    def read(self) -> list:
+        """
+        Return the states written by every process, the current one
+        being up to date
+        """
+        self.write(force=True)
+        states = []
+        for name in os.listdir(self.directory):
+            if not (name.startswith('metrics-') and name.endswith('.json')):
+                continue
+            try:
+                with open(os.path.join(self.directory, name)) as f:
+                    states.append(json.load(f))
+            except (OSError, ValueError):
+                # being replaced, or removed meanwhile
+                continue
+        return states
+
+def is_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def aggregate(states: list) -> dict:
+    """
+    Merge the states of several processes: counters and histograms are
+    summed, even those of exited processes, gauges are only kept for
+    live processes
+
+    :param states: states returned by `process_state`
+    :return: mapping of metric names to their merged values
+    """
+    merged = {metric.name: {} for metric in REGISTRY}
+    kinds = {metric.name: metric.kind for metric in REGISTRY}
+    for state in states:
+        alive = state['pid'] == os.getpid() or is_alive(state['pid'])
+        for name, values in state['metrics'].items():
+            if name not in merged:
+                continue
+            if kinds[name] == 'gauge':
+                if alive:
+                    merged[name].update(values)
+                continue
+            for key, value in values.items():
+                if isinstance(value, list):
+                    total = merged[name].setdefault(key, [0] * len(value))
+                    for i, x in enumerate(value):
+                        total[i] += x
+                else:
+                    merged[name][key] = merged[name].get(key, 0) + value
+    return merged
+
+def format_labels(names: tuple, key: str, extra: dict = None) -> str:
+    pairs = list(zip(names, json.loads(key) if key else [])) + list((extra or {}).items())
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(
+        name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    ) for name, value in pairs) + '}'
+
+def format_value(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def exposition(merged: dict, extra_gauges: list) -> str:
+    """
+    Format merged metrics in the Prometheus text format
+
+    :param merged: values returned by `aggregate`
+    :param extra_gauges: (name, help, samples) of gauges computed for
+                         the whole application, samples being a list of
+                         (labels, value)
+    :return: text to serve
+    """
+    lines = []
+    for metric in REGISTRY:
+        lines.append('# HELP {} {}'.format(metric.name, metric.help))
+        lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+        for key, value in sorted(merged[metric.name].items()):
+            if metric.kind != 'histogram':
+                lines.append('{}{} {}'.format(
+                    metric.name, format_labels(metric.labels, key), format_value(value)
+                ))
+                continue
+
+            cumulative = 0
+            for bound, count in zip(metric.buckets + ('+Inf',), value):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(
+                    metric.name, format_labels(metric.labels, key, {'le': bound}), cumulative
+                ))
+            lines.append('{}_sum{} {}'.format(
+                metric.name, format_labels(metric.labels, key), format_value(value[-2])
+            ))
+            lines.append('{}_count{} {}'.format(
+                metric.name, format_labels(metric.labels, key), value[-1]
+            ))
+
+    for name, help, samples in extra_gauges:
+        lines.append('# HELP {} {}'.format(name, help))
+        lines.append('# TYPE {} gauge'.format(name))
+        for labels, value in samples:
+            lines.append('{}{} {}'.format(name, format_labels((), '', labels), format_value(value)))
+    return '\n'.join(lines) + '\n'
+
+STORE = {'store': None}
+
+def collect(extra_gauges=()) -> str:
+    """
+    Return the metrics of every process in the Prometheus text format
+
+    :param extra_gauges: (name, help, samples) of gauges computed for
+                         the whole application, see `exposition`
+    """
+    store = STORE['store']
+    states = store.read() if store else [process_state()]
+    merged = aggregate(states)
+
+    ratios = []
+    hits, misses = merged[CACHE_HITS.name], merged[CACHE_MISSES.name]
+    for key in sorted(set(hits) | set(misses)):
+        total = hits.get(key, 0) + misses.get(key, 0)
+        if total:
+            ratios.append(({'cache': json.loads(key)[0]}, hits.get(key, 0) / total))
+    extra_gauges = list(extra_gauges) + [
+        ('messenger_cache_hit_ratio', 'Row cache hit ratio', ratios)
+    ]
+    return exposition(merged, extra_gauges)
+
+def install(app: Flask) -> None:
+    """
+    Record the requests of the given application
+
+    :param app: application to measure
+    """
+    if app.config['METRICS_DIR']:
+        os.makedirs(app.config['METRICS_DIR'], exist_ok=True)
+        STORE['store'] = Store(app.config['METRICS_DIR'], app.config['METRICS_FLUSH'])
+
+    @app.before_request
+    def start_timer():
+        g.metrics_start = time.perf_counter()
+
+    @app.after_request
+    def record_request(res):
+        start = g.get('metrics_start')
+        if start is not None:
+            endpoint = request.endpoint or 'none'
+            LATENCY.observe(time.perf_counter() - start, endpoint=endpoint, method=request.method)
+            REQUESTS.inc(endpoint=endpoint, method=request.method, status=str(res.status_code))
+        if STORE['store']:
+            STORE['store'].write()
+        return res
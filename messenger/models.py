@@ -6,15 +6,37 @@
 #------------------------------
 
 import datetime as dt
+import re, threading, time
 
-from messenger import DB
-from messenger.security import gen_rand_string, hash_pw
+from sqlalchemy import exc, inspect
+
+from messenger import APP, DB
+from messenger.cache import TTLCache
+from messenger.security import gen_rand_string
+
+# row caches placed in front of the user and session lookups
+USER_CACHE = TTLCache('users', APP.config['CACHE_MAX_SIZE'], APP.config['AUTH_CACHE_TTL'])
+SESSION_CACHE = TTLCache('sessions', APP.config['CACHE_MAX_SIZE'], APP.config['AUTH_CACHE_TTL'])
 
 def cols2keys(columns):
     return ''.join(
         ', :{}'.format(x.replace(' ', '')) for x in columns.split(',')
     )[2:]
 
+def quote_fts(text: str) -> str:
+    """
+    Quote a string as an FTS5 phrase
+    """
+    return '"{}"'.format(text.replace('"', '""'))
+
+def prefix_end(prefix: str) -> str:
+    """
+    Return the smallest string sorting after every string starting with
+    the given prefix, so that `x >= prefix AND x < prefix_end(prefix)`
+    matches the prefix with an index range
+    """
+    return prefix[:-1] + chr(min(ord(prefix[-1]) + 1, 0x10FFFF))
+
 def get_current_timestamp() -> int:
     return int((
         dt.datetime.now() + Session.SESSION_DURATION
@@ -33,16 +55,56 @@ class Model(object):
     @classmethod
     def create_table(cls, columns_stmt: str) -> None:
         """
-        Execute a `CREATE TABLE` command using the calling classe's
-        `__tablename__` table with the supplied columns statement
+        Execute a `CREATE TABLE IF NOT EXISTS` command using the calling
+        classe's `__tablename__` table with the supplied columns
+        statement, so that existing databases can be brought up to date
 
-        :param columns_stmt: SQL columns declaration
+        :param columns_stmt: SQL columns declaration, where `{SERIAL}`
+                             declares an auto-incremented primary key
+        """
+        DB.engine.execute('CREATE TABLE IF NOT EXISTS {} ({})'.format(
+            cls.__tablename__,
+            columns_stmt.format(
+                TEXT_LEN=Model.TEXT_MAX_LEN,
+                SERIAL='INTEGER PRIMARY KEY AUTOINCREMENT'
+                if DB.engine.dialect.name == 'sqlite' else
+                'INTEGER PRIMARY KEY AUTO_INCREMENT'
+            ),
+        ))
+
+    @classmethod
+    def create_index(cls, name: str, columns: str) -> None:
+        """
+        Execute a `CREATE INDEX IF NOT EXISTS` command on the calling
+        classe's `__tablename__` table
+
+        :param name: index name
+        :param columns: comma-separated indexed columns
         """
-        DB.engine.execute('CREATE TABLE {} ({})'.format(
+        DB.engine.execute('CREATE INDEX IF NOT EXISTS {} ON {} ({})'.format(
+            name,
             cls.__tablename__,
-            columns_stmt.format(TEXT_LEN=Model.TEXT_MAX_LEN),
+            columns
         ))
 
+    @classmethod
+    def add_column(cls, name: str, column_stmt: str) -> None:
+        """
+        Execute an `ALTER TABLE ADD COLUMN` command on the calling
+        classe's `__tablename__` table if it lacks the column, for the
+        tables created by an older version
+
+        :param name: column name
+        :param column_stmt: SQL column declaration, after the name
+        """
+        columns = [x['name'] for x in inspect(DB.engine).get_columns(cls.__tablename__)]
+        if name not in columns:
+            DB.engine.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(
+                cls.__tablename__,
+                name,
+                column_stmt
+            ))
+
     @classmethod
     def drop_table(cls) -> None:
         """
@@ -54,7 +116,7 @@ class Model(object):
         ))
 
     @classmethod
-    def insert(cls, columns: str, keys: str, values: dict) -> None:
+    def insert(cls, columns: str, keys: str, values: dict, conn=None) -> None:
         """
         Execute a `INSERT INTO VALUES` command using the calling
         classe's `__tablename__` table.
@@ -62,13 +124,35 @@ class Model(object):
         :param columns_stmt: SQL columns declaration
         :param key: column identifier to use
         :param value: value to insert
+        :param conn: connection of an ongoing transaction, if any
+        """
+        stmt = DB.text('INSERT INTO {} ({}) VALUES ({})'.format(
+            cls.__tablename__,
+            columns,
+            keys
+        ))
+        (conn or DB.engine).execute(stmt.bindparams(**values))
+
+    @classmethod
+    def insert_many(cls, columns: str, keys: str, values: list, conn=None) -> None:
+        """
+        Execute a single `INSERT INTO VALUES` command for several rows
+        (executemany) using the calling classe's `__tablename__` table.
+
+        :param columns: SQL columns declaration
+        :param keys: column identifiers to use
+        :param values: list of dicts of values to insert, one per row
+        :param conn: connection of an ongoing transaction, if any
         """
+        if not values:
+            return
+
         stmt = DB.text('INSERT INTO {} ({}) VALUES ({})'.format(
             cls.__tablename__,
             columns,
             keys
         ))
-        DB.engine.execute(stmt.bindparams(**values))
+        (conn or DB.engine).execute(stmt, values)
 
     @classmethod
     def select(cls, key: str, value: object) -> list:
@@ -87,6 +171,23 @@ class Model(object):
         ))
         return DB.engine.execute(stmt.bindparams(**{key: value})).fetchall()
 
+    @classmethod
+    def exists(cls, key: str, value: object) -> bool:
+        """
+        Execute a `SELECT 1 ... LIMIT 1` command on the calling classe's
+        `__tablename__` table with the supplied key and value
+
+        :param key: column identifier to use
+        :param value: value to match in column
+        :return: True if at least one row matches
+        """
+        stmt = DB.text('SELECT 1 FROM {} WHERE {}=:{} LIMIT 1'.format(
+            cls.__tablename__,
+            key,
+            key
+        ))
+        return DB.engine.execute(stmt.bindparams(**{key: value})).first() is not None
+
     @classmethod
     def update(cls, update_dict: dict, ident_key: str, ident_value: object) -> None:
         """
@@ -114,20 +215,52 @@ class Model(object):
 
 
     @classmethod
-    def delete(cls: object, key: str, value: object) -> None:
+    def delete(cls: object, key: str, value: object, conn=None) -> None:
         """
         Execute a `DELETE` command on the calling classe's
         `__tablename__` table with the supplied key and value
 
         :param key: column identifier to use for deletion
         :param value: value to match in column to delete row
+        :param conn: connection of an ongoing transaction, if any
         """
         stmt = DB.text('DELETE FROM {} WHERE {}=:{}'.format(
             cls.__tablename__,
             key,
             key
         ))
-        DB.engine.execute(stmt.bindparams(**{key: value}))
+        (conn or DB.engine).execute(stmt.bindparams(**{key: value}))
+
+    @classmethod
+    def purge_expired(cls, batch_size: int) -> list:
+        """
+        Delete the rows of the calling classe's `__tablename__` table
+        whose `expiry` has passed, in batches of bounded size so that
+        no single statement locks the table for long
+
+        :param batch_size: maximum number of rows deleted per statement
+        :return: IDs of the deleted rows
+        """
+        select_stmt = DB.text(
+            'SELECT id FROM {} WHERE expiry <= :now LIMIT :limit'.format(cls.__tablename__)
+        )
+        delete_stmt = DB.text(
+            'DELETE FROM {} WHERE id IN :ids'.format(cls.__tablename__)
+        ).bindparams(DB.bindparam('ids', expanding=True))
+
+        now = int(dt.datetime.now().timestamp())
+        deleted = []
+        while True:
+            ids = [row[0] for row in DB.engine.execute(
+                select_stmt.bindparams(now=now, limit=batch_size)
+            ).fetchall()]
+            if not ids:
+                return deleted
+
+            DB.engine.execute(delete_stmt, ids=ids)
+            deleted += ids
+            if len(ids) < batch_size:
+                return deleted
 
 class User(Model):
     """
@@ -142,12 +275,41 @@ class User(Model):
         self.firstname = firstname
         self.lastname = lastname
         self.password = password
-        self.messages = Message.from_recipient(self.username)
+
+    @property
+    def messages(self) -> list:
+        """
+        All the messages received by the user, newest first.
+
+        Queried on every access: use `inbox` to fetch a single page.
+        """
+        return self.inbox()
+
+    def inbox(self, limit: int = None, before: tuple = None) -> list:
+        """
+        Return a page of the messages received by the user, newest first
+
+        :param limit: maximum number of messages to return, None for all
+        :param before: (timestamp, id) keyset cursor, only messages
+                       strictly older than it are returned
+        :return: list of Message
+        """
+        return Message.from_recipient(self.username, limit, before)
 
     def __str__(self):
-        return '{} {} (@{})'.format(
-            self.firstname, self.lastname, self.username
-        )
+        return User.format_name(self.firstname, self.lastname, self.username)
+
+    @staticmethod
+    def format_name(firstname: str, lastname: str, username: str) -> str:
+        """
+        Format a user's display name
+
+        :param firstname: first name
+        :param lastname: last name
+        :param username: username
+        :return: display name
+        """
+        return '{} {} (@{})'.format(firstname, lastname, username)
 
     @classmethod
     def create_table(cls) -> None:
@@ -164,6 +326,11 @@ class User(Model):
             password VARCHAR({TEXT_LEN}) NOT NULL
             """,
         )
+        # serve the filters and sort orders of the admin user list
+        super().create_index('idx_users_firstname', 'firstname, username')
+        super().create_index('idx_users_lastname', 'lastname, username')
+        super().create_index('idx_users_active', 'active, username')
+        super().create_index('idx_users_admin', 'admin, username')
 
     @classmethod
     def insert(cls, admin: bool, firstname: str, lastname: str, username: str, password: str) -> None:
@@ -177,15 +344,19 @@ class User(Model):
         :param password: password
         """
         columns = 'admin, active, firstname, lastname, username, password'
-        super().insert(
-            columns=columns,
-            keys=cols2keys(columns),
-            values={
-                'admin': admin, 'active': True,
-                'firstname': firstname, 'lastname': lastname,
-                'username': username, 'password': password
-            }
-        )
+        with DB.engine.begin() as conn:
+            super().insert(
+                columns=columns,
+                keys=cols2keys(columns),
+                values={
+                    'admin': admin, 'active': True,
+                    'firstname': firstname, 'lastname': lastname,
+                    'username': username, 'password': password
+                },
+                conn=conn
+            )
+            MailboxStats.insert(username, conn)
+        USER_CACHE.invalidate(username)
 
     @classmethod
     def select(cls, username: str):
@@ -195,17 +366,186 @@ class User(Model):
         :param username: username to look for
         :return: User if username exists, else None
         """
-        rows = super().select('username', username)
-        if rows:
-            return User(*rows[0])
-        return None
+        row = USER_CACHE.get(username)
+        if row is None:
+            rows = super().select('username', username)
+            if not rows:
+                return None
+            row = tuple(rows[0])
+            USER_CACHE.set(username, row)
+        return User(*row)
+
+    # sort orders of `listing`, by name
+    LISTING_ORDERS = {
+        'username': 'u.username',
+        'firstname': 'u.firstname',
+        'lastname': 'u.lastname',
+        'messages': 's.count',
+        'last': 's.newest_date',
+    }
 
     @classmethod
-    def all(cls) -> list:
-        rows = super().select('1', 1)
-        if rows:
-            return [User(*row) for row in rows]
-        return None
+    def listing(cls, username: str = None, name: str = None, active: bool = None,
+                admin: bool = None, order: str = 'username', descending: bool = False,
+                limit: int = 50, offset: int = 0) -> list:
+        """
+        Return a page of the user list of the administration, with the
+        inbox summary of each user
+
+        Only the displayed columns are selected. Text filters match the
+        beginning of the values, as index ranges. The orders of the inbox
+        summary read the summaries first, along their indexes; every user
+        has one (see `MailboxStats.rebuild` for older databases).
+
+        :param username: only users whose username starts with it
+        :param name: only users whose first or last name starts with it
+        :param active: only enabled (True) or disabled (False) users
+        :param admin: only admins (True) or regular users (False)
+        :param order: name of the sort order, see `LISTING_ORDERS`
+        :param descending: reverse the sort order
+        :param limit: maximum number of users to return
+        :param offset: number of users to skip
+        :return: list of dicts
+        """
+        where, params = [], {'limit': limit, 'offset': offset}
+        if username:
+            where.append('(u.username >= :username AND u.username < :username_end)')
+            params.update(username=username, username_end=prefix_end(username))
+        if name:
+            where.append(
+                '((u.firstname >= :name AND u.firstname < :name_end) '
+                'OR (u.lastname >= :name AND u.lastname < :name_end))'
+            )
+            params.update(name=name, name_end=prefix_end(name))
+        if active is not None:
+            where.append('u.active = :active')
+            params['active'] = active
+        if admin is not None:
+            where.append('u.admin = :admin')
+            params['admin'] = admin
+
+        direction = ' DESC' if descending else ''
+        sort = cls.LISTING_ORDERS[order]
+        if sort.startswith('s.'):
+            stmt = 'FROM {1} s JOIN {0} u ON u.username = s.username'
+            tiebreak = 's.username'
+        else:
+            stmt = 'FROM {0} u LEFT JOIN {1} s ON s.username = u.username'
+            tiebreak = 'u.username'
+        stmt = (
+            'SELECT u.username, u.firstname, u.lastname, u.active, u.admin, '
+            's.count, s.newest_date ' + stmt
+        ).format(cls.__tablename__, MailboxStats.__tablename__)
+        if where:
+            stmt += ' WHERE ' + ' AND '.join(where)
+        stmt += ' ORDER BY {}{}'.format(sort, direction)
+        if order != 'username':
+            stmt += ', {}{}'.format(tiebreak, direction)
+        stmt += ' LIMIT :limit OFFSET :offset'
+
+        rows = DB.engine.execute(DB.text(stmt).bindparams(**params)).fetchall()
+        return [{
+            'username': x.username, 'firstname': x.firstname, 'lastname': x.lastname,
+            'active': x.active, 'admin': x.admin, 'messages': x.count or 0,
+            'last': MailboxStats.format_date(x.newest_date),
+        } for x in rows]
+
+    @classmethod
+    def display_names(cls, usernames) -> dict:
+        """
+        Resolve the display names of several users with a single query
+
+        :param usernames: iterable of usernames to look for
+        :return: mapping of existing usernames to their display name
+        """
+        usernames = set(usernames)
+        if not usernames:
+            return {}
+
+        stmt = DB.text(
+            'SELECT username, firstname, lastname FROM {} '
+            'WHERE username IN :usernames'.format(cls.__tablename__)
+        ).bindparams(DB.bindparam('usernames', expanding=True))
+        rows = DB.engine.execute(stmt, usernames=list(usernames)).fetchall()
+        return {
+            username: User.format_name(firstname, lastname, username)
+            for username, firstname, lastname in rows
+        }
+
+    @classmethod
+    def existing(cls, usernames) -> set:
+        """
+        Check which of the given usernames exist, with a single query
+
+        :param usernames: iterable of usernames to look for
+        :return: set of the usernames used by an account
+        """
+        usernames = set(usernames)
+        if not usernames:
+            return set()
+
+        stmt = DB.text(
+            'SELECT username FROM {} WHERE username IN :usernames'.format(cls.__tablename__)
+        ).bindparams(DB.bindparam('usernames', expanding=True))
+        return {row[0] for row in DB.engine.execute(stmt, usernames=list(usernames))}
+
+    @classmethod
+    def usernames(cls, after: str = None, limit: int = None) -> list:
+        """
+        Return the usernames of the users, in alphabetical order
+
+        :param after: only return usernames sorting after this one
+        :param limit: maximum number of usernames to return, None for all
+        :return: list of usernames
+        """
+        stmt = 'SELECT username FROM {}'.format(cls.__tablename__)
+        params = {}
+        if after is not None:
+            stmt += ' WHERE username > :after'
+            params['after'] = after
+        stmt += ' ORDER BY username'
+        if limit is not None:
+            stmt += ' LIMIT :limit'
+            params['limit'] = limit
+        return [row[0] for row in DB.engine.execute(DB.text(stmt).bindparams(**params))]
+
+    @classmethod
+    def suggest(cls, prefix: str, limit: int) -> list:
+        """
+        Return the first users whose username starts with the given
+        prefix, in alphabetical order
+
+        Written as a range on the primary key rather than a `LIKE`, so
+        that only the matching index entries are read.
+
+        :param prefix: beginning of the username
+        :param limit: maximum number of users to return
+        :return: list of (username, display name)
+        """
+        if not prefix:
+            return []
+
+        upper = prefix_end(prefix)
+        stmt = DB.text(
+            'SELECT username, firstname, lastname FROM {} '
+            'WHERE username >= :prefix AND username < :upper '
+            'ORDER BY username LIMIT :limit'.format(cls.__tablename__)
+        )
+        rows = DB.engine.execute(stmt.bindparams(prefix=prefix, upper=upper, limit=limit))
+        return [
+            (username, User.format_name(firstname, lastname, username))
+            for username, firstname, lastname in rows
+        ]
+
+    @classmethod
+    def count(cls) -> int:
+        """
+        Return the number of users
+
+        :return: number of users
+        """
+        stmt = DB.text('SELECT COUNT(*) FROM {}'.format(cls.__tablename__))
+        return DB.engine.execute(stmt).scalar()
 
     @classmethod
     def find(cls, username: str) -> bool:
@@ -215,7 +555,7 @@ class User(Model):
         :param username: username to look for
         :return: True if username is used by an account
         """
-        return isinstance(cls.select(username), User)
+        return super().exists('username', username)
 
     @classmethod
     def update(cls, username, update_dict):
@@ -226,11 +566,18 @@ class User(Model):
         :param update_dict: column and content to update
         """
         super().update(update_dict, 'username', username)
+        USER_CACHE.invalidate(username)
 
     @classmethod
-    def change_pass(cls, username, newpass):
+    def change_pass(cls, username, pw_hash):
+        """
+        Replace the password of the given user and log them out everywhere
+
+        :param username: username to look for
+        :param pw_hash: hash of the new password
+        """
         # update password
-        cls.update(username, {'password': hash_pw(newpass)})
+        cls.update(username, {'password': pw_hash})
 
         # terminate all sessions
         Session.terminate_user(username)
@@ -242,21 +589,29 @@ class User(Model):
 
         :param username: username to look for and delete
         """
-        user = cls.select(username)
+        with DB.engine.begin() as conn:
+            # delete user's inbox
+            Message.delete_for_recipient(username, conn)
 
-        # delete user's inbox
-        for msg in user.messages:
-            Message.delete(msg.id)
+            # delete user sessions
+            Session.terminate_user(username, conn)
 
-        # delete user sessions
-        Session.terminate_user(user.username)
-
-        super().delete('username', username)
+            MailboxStats.delete(username, conn)
+            super().delete('username', username, conn)
+        USER_CACHE.invalidate(username)
 
     @classmethod
     def from_session(cls, session_id: str):
-        session = Session.select(session_id)
-        return User.select(session.username)
+        """
+        Return the User owning the given session, if it exists
+
+        :param session_id: session ID to look for
+        :return: User if session exists, else None
+        """
+        row = Session.select_with_user(session_id)
+        if row:
+            return row[1]
+        return None
 
 class Session(Model):
     """
@@ -288,6 +643,9 @@ class Session(Model):
             CONSTRAINT `fk_session_username` FOREIGN KEY (username) REFERENCES users(username)
             """
         )
+        super().create_index('idx_sessions_username', 'username')
+        # serves the expired sessions purge
+        super().create_index('idx_sessions_expiry', 'expiry')
 
     @classmethod
     def insert(cls, session_id: str, username: str, expiry: int, ip: str, user_agent: str) -> None:
@@ -322,11 +680,73 @@ class Session(Model):
         :param find_by_id: whether to find user by ID or username
         :return: User if ID exists, else None
         """
-        rows = super().select('id', session_id)
-        if rows:
-            return Session(*rows[0])
+        row = SESSION_CACHE.get(session_id)
+        if row is None:
+            rows = super().select('id', session_id)
+            if not rows:
+                return None
+            row = tuple(rows[0])
+            SESSION_CACHE.set(session_id, row)
+        return Session(*row)
+
+    @classmethod
+    def select_with_user(cls, session_id: str):
+        """
+        Return the session with the given ID along with its owner,
+        using a single joined query
+
+        :param session_id: session ID to look for
+        :return: (Session, User) tuple if ID exists, else None
+        """
+        session_row = SESSION_CACHE.get(session_id)
+        if session_row is not None:
+            user_row = USER_CACHE.get(session_row[1])
+            if user_row is not None:
+                return Session(*session_row), User(*user_row)
+
+        stmt = DB.text(
+            'SELECT s.id, s.username, s.expiry, s.ip, s.user_agent, '
+            'u.admin, u.active, u.username, u.firstname, u.lastname, u.password '
+            'FROM sessions s JOIN users u ON u.username = s.username '
+            'WHERE s.id=:id'
+        )
+        row = DB.engine.execute(stmt.bindparams(id=session_id)).first()
+        if row:
+            session_row, user_row = tuple(row[:5]), tuple(row[5:])
+            SESSION_CACHE.set(session_id, session_row)
+            USER_CACHE.set(session_row[1], user_row)
+            return Session(*session_row), User(*user_row)
         return None
 
+    @classmethod
+    def count_active(cls) -> int:
+        """
+        Return the number of unexpired sessions
+
+        :return: number of sessions, served by the expiry index
+        """
+        stmt = DB.text('SELECT COUNT(*) FROM {} WHERE expiry > :now'.format(cls.__tablename__))
+        return DB.engine.execute(stmt.bindparams(
+            now=int(dt.datetime.now().timestamp())
+        )).scalar()
+
+    @classmethod
+    def existing(cls, session_ids) -> set:
+        """
+        Check which of the given sessions still exist, with a single query
+
+        :param session_ids: iterable of session IDs to look for
+        :return: set of the IDs of the sessions not logged out nor purged
+        """
+        session_ids = set(session_ids)
+        if not session_ids:
+            return set()
+
+        stmt = DB.text(
+            'SELECT id FROM {} WHERE id IN :ids'.format(cls.__tablename__)
+        ).bindparams(DB.bindparam('ids', expanding=True))
+        return {row[0] for row in DB.engine.execute(stmt, ids=list(session_ids))}
+
     @classmethod
     def from_user(cls, username):
         rows = super().select('username', username)
@@ -335,11 +755,36 @@ class Session(Model):
         return []
 
     @classmethod
-    def terminate_user(cls, username):
+    def terminate_user(cls, username, conn=None):
+        """
+        Delete and revoke all the sessions of the given user
+
+        :param username: username whose sessions are terminated
+        :param conn: connection of an ongoing transaction, if any
+        """
         # https://youtu.be/ewZZNeYDiLo?t=32
-        for sesh in cls.from_user(username):
-            cls.delete(sesh.id)
+        if conn is None:
+            with DB.engine.begin() as conn:
+                return cls.terminate_user(username, conn)
+
+        # only the stateless mode trusts tokens without their session row
+        if APP.config['AUTH_STATELESS']:
+            Revocation.revoke_user(username, get_current_timestamp(), conn)
+        super().delete('username', username, conn)
+        SESSION_CACHE.invalidate_where(lambda row: row[1] == username)
+
+    @classmethod
+    def purge_expired(cls, batch_size: int = 1000) -> int:
+        """
+        Delete the expired sessions, in batches
 
+        :param batch_size: maximum number of sessions deleted per statement
+        :return: number of deleted sessions
+        """
+        deleted = super().purge_expired(batch_size)
+        for session_id in deleted:
+            SESSION_CACHE.invalidate(session_id)
+        return len(deleted)
 
     @classmethod
     def delete(cls, session_id: str) -> None:
@@ -349,6 +794,118 @@ class Session(Model):
         :param session_id: session ID to look for and delete
         """
         super().delete('id', session_id)
+        SESSION_CACHE.invalidate(session_id)
+
+        # in stateless mode, tokens carrying this session may still be
+        # presented until they expire, at most one session duration from now
+        if APP.config['AUTH_STATELESS']:
+            Revocation.revoke(session_id, get_current_timestamp())
+
+class Revocation(Model):
+    """
+    Database model representing a revoked session
+
+    Used by the stateless authentication mode, in which sessions are
+    trusted from their signed JWT alone, unless they are listed here.
+    Each worker process keeps the set of revoked session IDs in memory
+    and refreshes it periodically.
+    """
+    __tablename__ = 'revocations'
+
+    _ids = frozenset()
+    _loaded_at = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def create_table(cls) -> None:
+        """
+        Create the revocation table
+        """
+        super().create_table(
+            columns_stmt="""
+            id VARCHAR({TEXT_LEN}) PRIMARY KEY,
+            expiry INTEGER NOT NULL
+            """
+        )
+        super().create_index('idx_revocations_expiry', 'expiry')
+
+    @classmethod
+    def revoke(cls, session_id: str, expiry: int) -> None:
+        """
+        Record the given session as revoked
+
+        :param session_id: ID of the revoked session
+        :param expiry: UNIX timestamp after which the record may be dropped
+        """
+        if not super().exists('id', session_id):
+            super().insert(
+                columns='id, expiry',
+                keys=cols2keys('id, expiry'),
+                values={'id': session_id, 'expiry': expiry}
+            )
+
+        with cls._lock:
+            cls._ids = cls._ids | {session_id}
+
+    @classmethod
+    def revoke_user(cls, username: str, expiry: int, conn) -> None:
+        """
+        Record all the sessions of the given user as revoked, with a
+        single statement
+
+        :param username: user whose sessions are revoked
+        :param expiry: UNIX timestamp after which the records may be dropped
+        :param conn: connection of an ongoing transaction
+        """
+        stmt = DB.text(
+            'SELECT id FROM sessions WHERE username=:username '
+            'AND id NOT IN (SELECT id FROM {})'.format(cls.__tablename__)
+        )
+        session_ids = [row[0] for row in conn.execute(stmt.bindparams(username=username))]
+        if not session_ids:
+            return
+
+        stmt = DB.text(
+            'INSERT INTO {} (id, expiry) SELECT id, :expiry FROM sessions '
+            'WHERE id IN :ids'.format(cls.__tablename__)
+        ).bindparams(DB.bindparam('ids', expanding=True))
+        conn.execute(stmt, expiry=expiry, ids=session_ids)
+
+        with cls._lock:
+            cls._ids = cls._ids | set(session_ids)
+
+    @classmethod
+    def purge_expired(cls, batch_size: int = 1000) -> int:
+        """
+        Delete the revocations of sessions that have expired, in batches
+
+        :param batch_size: maximum number of rows deleted per statement
+        :return: number of deleted rows
+        """
+        return len(super().purge_expired(batch_size))
+
+    @classmethod
+    def is_revoked(cls, session_id: str) -> bool:
+        """
+        Check whether the given session has been revoked
+
+        Relies on the in-memory revocation set, reloaded from the
+        database every `REVOCATION_REFRESH` seconds.
+
+        :param session_id: session ID to look for
+        :return: True if the session has been revoked
+        """
+        now = time.monotonic()
+        if cls._loaded_at is None or now - cls._loaded_at >= APP.config['REVOCATION_REFRESH']:
+            stmt = DB.text('SELECT id FROM {} WHERE expiry > :now'.format(cls.__tablename__))
+            rows = DB.engine.execute(stmt.bindparams(
+                now=int(dt.datetime.now().timestamp())
+            )).fetchall()
+            with cls._lock:
+                cls._ids = frozenset(row[0] for row in rows)
+                cls._loaded_at = now
+
+        return session_id in cls._ids
 
 class Message(Model):
     __tablename__ = 'messages'
@@ -357,6 +914,7 @@ class Message(Model):
         self.id = id
         self.sender_name = sender_name
         self.recipient_name = recipient_name
+        self.timestamp = date
         self.date = dt.datetime.fromtimestamp(date).strftime('%Y-%m-%d %H:%M:%S')
         self.title = title
         self.body = body
@@ -378,6 +936,8 @@ class Message(Model):
             CONSTRAINT `fk_message_recipient_name` FOREIGN KEY (recipient_name) REFERENCES users(username)
             """
         )
+        # serves the keyset-paginated inbox
+        super().create_index('idx_messages_recipient_date', 'recipient_name, date, id')
 
     @classmethod
     def insert(cls, sender_name, recipient_name, date, title, body) -> None:
@@ -390,16 +950,41 @@ class Message(Model):
         :param title: title of the message
         :param body: the message itself
         """
+        cls.insert_many(sender_name, [recipient_name], date, title, body)
+
+    @classmethod
+    def insert_many(cls, sender_name, recipient_names, date, title, body, conn=None) -> None:
+        """
+        Send a copy of a message to each of the given recipients, with a
+        single multi-row insert in one transaction
+
+        :param sender_name: username of the sender
+        :param recipient_names: usernames of the receivers
+        :param date: date when the message was sended
+        :param title: title of the message
+        :param body: the message itself
+        :param conn: connection of an ongoing transaction, if any
+        """
+        if conn is None:
+            with DB.engine.begin() as conn:
+                return cls.insert_many(sender_name, recipient_names, date, title, body, conn)
+
+        values = [{
+            'id': gen_rand_string('me'), 'sender_name': sender_name,
+            'recipient_name': recipient_name,
+            'date': date, 'title': title, 'body': body
+        } for recipient_name in recipient_names]
+
         columns = 'id, sender_name, recipient_name, date, title, body'
-        super().insert(
+        super().insert_many(
             columns=columns,
             keys=cols2keys(columns),
-            values={
-                'id': gen_rand_string('me'), 'sender_name': sender_name,
-                'recipient_name': recipient_name,
-                'date': date, 'title': title, 'body': body
-            }
+            values=values,
+            conn=conn
         )
+        MessageIndex.index([x['id'] for x in values], conn)
+        MailboxStats.changed(recipient_names, 1, conn)
+        Notification.insert_many(values, conn)
 
     @classmethod
     def select(cls, message_id):
@@ -426,20 +1011,52 @@ class Message(Model):
         return None
 
     @classmethod
-    def from_recipient(cls, recipient_name):
+    def from_recipient(cls, recipient_name, limit: int = None, before: tuple = None):
         """
-        Select all the messages recived by a user
+        Select the messages recived by a user, newest first
+
+        Messages are ordered by (date, id) so that a page can be fetched
+        from a keyset cursor without scanning the previous ones.
 
         :param recipient_name: username of the receiver
+        :param limit: maximum number of messages to return, None for all
+        :param before: (timestamp, id) cursor, only messages strictly
+                       older than it are returned
         """
-        rows = super().select('recipient_name', recipient_name)
-        if rows:
-            return sorted(
-                [Message(*row) for row in rows],
-                key=lambda x: x.date,
-                reverse=True
-            )
-        return []
+        stmt = 'SELECT * FROM {} WHERE recipient_name=:recipient_name'.format(
+            cls.__tablename__
+        )
+        params = {'recipient_name': recipient_name}
+        if before is not None:
+            stmt += ' AND (date < :date OR (date = :date AND id < :id))'
+            params.update(date=before[0], id=before[1])
+        stmt += ' ORDER BY date DESC, id DESC'
+        if limit is not None:
+            stmt += ' LIMIT :limit'
+            params['limit'] = limit
+
+        rows = DB.engine.execute(DB.text(stmt).bindparams(**params)).fetchall()
+        return [Message(*row) for row in rows]
+
+    @property
+    def cursor(self) -> str:
+        """
+        Keyset cursor pointing right after this message in its inbox
+        """
+        return '{}-{}'.format(self.timestamp, self.id)
+
+    @staticmethod
+    def parse_cursor(cursor: str):
+        """
+        Parse a cursor built by `Message.cursor`
+
+        :param cursor: cursor to parse
+        :return: (timestamp, id) tuple, or None if malformed
+        """
+        timestamp, _, message_id = (cursor or '').partition('-')
+        if not timestamp.isdigit() or not message_id:
+            return None
+        return int(timestamp), message_id
 
     @classmethod
     def delete(cls, message_id: str) -> None:
@@ -448,4 +1065,988 @@ class Message(Model):
 
         :param message_id: ID to look for and delete
         """
-        super().delete('id', message_id)
+        stmt = DB.text('SELECT recipient_name FROM {} WHERE id=:id'.format(cls.__tablename__))
+        with DB.engine.begin() as conn:
+            recipient_name = conn.execute(stmt.bindparams(id=message_id)).scalar()
+            if recipient_name is None:
+                return
+            MessageIndex.unindex(recipient_name, message_id, conn)
+            super().delete('id', message_id, conn)
+            MailboxStats.changed([recipient_name], -1, conn)
+
+    @classmethod
+    def delete_for_recipient(cls, recipient_name: str, conn=None) -> None:
+        """
+        Delete all the messages received by a user
+
+        :param recipient_name: username of the receiver
+        :param conn: connection of an ongoing transaction, if any
+        """
+        if conn is None:
+            with DB.engine.begin() as conn:
+                return cls.delete_for_recipient(recipient_name, conn)
+
+        MessageIndex.unindex(recipient_name, conn=conn)
+        super().delete('recipient_name', recipient_name, conn)
+        MailboxStats.reset(recipient_name, conn)
+
+class MessageIndex(Model):
+    """
+    Full-text index of the message titles and bodies
+
+    Uses an FTS5 table on SQLite, kept in sync with the messages, and a
+    FULLTEXT index of the messages table on MariaDB, which InnoDB
+    maintains itself. Other databases fall back to a `LIKE` scan of the
+    recipient's inbox.
+
+    FTS5 rows are keyed by an integer, so `DOCS_TABLE` maps each
+    message ID to the rowid of its FTS5 row. The rowid of the messages
+    is not used, VACUUM may renumber it since their primary key is a
+    VARCHAR.
+    """
+    __tablename__ = 'messages_fts'
+    DOCS_TABLE = 'messages_fts_docs'
+
+    # result weights of the recipient, title and body columns (FTS5)
+    WEIGHTS = (0.0, 10.0, 1.0)
+
+    @staticmethod
+    def backend() -> str:
+        """
+        Return the index implementation of the current database
+
+        :return: 'fts5', 'fulltext' or 'like'
+        """
+        return {'sqlite': 'fts5', 'mysql': 'fulltext'}.get(DB.engine.dialect.name, 'like')
+
+    @classmethod
+    def create_table(cls) -> None:
+        """
+        Create the full-text index, after the messages table
+        """
+        if cls.backend() == 'fts5':
+            DB.engine.execute(
+                'CREATE TABLE IF NOT EXISTS {} (docid INTEGER PRIMARY KEY, '
+                'id VARCHAR({}) NOT NULL UNIQUE, recipient_name VARCHAR({}) NOT NULL)'.format(
+                    cls.DOCS_TABLE, Model.TEXT_MAX_LEN, Model.TEXT_MAX_LEN
+                )
+            )
+            DB.engine.execute('CREATE INDEX IF NOT EXISTS idx_messages_fts_docs_recipient ON {} (recipient_name)'.format(
+                cls.DOCS_TABLE
+            ))
+            DB.engine.execute(
+                'CREATE VIRTUAL TABLE IF NOT EXISTS {} USING fts5(recipient_name, title, body, '
+                "tokenize='unicode61 remove_diacritics 2')".format(cls.__tablename__)
+            )
+        elif cls.backend() == 'fulltext':
+            DB.engine.execute(
+                'CREATE FULLTEXT INDEX IF NOT EXISTS idx_messages_fulltext ON {} (title, body)'.format(
+                    Message.__tablename__
+                )
+            )
+
+    @classmethod
+    def outdated(cls) -> bool:
+        """
+        Check whether the FTS5 table was created by an older version,
+        keyed by the rowid of the messages or storing their ID
+
+        :return: True if the index must be dropped and rebuilt
+        """
+        if cls.backend() != 'fts5':
+            return False
+        tables = set(DB.engine.table_names())
+        if cls.__tablename__ not in tables:
+            return False
+        columns = [row[1] for row in DB.engine.execute('PRAGMA table_info({})'.format(cls.__tablename__))]
+        return cls.DOCS_TABLE not in tables or 'id' in columns
+
+    @classmethod
+    def drop_table(cls) -> None:
+        """
+        Drop the full-text index (the FULLTEXT index goes along with
+        the messages table)
+        """
+        if cls.backend() == 'fts5':
+            super().drop_table()
+            DB.engine.execute('DROP TABLE IF EXISTS {}'.format(cls.DOCS_TABLE))
+
+    @classmethod
+    def index(cls, message_ids: list, conn) -> None:
+        """
+        Add new messages to the index
+
+        :param message_ids: IDs of the inserted messages
+        :param conn: connection of the transaction inserting them
+        """
+        if cls.backend() != 'fts5' or not message_ids:
+            return
+
+        for stmt in (
+            'INSERT INTO {1} (id, recipient_name) SELECT id, recipient_name FROM {2} WHERE id IN :ids',
+            'INSERT INTO {0} (rowid, recipient_name, title, body) '
+            'SELECT d.docid, m.recipient_name, m.title, m.body FROM {1} d '
+            'JOIN {2} m ON m.id = d.id WHERE d.id IN :ids',
+        ):
+            stmt = DB.text(stmt.format(
+                cls.__tablename__, cls.DOCS_TABLE, Message.__tablename__
+            )).bindparams(DB.bindparam('ids', expanding=True))
+            conn.execute(stmt, ids=list(message_ids))
+
+    @classmethod
+    def unindex(cls, recipient_name: str, message_id: str = None, conn=None) -> None:
+        """
+        Remove messages from the index, looking their FTS5 rows up by
+        message ID or recipient
+
+        :param recipient_name: username of the receiver
+        :param message_id: only remove this message, None for the whole inbox
+        :param conn: connection of the transaction deleting them
+        """
+        if cls.backend() != 'fts5':
+            return
+
+        if message_id is not None:
+            where, params = 'id=:id', {'id': message_id}
+        else:
+            where, params = 'recipient_name=:recipient_name', {'recipient_name': recipient_name}
+        for stmt in (
+            'DELETE FROM {0} WHERE rowid IN (SELECT docid FROM {1} WHERE {2})',
+            'DELETE FROM {1} WHERE {2}',
+        ):
+            (conn or DB.engine).execute(DB.text(
+                stmt.format(cls.__tablename__, cls.DOCS_TABLE, where)
+            ).bindparams(**params))
+
+    @staticmethod
+    def terms(query: str) -> list:
+        """
+        Split a search query into the words to look for
+
+        :param query: query typed by the user
+        :return: list of words
+        """
+        return re.findall(r'\w+', query.lower())
+
+    @classmethod
+    def search(cls, recipient_name: str, query: str, limit: int, offset: int = 0) -> list:
+        """
+        Search the messages received by a user, best matches first
+
+        Every word of the query must appear in the title or the body.
+
+        :param recipient_name: username of the receiver
+        :param query: words to look for
+        :param limit: maximum number of messages to return
+        :param offset: number of messages to skip
+        :return: list of Message
+        """
+        terms = cls.terms(query)
+        if not terms:
+            return []
+
+        params = {'recipient_name': recipient_name, 'limit': limit, 'offset': offset}
+        backend = cls.backend()
+        if backend == 'fts5':
+            # the recipient is matched by the index too, then exactly
+            params['match'] = 'recipient_name:{} AND {{title body}}:({})'.format(
+                quote_fts(recipient_name), ' '.join(quote_fts(x) for x in terms)
+            )
+            stmt = (
+                'SELECT m.* FROM {0} f JOIN {1} d ON d.docid = f.rowid JOIN {2} m ON m.id = d.id '
+                'WHERE {0} MATCH :match AND m.recipient_name=:recipient_name '
+                'ORDER BY bm25({0}, {3}), m.date DESC '
+                'LIMIT :limit OFFSET :offset'.format(
+                    cls.__tablename__, cls.DOCS_TABLE, Message.__tablename__,
+                    ', '.join(str(x) for x in cls.WEIGHTS)
+                )
+            )
+        elif backend == 'fulltext':
+            params['match'] = ' '.join('+' + x for x in terms)
+            stmt = (
+                'SELECT id, sender_name, recipient_name, date, title, body FROM {} '
+                'WHERE recipient_name=:recipient_name '
+                'AND MATCH (title, body) AGAINST (:match IN BOOLEAN MODE) '
+                'ORDER BY MATCH (title, body) AGAINST (:match IN BOOLEAN MODE) DESC, date DESC '
+                'LIMIT :limit OFFSET :offset'.format(Message.__tablename__)
+            )
+        else:
+            stmt = (
+                'SELECT * FROM {} WHERE recipient_name=:recipient_name'.format(Message.__tablename__)
+            )
+            for i, term in enumerate(terms):
+                stmt += ' AND (LOWER(title) LIKE :term{0} OR LOWER(body) LIKE :term{0})'.format(i)
+                params['term{}'.format(i)] = '%{}%'.format(term)
+            stmt += ' ORDER BY date DESC LIMIT :limit OFFSET :offset'
+
+        rows = DB.engine.execute(DB.text(stmt).bindparams(**params)).fetchall()
+        return [Message(*row) for row in rows]
+
+    @classmethod
+    def rebuild(cls) -> int:
+        """
+        Index again every message, for the databases created before the
+        index existed or to repair it
+
+        :return: number of indexed messages
+        """
+        if cls.backend() != 'fts5':
+            return 0
+
+        with DB.engine.begin() as conn:
+            conn.execute('DELETE FROM {}'.format(cls.__tablename__))
+            conn.execute('DELETE FROM {}'.format(cls.DOCS_TABLE))
+            conn.execute('INSERT INTO {} (id, recipient_name) SELECT id, recipient_name FROM {}'.format(
+                cls.DOCS_TABLE, Message.__tablename__
+            ))
+            return conn.execute(
+                'INSERT INTO {} (rowid, recipient_name, title, body) '
+                'SELECT d.docid, m.recipient_name, m.title, m.body FROM {} d '
+                'JOIN {} m ON m.id = d.id'.format(
+                    cls.__tablename__, cls.DOCS_TABLE, Message.__tablename__
+                )
+            ).rowcount
+
+class MailboxStats(Model):
+    """
+    Database model representing the summary of a user's inbox
+
+    Kept up to date in the same transaction as the messages it counts,
+    so that it can be read instead of scanning the inbox. `version` is
+    incremented on every change.
+    """
+    __tablename__ = 'mailbox_stats'
+
+    def __init__(self, username, count, newest_date, newest_id, version):
+        self.username = username
+        self.count = count
+        self.newest_date = newest_date
+        self.newest_id = newest_id
+        self.version = version
+
+    @property
+    def newest(self) -> str:
+        """
+        Formatted date of the newest message, None if the inbox is empty
+        """
+        return MailboxStats.format_date(self.newest_date)
+
+    @staticmethod
+    def format_date(timestamp: int) -> str:
+        """
+        Format a message date, None stays None
+        """
+        if timestamp is None:
+            return None
+        return dt.datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
+
+    @classmethod
+    def create_table(cls) -> None:
+        """
+        Create the mailbox summary table
+        """
+        super().create_table(
+            """
+            username VARCHAR({TEXT_LEN}) PRIMARY KEY,
+            count INTEGER NOT NULL,
+            newest_date INTEGER,
+            newest_id VARCHAR({TEXT_LEN}),
+            version INTEGER NOT NULL
+            """
+        )
+        # sort orders of the user list
+        super().create_index('idx_mailbox_stats_count', 'count, username')
+        super().create_index('idx_mailbox_stats_newest', 'newest_date, username')
+
+    @classmethod
+    def insert(cls, username: str, conn=None) -> None:
+        """
+        Create the summary of a new, empty inbox
+
+        :param username: owner of the inbox
+        :param conn: connection of an ongoing transaction, if any
+        """
+        columns = 'username, count, newest_date, newest_id, version'
+        super().insert(
+            columns=columns,
+            keys=cols2keys(columns),
+            values={
+                'username': username, 'count': 0,
+                'newest_date': None, 'newest_id': None, 'version': 0
+            },
+            conn=conn
+        )
+
+    @classmethod
+    def select(cls, username: str):
+        """
+        Return the summary of a user's inbox, computing it if missing
+
+        :param username: owner of the inbox
+        :return: MailboxStats, empty if the user does not exist (anymore)
+        """
+        rows = super().select('username', username)
+        if not rows:
+            cls.rebuild(username)
+            rows = super().select('username', username)
+        if not rows:
+            # the user was deleted meanwhile
+            return MailboxStats(username, 0, None, None, 0)
+        return MailboxStats(*rows[0])
+
+    @classmethod
+    def changed(cls, usernames, delta: int, conn) -> None:
+        """
+        Record that messages were added to or removed from inboxes
+
+        The newest message is looked up again from the inbox index, which
+        only reads its first entry.
+
+        :param usernames: owners of the changed inboxes
+        :param delta: number of messages added (or removed, if negative)
+                      to each inbox
+        :param conn: connection of the transaction changing the messages
+        """
+        usernames = list(usernames)
+        if not usernames:
+            return
+
+        newest = (
+            '(SELECT {{}} FROM {} WHERE recipient_name=:username '
+            'ORDER BY date DESC, id DESC LIMIT 1)'.format(Message.__tablename__)
+        )
+        stmt = DB.text(
+            'UPDATE {} SET count=count + :delta, version=version + 1, '
+            'newest_date={}, newest_id={} '
+            'WHERE username=:username'.format(
+                cls.__tablename__, newest.format('date'), newest.format('id')
+            )
+        )
+        conn.execute(stmt, [{'username': x, 'delta': delta} for x in usernames])
+
+    @classmethod
+    def reset(cls, username: str, conn) -> None:
+        """
+        Record that an inbox was emptied
+
+        :param username: owner of the inbox
+        :param conn: connection of the transaction deleting the messages
+        """
+        stmt = DB.text(
+            'UPDATE {} SET count=0, version=version + 1, newest_date=NULL, '
+            'newest_id=NULL WHERE username=:username'.format(cls.__tablename__)
+        )
+        conn.execute(stmt.bindparams(username=username))
+
+    @classmethod
+    def delete(cls, username: str, conn=None) -> None:
+        """
+        Delete the summary of a user's inbox
+
+        :param username: owner of the inbox
+        :param conn: connection of an ongoing transaction, if any
+        """
+        super().delete('username', username, conn)
+
+    @classmethod
+    def rebuild(cls, username: str = None) -> int:
+        """
+        Compute again the summaries from the messages, for the databases
+        created before they existed or to repair them
+
+        :param username: only rebuild this user's summary, None for all
+        :return: number of summaries written
+        """
+        newest = (
+            '(SELECT {{}} FROM {} m WHERE m.recipient_name=u.username '
+            'ORDER BY m.date DESC, m.id DESC LIMIT 1)'.format(Message.__tablename__)
+        )
+        stmt = (
+            'INSERT INTO {} (username, count, newest_date, newest_id, version) '
+            'SELECT u.username, '
+            '(SELECT COUNT(*) FROM {} m WHERE m.recipient_name=u.username), '
+            '{}, {}, 0 FROM {} u'.format(
+                cls.__tablename__, Message.__tablename__,
+                newest.format('m.date'), newest.format('m.id'), User.__tablename__
+            )
+        )
+
+        with DB.engine.begin() as conn:
+            if username is None:
+                conn.execute('DELETE FROM {}'.format(cls.__tablename__))
+                return conn.execute(DB.text(stmt)).rowcount
+
+            super().delete('username', username, conn)
+            try:
+                return conn.execute(DB.text(stmt + ' WHERE u.username=:username').bindparams(
+                    username=username
+                )).rowcount
+            except exc.IntegrityError:
+                # built meanwhile by another request
+                return 0
+
+class RateLimit(Model):
+    """
+    Database model representing a fixed-window rate limit counter
+
+    Shared by all the worker processes, unlike in-memory counters.
+    """
+    __tablename__ = 'rate_limits'
+
+    @classmethod
+    def create_table(cls) -> None:
+        """
+        Create the rate limit table
+        """
+        super().create_table(
+            columns_stmt="""
+            id VARCHAR({TEXT_LEN}) PRIMARY KEY,
+            count INTEGER NOT NULL,
+            expiry INTEGER NOT NULL
+            """
+        )
+        super().create_index('idx_rate_limits_expiry', 'expiry')
+
+    @classmethod
+    def incr(cls, key: str, expiry: int, elastic_expiry: bool = False) -> int:
+        """
+        Atomically increment the counter with the given key, starting
+        a new window if the current one has expired
+
+        :param key: rate limit key
+        :param expiry: window length, in seconds
+        :param elastic_expiry: whether every hit extends the window
+        :return: counter value after the increment
+        """
+        now = int(time.time())
+        stmt = DB.text(
+            'UPDATE {} SET '
+            'count = CASE WHEN expiry <= :now THEN 1 ELSE count + 1 END, '
+            'expiry = {} '
+            'WHERE id=:id'.format(
+                cls.__tablename__,
+                ':expiry' if elastic_expiry else 'CASE WHEN expiry <= :now THEN :expiry ELSE expiry END'
+            )
+        ).bindparams(id=key, now=now, expiry=now + expiry)
+
+        while True:
+            with DB.engine.begin() as conn:
+                if conn.execute(stmt).rowcount:
+                    return conn.execute(DB.text(
+                        'SELECT count FROM {} WHERE id=:id'.format(cls.__tablename__)
+                    ).bindparams(id=key)).scalar()
+
+            # first hit, another worker may create the row concurrently
+            try:
+                super().insert(
+                    columns='id, count, expiry',
+                    keys=cols2keys('id, count, expiry'),
+                    values={'id': key, 'count': 1, 'expiry': now + expiry}
+                )
+                return 1
+            except exc.IntegrityError:
+                continue
+
+    @classmethod
+    def get(cls, key: str) -> int:
+        """
+        Return the value of the counter with the given key
+
+        :param key: rate limit key
+        :return: counter value, 0 if its window has expired
+        """
+        stmt = DB.text(
+            'SELECT count FROM {} WHERE id=:id AND expiry > :now'.format(cls.__tablename__)
+        )
+        return DB.engine.execute(stmt.bindparams(id=key, now=int(time.time()))).scalar() or 0
+
+    @classmethod
+    def get_expiry(cls, key: str) -> int:
+        """
+        Return the end of the current window of the given key
+
+        :param key: rate limit key
+        :return: UNIX timestamp of the end of the window
+        """
+        rows = super().select('id', key)
+        if rows and rows[0][2] > time.time():
+            return rows[0][2]
+        return int(time.time())
+
+    @classmethod
+    def purge_expired(cls, batch_size: int = 1000) -> int:
+        """
+        Delete the counters whose window has expired, in batches
+
+        :param batch_size: maximum number of rows deleted per statement
+        :return: number of deleted rows
+        """
+        return len(super().purge_expired(batch_size))
+
+class LeaseLost(Exception):
+    """
+    Raised when a worker no longer owns the delivery it processes
+    """
+
+class Delivery(Model):
+    """
+    Database model representing a message waiting in the outbox
+
+    Messages are delivered to their recipients in chunks, in
+    alphabetical order of usernames. Each chunk is committed along with
+    the progress of the delivery, so that an interrupted delivery
+    resumes where it stopped. Recipients deleted meanwhile are skipped
+    and counted apart.
+    """
+    __tablename__ = 'outbox'
+
+    PENDING = 'pending'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    # target delivering to every user
+    ALL_USERS = '@all'
+    # target delivering to the recipients listed in `DeliveryRecipient`
+    RECIPIENT_LIST = '@list'
+    # expiry of deliveries that are not finished yet
+    NEVER = 2 ** 31 - 1
+
+    def __init__(self, id, sender_name, target, date, title, body, status,
+                 total, delivered, last_recipient, owner, lease_expiry,
+                 attempts, next_attempt, error, expiry, skipped):
+        self.id = id
+        self.sender_name = sender_name
+        self.target = target
+        self.date = date
+        self.title = title
+        self.body = body
+        self.status = status
+        self.total = total
+        self.delivered = delivered
+        self.last_recipient = last_recipient
+        self.owner = owner
+        self.lease_expiry = lease_expiry
+        self.attempts = attempts
+        self.next_attempt = next_attempt
+        self.error = error
+        self.expiry = expiry
+        self.skipped = skipped
+
+    @classmethod
+    def create_table(cls) -> None:
+        """
+        Create the outbox table
+        """
+        super().create_table(
+            columns_stmt="""
+            id VARCHAR({TEXT_LEN}) PRIMARY KEY,
+            sender_name VARCHAR({TEXT_LEN}) NOT NULL,
+            target TEXT NOT NULL,
+            date INTEGER NOT NULL,
+            title VARCHAR({TEXT_LEN}) NOT NULL,
+            body VARCHAR({TEXT_LEN}) NOT NULL,
+            status VARCHAR(16) NOT NULL,
+            total INTEGER NOT NULL,
+            delivered INTEGER NOT NULL,
+            last_recipient VARCHAR({TEXT_LEN}),
+            owner VARCHAR({TEXT_LEN}),
+            lease_expiry INTEGER NOT NULL,
+            attempts INTEGER NOT NULL,
+            next_attempt INTEGER NOT NULL,
+            error VARCHAR({TEXT_LEN}),
+            expiry INTEGER NOT NULL,
+            skipped INTEGER NOT NULL DEFAULT 0
+            """
+        )
+        super().add_column('skipped', 'INTEGER NOT NULL DEFAULT 0')
+        # serves the lookup of the next delivery to process
+        super().create_index('idx_outbox_status_next_attempt', 'status, next_attempt')
+        super().create_index('idx_outbox_expiry', 'expiry')
+
+    @classmethod
+    def insert(cls, sender_name, recipient_names, date, title, body) -> str:
+        """
+        Queue a message for delivery
+
+        :param sender_name: username of the sender
+        :param recipient_names: usernames of the receivers, or
+                                `Delivery.ALL_USERS`
+        :param date: date when the message was sended
+        :param title: title of the message
+        :param body: the message itself
+        :return: delivery ID
+        """
+        if recipient_names == cls.ALL_USERS:
+            target, recipient_names = cls.ALL_USERS, []
+            total = User.count()
+        else:
+            target, recipient_names = cls.RECIPIENT_LIST, set(recipient_names)
+            total = len(recipient_names)
+
+        delivery_id = gen_rand_string('de')
+        columns = ('id, sender_name, target, date, title, body, status, total, '
+                   'delivered, lease_expiry, attempts, next_attempt, expiry')
+        with DB.engine.begin() as conn:
+            super().insert(
+                columns=columns,
+                keys=cols2keys(columns),
+                values={
+                    'id': delivery_id, 'sender_name': sender_name,
+                    'target': target, 'date': date, 'title': title, 'body': body,
+                    'status': cls.PENDING, 'total': total, 'delivered': 0,
+                    'lease_expiry': 0, 'attempts': 0, 'next_attempt': 0,
+                    'expiry': cls.NEVER,
+                },
+                conn=conn
+            )
+            DeliveryRecipient.insert_many(delivery_id, recipient_names, conn)
+        return delivery_id
+
+    @classmethod
+    def select(cls, delivery_id: str):
+        """
+        Return the delivery with the given ID, if it exists
+
+        :param delivery_id: delivery ID to look for
+        :return: Delivery if ID exists, else None
+        """
+        rows = super().select('id', delivery_id)
+        if rows:
+            return Delivery(*rows[0])
+        return None
+
+    @classmethod
+    def claim(cls, owner: str, lease: int, delivery_id: str = None):
+        """
+        Take ownership of a delivery that is due and not being processed
+
+        :param owner: random token identifying the claiming worker
+        :param lease: seconds after which the delivery may be claimed
+                      by another worker if not renewed
+        :param delivery_id: claim this delivery only, else the next due one
+        :return: claimed Delivery, or None
+        """
+        now = int(time.time())
+        if delivery_id is None:
+            stmt = DB.text(
+                'SELECT id FROM {} WHERE status=:status AND next_attempt <= :now '
+                'AND lease_expiry <= :now ORDER BY next_attempt LIMIT 1'.format(cls.__tablename__)
+            )
+            delivery_id = DB.engine.execute(stmt.bindparams(
+                status=cls.PENDING, now=now
+            )).scalar()
+            if delivery_id is None:
+                return None
+
+        stmt = DB.text(
+            'UPDATE {} SET owner=:owner, lease_expiry=:lease_expiry '
+            'WHERE id=:id AND status=:status AND lease_expiry <= :now'.format(cls.__tablename__)
+        )
+        claimed = DB.engine.execute(stmt.bindparams(
+            owner=owner, lease_expiry=now + lease, id=delivery_id,
+            status=cls.PENDING, now=now
+        )).rowcount
+        if claimed:
+            return cls.select(delivery_id)
+        return None
+
+    def next_recipients(self, limit: int) -> list:
+        """
+        Return the next recipients this delivery has to reach
+
+        :param limit: maximum number of recipients
+        :return: usernames, in alphabetical order
+        """
+        if self.target == Delivery.ALL_USERS:
+            return User.usernames(self.last_recipient, limit)
+        if self.target == Delivery.RECIPIENT_LIST:
+            return DeliveryRecipient.usernames(self.id, self.last_recipient, limit)
+
+        # comma-separated recipients, queued by an older version
+        recipients = self.target.split(',')
+        if self.last_recipient is not None:
+            recipients = [x for x in recipients if x > self.last_recipient]
+        return recipients[:limit]
+
+    def deliver_chunk(self, chunk_size: int, lease: int) -> bool:
+        """
+        Deliver the next chunk of recipients, in a single transaction
+        recording the progress of the delivery
+
+        :param chunk_size: maximum number of recipients in the chunk
+        :param lease: seconds by which the ownership is extended
+        :raises LeaseLost: if another worker took the delivery over
+        :return: True if the delivery is complete
+        """
+        recipients = self.next_recipients(chunk_size)
+        done = len(recipients) < chunk_size
+        now = int(time.time())
+
+        # users deleted since the message was queued
+        last_recipient = recipients[-1] if recipients else self.last_recipient
+        if self.target != Delivery.ALL_USERS:
+            existing = User.existing(recipients)
+            skipped = len(recipients) - len(existing)
+            recipients = [x for x in recipients if x in existing]
+        else:
+            skipped = 0
+
+        update_dict = {
+            'delivered': self.delivered + len(recipients),
+            'skipped': self.skipped + skipped,
+            'last_recipient': last_recipient,
+        }
+        if done:
+            update_dict.update(
+                status=Delivery.DONE, owner=None, lease_expiry=0,
+                expiry=now + APP.config['OUTBOX_RETENTION'],
+            )
+            if self.target == Delivery.ALL_USERS:
+                # deliveries to all users end up with the actual count
+                update_dict['total'] = update_dict['delivered']
+        else:
+            update_dict['lease_expiry'] = now + lease
+
+        stmt = DB.text('UPDATE {} SET {} WHERE id=:id AND owner=:current_owner'.format(
+            Delivery.__tablename__,
+            ', '.join('{}=:{}'.format(x, x) for x in update_dict)
+        ))
+        with DB.engine.begin() as conn:
+            Message.insert_many(
+                self.sender_name, recipients, self.date, self.title, self.body, conn
+            )
+            # another worker took over, roll this chunk back
+            if not conn.execute(stmt.bindparams(
+                id=self.id, current_owner=self.owner, **update_dict
+            )).rowcount:
+                raise LeaseLost(self.id)
+
+        for x in update_dict:
+            setattr(self, x, update_dict[x])
+        return done
+
+    def fail(self, error: str, max_attempts: int, backoff: int) -> None:
+        """
+        Record a failed attempt, scheduling a retry unless the delivery
+        ran out of attempts
+
+        :param error: description of the failure
+        :param max_attempts: attempts after which the delivery is abandoned
+        :param backoff: seconds before the first retry, doubled each time
+        """
+        self.attempts += 1
+        update_dict = {
+            'attempts': self.attempts,
+            'owner': None,
+            'lease_expiry': 0,
+            'error': error[:Model.TEXT_MAX_LEN],
+        }
+        if self.attempts >= max_attempts:
+            update_dict['status'] = Delivery.FAILED
+            update_dict['expiry'] = int(time.time()) + APP.config['OUTBOX_RETENTION']
+        else:
+            update_dict['next_attempt'] = int(time.time()) + backoff * 2 ** (self.attempts - 1)
+
+        stmt = DB.text('UPDATE {} SET {} WHERE id=:id AND owner=:current_owner'.format(
+            Delivery.__tablename__,
+            ', '.join('{}=:{}'.format(x, x) for x in update_dict)
+        ))
+        DB.engine.execute(stmt.bindparams(id=self.id, current_owner=self.owner, **update_dict))
+
+    @classmethod
+    def purge_expired(cls, batch_size: int = 1000) -> int:
+        """
+        Delete the finished deliveries past their retention, along with
+        their recipients, in batches
+
+        :param batch_size: maximum number of rows deleted per statement
+        :return: number of deleted deliveries
+        """
+        deleted = super().purge_expired(batch_size)
+        for i in range(0, len(deleted), batch_size):
+            DeliveryRecipient.delete_for_deliveries(deleted[i:i + batch_size])
+        return len(deleted)
+
+class DeliveryRecipient(Model):
+    """
+    Database model representing a recipient of a delivery
+
+    One row per recipient rather than a list in the delivery, whose
+    size is not bounded. Read in alphabetical order of usernames, from
+    the last recipient reached.
+    """
+    __tablename__ = 'outbox_recipients'
+
+    @classmethod
+    def create_table(cls) -> None:
+        """
+        Create the delivery recipient table
+        """
+        super().create_table(
+            columns_stmt="""
+            delivery_id VARCHAR({TEXT_LEN}) NOT NULL,
+            username VARCHAR({TEXT_LEN}) NOT NULL,
+            PRIMARY KEY (delivery_id, username)
+            """
+        )
+
+    @classmethod
+    def insert_many(cls, delivery_id: str, usernames, conn=None) -> None:
+        """
+        Record the recipients of a delivery
+
+        :param delivery_id: ID of the delivery
+        :param usernames: iterable of distinct usernames
+        :param conn: connection of an ongoing transaction, if any
+        """
+        columns = 'delivery_id, username'
+        super().insert_many(
+            columns=columns,
+            keys=cols2keys(columns),
+            values=[{'delivery_id': delivery_id, 'username': x} for x in usernames],
+            conn=conn
+        )
+
+    @classmethod
+    def usernames(cls, delivery_id: str, after: str = None, limit: int = None) -> list:
+        """
+        Return the recipients of a delivery, in alphabetical order
+
+        :param delivery_id: ID of the delivery
+        :param after: only return usernames sorting after this one
+        :param limit: maximum number of usernames to return, None for all
+        :return: list of usernames
+        """
+        stmt = 'SELECT username FROM {} WHERE delivery_id=:delivery_id'.format(cls.__tablename__)
+        params = {'delivery_id': delivery_id}
+        if after is not None:
+            stmt += ' AND username > :after'
+            params['after'] = after
+        stmt += ' ORDER BY username'
+        if limit is not None:
+            stmt += ' LIMIT :limit'
+            params['limit'] = limit
+        return [row[0] for row in DB.engine.execute(DB.text(stmt).bindparams(**params))]
+
+    @classmethod
+    def delete_for_deliveries(cls, delivery_ids: list) -> None:
+        """
+        Delete the recipients of the given deliveries
+
+        :param delivery_ids: IDs of the deliveries
+        """
+        if not delivery_ids:
+            return
+
+        stmt = DB.text(
+            'DELETE FROM {} WHERE delivery_id IN :ids'.format(cls.__tablename__)
+        ).bindparams(DB.bindparam('ids', expanding=True))
+        DB.engine.execute(stmt, ids=list(delivery_ids))
+
+class Notification(Model):
+    """
+    Database model representing a new message notification
+
+    Written along with the messages, and read in order by the
+    notifiers of every worker process. Notifications are only kept for
+    a short while.
+    """
+    __tablename__ = 'notifications'
+
+    RETENTION = 300
+
+    @classmethod
+    def create_table(cls) -> None:
+        """
+        Create the notification table
+        """
+        super().create_table(
+            columns_stmt="""
+            id {SERIAL},
+            recipient_name VARCHAR({TEXT_LEN}) NOT NULL,
+            message_id VARCHAR({TEXT_LEN}) NOT NULL,
+            sender_name VARCHAR({TEXT_LEN}) NOT NULL,
+            title VARCHAR({TEXT_LEN}) NOT NULL,
+            expiry INTEGER NOT NULL
+            """
+        )
+        super().create_index('idx_notifications_expiry', 'expiry')
+
+    @classmethod
+    def insert_many(cls, messages: list, conn=None) -> None:
+        """
+        Record a notification for each of the given new messages
+
+        :param messages: dicts of the inserted message columns
+        :param conn: connection of an ongoing transaction, if any
+        """
+        expiry = int(time.time()) + cls.RETENTION
+        columns = 'recipient_name, message_id, sender_name, title, expiry'
+        super().insert_many(
+            columns=columns,
+            keys=cols2keys(columns),
+            values=[{
+                'recipient_name': x['recipient_name'], 'message_id': x['id'],
+                'sender_name': x['sender_name'], 'title': x['title'],
+                'expiry': expiry,
+            } for x in messages],
+            conn=conn
+        )
+
+    @classmethod
+    def last_id(cls) -> int:
+        """
+        Return the ID of the latest notification
+
+        :return: notification ID, 0 if there is none
+        """
+        stmt = DB.text('SELECT MAX(id) FROM {}'.format(cls.__tablename__))
+        return DB.engine.execute(stmt).scalar() or 0
+
+    @classmethod
+    def after(cls, last_id: int, limit: int) -> list:
+        """
+        Return the notifications recorded after the given one
+
+        :param last_id: ID of the last notification already read
+        :param limit: maximum number of notifications to return
+        :return: rows of (id, recipient_name, message_id, sender_name, title)
+        """
+        stmt = DB.text(
+            'SELECT id, recipient_name, message_id, sender_name, title FROM {} '
+            'WHERE id > :last_id ORDER BY id LIMIT :limit'.format(cls.__tablename__)
+        )
+        return DB.engine.execute(stmt.bindparams(last_id=last_id, limit=limit)).fetchall()
+
+    @classmethod
+    def select_ids(cls, ids: list) -> list:
+        """
+        Return the given notifications, those that exist
+
+        :param ids: IDs of the notifications to look for
+        :return: rows of (id, recipient_name, message_id, sender_name, title)
+        """
+        if not ids:
+            return []
+
+        stmt = DB.text(
+            'SELECT id, recipient_name, message_id, sender_name, title FROM {} '
+            'WHERE id IN :ids ORDER BY id'.format(cls.__tablename__)
+        ).bindparams(DB.bindparam('ids', expanding=True))
+        return DB.engine.execute(stmt, ids=list(ids)).fetchall()
+
+    @classmethod
+    def purge_expired(cls, batch_size: int = 1000) -> int:
+        """
+        Delete the notifications past their retention, in batches
+
+        :param batch_size: maximum number of rows deleted per statement
+        :return: number of deleted rows
+        """
+        return len(super().purge_expired(batch_size))
+
+# every model, in creation order (dropped in reverse)
+MODELS = (
+    User, MailboxStats, Session, Message, MessageIndex,
+    Revocation, RateLimit, Delivery, DeliveryRecipient, Notification,
+)
@@ -0,0 +1,229 @@
+# ---------------------------
+#Fichier : notify.py
+#Date : 14.10.2020
+#But : notification des nouveaux messages aux clients connectés (SSE)
+#Remarque : un seul thread par processus interroge la base, quel que
+#           soit le nombre de clients connectés
+#------------------------------
+
+import logging, queue, threading, time
+
+from messenger import APP
+from messenger.models import Notification, Session
+
+LOGGER = logging.getLogger('messenger.notify')
+
+class TooManySubscribers(Exception):
+    """
+    Raised when the process already serves `NOTIFY_MAX_SUBSCRIBERS` streams
+    """
+
+class Subscription(queue.Queue):
+    """
+    Queue of the events of one stream, closed by the notifier when its
+    session is logged out
+    """
+
+    def __init__(self, session_id: str, maxsize: int):
+        super().__init__(maxsize)
+        self.session_id = session_id
+        self.closed = False
+
+class Notifier(object):
+    """
+    In-process publish/subscribe of new message events, fed by polling
+    the notification table
+
+    Each connected client owns a small queue. A single thread reads
+    the notifications recorded since its last poll, by any process, and
+    dispatches them to the queues of their recipients, so that idle
+    clients cost no database query. The same thread periodically checks
+    that the sessions of the subscribers still exist.
+
+    IDs are allocated when a transaction inserts its notifications, but
+    the transactions may commit in another order. The IDs skipped by a
+    poll are therefore looked up again by the next ones, until they are
+    found or `gap_grace` seconds elapsed.
+    """
+
+    def __init__(self, max_subscribers: int, poll_interval: float, session_check: float = 10,
+                 queue_size: int = 16, gap_grace: float = 10, max_gaps: int = 1000):
+        """
+        :param max_subscribers: maximum number of concurrent subscribers
+        :param poll_interval: seconds between two polls of the database
+        :param session_check: seconds between two checks of the sessions
+        :param queue_size: events kept for a subscriber that lags behind,
+                           further events are dropped
+        :param gap_grace: seconds during which skipped IDs are looked up
+        :param max_gaps: maximum number of skipped IDs looked up
+        """
+        self.max_subscribers = max_subscribers
+        self.poll_interval = poll_interval
+        self.session_check = session_check
+        self.queue_size = queue_size
+        self.gap_grace = gap_grace
+        self.max_gaps = max_gaps
+        self._subscribers = {}
+        self._count = 0
+        self._lock = threading.Lock()
+        self._thread = None
+        self._last_id = None
+        # skipped notification IDs, with the time they were noticed
+        self._gaps = {}
+        self._checked_at = 0
+        self._tick = threading.Event()
+
+    def subscribe(self, username: str, session_id: str) -> Subscription:
+        """
+        Register a new subscriber to the messages of the given user
+
+        :param username: recipient to follow
+        :param session_id: session of the subscriber, the subscription is
+                           closed once it no longer exists
+        :raises TooManySubscribers: if the process is at capacity
+        :return: queue receiving the events, then None once it is closed
+        """
+        q = Subscription(session_id, self.queue_size)
+        with self._lock:
+            if self._count >= self.max_subscribers:
+                raise TooManySubscribers()
+            self._subscribers.setdefault(username, set()).add(q)
+            self._count += 1
+            if self._count == 1:
+                # start from the latest notification right away
+                self._tick.set()
+
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='notifier', daemon=True)
+                self._thread.start()
+        return q
+
+    def unsubscribe(self, username: str, q: queue.Queue) -> None:
+        """
+        Remove a subscriber
+
+        :param username: recipient it followed
+        :param q: queue returned by `subscribe`
+        """
+        with self._lock:
+            queues = self._subscribers.get(username, set())
+            if q in queues:
+                queues.discard(q)
+                self._count -= 1
+            if not queues:
+                self._subscribers.pop(username, None)
+
+    def publish(self, username: str, event: dict) -> None:
+        """
+        Hand an event to every subscriber of the given user
+
+        :param username: recipient of the event
+        :param event: event to send
+        """
+        with self._lock:
+            queues = list(self._subscribers.get(username, ()))
+        for q in queues:
+            try:
+                q.put_nowait(event)
+            except queue.Full:
+                pass
+
+    def check_sessions(self) -> int:
+        """
+        Close the subscriptions whose session was logged out or purged
+
+        :return: number of closed subscriptions
+        """
+        with self._lock:
+            queues = [q for qs in self._subscribers.values() for q in qs if not q.closed]
+        session_ids = [q.session_id for q in queues]
+
+        existing = set()
+        for i in range(0, len(session_ids), 1000):
+            existing |= Session.existing(session_ids[i:i + 1000])
+
+        closed = 0
+        for q in queues:
+            if q.session_id not in existing:
+                q.closed = True
+                closed += 1
+                try:
+                    # wake the stream up
+                    q.put_nowait(None)
+                except queue.Full:
+                    pass
+        return closed
+
+    def stats(self) -> dict:
+        """
+        Return the number of subscribers and followed users
+        """
+        with self._lock:
+            return {'subscribers': self._count, 'users': len(self._subscribers)}
+
+    def dispatch(self, row) -> None:
+        """
+        Publish a notification row to the subscribers of its recipient
+
+        :param row: (id, recipient_name, message_id, sender_name, title)
+        """
+        _, recipient_name, message_id, sender_name, title = row
+        self.publish(recipient_name, {
+            'id': message_id,
+            'sender': sender_name,
+            'title': title,
+        })
+
+    def poll(self) -> None:
+        """
+        Dispatch the notifications recorded since the previous poll, and
+        those committed late whose ID was skipped
+        """
+        if self._last_id is None:
+            self._last_id = Notification.last_id()
+            self._gaps = {}
+
+        if self._gaps:
+            now = time.monotonic()
+            # rolled back, or committed too late to be noticed
+            self._gaps = {id: seen for id, seen in self._gaps.items() if now - seen < self.gap_grace}
+            for row in Notification.select_ids(list(self._gaps)):
+                del self._gaps[row[0]]
+                self.dispatch(row)
+
+        while True:
+            rows = Notification.after(self._last_id, 1000)
+            now = time.monotonic()
+            for row in rows:
+                for id in range(self._last_id + 1, row[0]):
+                    if len(self._gaps) >= self.max_gaps:
+                        break
+                    self._gaps[id] = now
+                self.dispatch(row)
+                self._last_id = row[0]
+            if len(rows) < 1000:
+                return
+
+    def _run(self) -> None:
+        while True:
+            with self._lock:
+                listening = self._count > 0
+            if listening:
+                try:
+                    self.poll()
+                    if time.monotonic() - self._checked_at >= self.session_check:
+                        self._checked_at = time.monotonic()
+                        self.check_sessions()
+                except Exception:
+                    LOGGER.exception('Notification poll failed')
+            else:
+                # nobody missed anything, restart from the latest one
+                self._last_id = None
+            self._tick.wait(self.poll_interval)
+            self._tick.clear()
+
+NOTIFIER = Notifier(
+    APP.config['NOTIFY_MAX_SUBSCRIBERS'],
+    APP.config['NOTIFY_POLL_INTERVAL'],
+    APP.config['NOTIFY_SESSION_CHECK']
+)
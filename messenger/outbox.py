@@ -0,0 +1,103 @@
+# ---------------------------
+#Fichier : outbox.py
+#Date : 14.10.2020
+#But : distribution des messages en file d'attente par lots
+#Remarque : un thread par processus, ou la commande flask deliver
+#------------------------------
+
+import logging, threading
+
+from messenger import APP
+from messenger.models import Delivery
+from messenger.security import gen_rand_string
+
+LOGGER = logging.getLogger('messenger.outbox')
+
+_wakeup = threading.Event()
+_worker = {'thread': None}
+_worker_lock = threading.Lock()
+
+def send(sender_name, recipient_names, date, title, body) -> tuple:
+    """
+    Queue a message for delivery, delivering it right away if it fits
+    in a single chunk
+
+    :param sender_name: username of the sender
+    :param recipient_names: usernames of the receivers, or
+                            `Delivery.ALL_USERS`
+    :param date: date when the message was sended
+    :param title: title of the message
+    :param body: the message itself
+    :return: (delivery ID, True if already delivered)
+    """
+    delivery_id = Delivery.insert(sender_name, recipient_names, date, title, body)
+
+    if recipient_names != Delivery.ALL_USERS and len(recipient_names) <= APP.config['OUTBOX_CHUNK_SIZE']:
+        delivery = Delivery.claim(gen_rand_string('wk'), APP.config['OUTBOX_LEASE'], delivery_id)
+        if delivery and process(delivery):
+            return delivery_id, True
+
+    start_worker()
+    _wakeup.set()
+    return delivery_id, False
+
+def process(delivery: Delivery) -> bool:
+    """
+    Deliver the chunks of a claimed delivery until it is complete,
+    recording a failed attempt on error
+
+    :param delivery: delivery owned by the caller
+    :return: True if the delivery is complete
+    """
+    try:
+        while not delivery.deliver_chunk(APP.config['OUTBOX_CHUNK_SIZE'], APP.config['OUTBOX_LEASE']):
+            pass
+        return True
+    except Exception as e:
+        LOGGER.exception('Delivery %s failed', delivery.id)
+        delivery.fail(
+            '{}: {}'.format(type(e).__name__, e),
+            APP.config['OUTBOX_MAX_ATTEMPTS'],
+            APP.config['OUTBOX_RETRY_DELAY']
+        )
+        return False
+
+def run(once: bool = False) -> int:
+    """
+    Process due deliveries, waiting for new ones unless `once` is set
+
+    :param once: return as soon as no delivery is due
+    :return: number of deliveries processed
+    """
+    owner = gen_rand_string('wk')
+    processed = 0
+    while True:
+        delivery = Delivery.claim(owner, APP.config['OUTBOX_LEASE'])
+        if delivery:
+            process(delivery)
+            processed += 1
+            continue
+
+        if once:
+            return processed
+        _wakeup.wait(APP.config['OUTBOX_POLL_INTERVAL'])
+        _wakeup.clear()
+
+def start_worker() -> None:
+    """
+    Start the delivery thread of the current process, if not running
+    """
+    with _worker_lock:
+        if _worker['thread'] is None or not _worker['thread'].is_alive():
+            _worker['thread'] = threading.Thread(
+                target=_run_forever, name='outbox', daemon=True
+            )
+            _worker['thread'].start()
+
+def _run_forever() -> None:
+    while True:
+        try:
+            run()
+        except Exception:
+            LOGGER.exception('Outbox worker crashed, restarting')
+            _wakeup.wait(APP.config['OUTBOX_POLL_INTERVAL'])
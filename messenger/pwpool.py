@@ -0,0 +1,73 @@
+# ---------------------------
+#Fichier : pwpool.py
+#Date : 14.10.2020
+#But : hachage des mots de passe dans un pool de threads borné
+#Remarque : scrypt libère le GIL, les threads suffisent
+#------------------------------
+
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from messenger import APP
+from messenger import security
+
+class PoolBusy(Exception):
+    """
+    Raised when too many password hashes are already pending, or when
+    one waited longer than `PW_TIMEOUT`
+    """
+
+_executor = ThreadPoolExecutor(
+    max_workers=APP.config['PW_WORKERS'],
+    thread_name_prefix='pwpool'
+)
+# running and queued jobs, beyond which new ones are refused
+_slots = threading.BoundedSemaphore(APP.config['PW_WORKERS'] + APP.config['PW_QUEUE_MAX'])
+
+def run(fn, *args):
+    """
+    Run the given function on the password pool and wait for its result
+
+    :param fn: function to run
+    :param args: arguments of `fn`
+    :raises PoolBusy: if the pool queue is full, or the job did not
+                      finish in time
+    :return: return value of `fn`
+    """
+    if not _slots.acquire(blocking=False):
+        raise PoolBusy()
+
+    try:
+        future = _executor.submit(fn, *args)
+    except BaseException:
+        _slots.release()
+        raise
+
+    # the slot is freed once the job is done, even if we stop waiting
+    future.add_done_callback(lambda _: _slots.release())
+    try:
+        return future.result(timeout=APP.config['PW_TIMEOUT'])
+    except TimeoutError:
+        # drop the job if it is still queued, a running one keeps its
+        # slot until it finishes
+        future.cancel()
+        raise PoolBusy()
+
+def hash_pw(password):
+    """
+    Hash the given password on the password pool
+
+    :param password: password to hash
+    :return: hashed password with arguments
+    """
+    return run(security.hash_pw, password)
+
+def check_pw(password, pw_hash):
+    """
+    Check the given password on the password pool
+
+    :param password: password to check
+    :param pw_hash: hash string to compare with
+    :return: True if the password is correct, else False
+    """
+    return run(security.check_pw, password, pw_hash)
@@ -0,0 +1,45 @@
+# ---------------------------
+#Fichier : ratelimit.py
+#Date : 14.10.2020
+#But : stockage des compteurs de Flask-Limiter dans la base de données
+#Remarque : s'enregistre sous le schéma sql:// auprès de limits
+#------------------------------
+
+from limits.storage import Storage
+
+from messenger import DB
+from messenger.models import RateLimit
+
+class SQLStorage(Storage):
+    """
+    Rate limit storage keeping fixed-window counters in the
+    application database, so that every worker process enforces
+    the same limits.
+
+    Selected with `RATELIMIT_STORAGE_URL = 'sql://'`. Only the
+    fixed-window strategies are supported.
+    """
+
+    STORAGE_SCHEME = ['sql']
+
+    def incr(self, key, expiry, elastic_expiry=False):
+        return RateLimit.incr(key, expiry, elastic_expiry)
+
+    def get(self, key):
+        return RateLimit.get(key)
+
+    def get_expiry(self, key):
+        return RateLimit.get_expiry(key)
+
+    def check(self):
+        try:
+            DB.engine.execute('SELECT 1')
+            return True
+        except Exception:
+            return False
+
+    def reset(self):
+        DB.engine.execute('DELETE FROM {}'.format(RateLimit.__tablename__))
+
+    def clear(self, key):
+        RateLimit.delete('id', key)
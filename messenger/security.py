@@ -4,22 +4,32 @@
 #But :
 #Remarque :
 #------------------------------
-import random, string, base64, hmac, re
+import random, string, base64, hmac, re, hashlib, os
 
 
 SCRYPT_N = 65536
+SCRYPT_R = 8
+SCRYPT_P = 1
 SCRYPT_SALT_LEN = 16
+SCRYPT_KEY_LEN = 32
 API_ID_LEN = 24
 
-def implode(pw_hash, salt):
+def implode(pw_hash, salt, params=None):
     """
     Implodes the given hash and its arguments into a string
 
     :param pw_hash: password hash
     :param salt: hash salt
-    :returns: hash string with arguments in order (salt,hash)
+    :param params: scrypt parameters as a dict with keys n, r and p,
+                   None for the legacy HMAC format
+    :returns: hash string with arguments in order (salt,hash), preceded
+              by the algorithm and its parameters for scrypt
     """
-    return '$' + salt + '$' + pw_hash
+    if params is None:
+        return '$' + salt + '$' + pw_hash
+    return '$scrypt$n={n},r={r},p={p}${salt}${pw_hash}'.format(
+        salt=salt, pw_hash=pw_hash, **params
+    )
 
 def explode(hashstr):
     """
@@ -54,6 +64,26 @@ def pw_complexity(password):
     return True
 
 
+def scrypt(password, salt, n, r, p):
+    """
+    Derives the scrypt key of the given password
+
+    :param password: password to hash
+    :param salt: hash salt
+    :param n: CPU/memory cost
+    :param r: block size
+    :param p: parallelization
+    :returns: base64-encoded key
+    """
+    return base64.b64encode(hashlib.scrypt(
+        password.encode('utf8'),
+        salt=salt.encode('utf8'),
+        n=n, r=r, p=p,
+        # scrypt needs 128 * n * r bytes, leave some headroom
+        maxmem=256 * n * r,
+        dklen=SCRYPT_KEY_LEN
+    )).decode('utf8')
+
 def hash_pw(password):
     """
     Hashes the given password using scrypt and a random salt
@@ -62,28 +92,33 @@ def hash_pw(password):
     :returns: hashed password with arguments
     """
 
-    salt = gen_rand_string()
-    pw_hash = base64.b64encode(
-        hmac.new(
-            key=salt.encode('utf8'),
-            msg=password.encode('utf8'),
-            digestmod='SHA256'
-        ).digest()
-    ).decode('utf8')
+    salt = base64.b64encode(os.urandom(SCRYPT_SALT_LEN)).decode('utf8')
+    params = {'n': SCRYPT_N, 'r': SCRYPT_R, 'p': SCRYPT_P}
 
-    return implode(pw_hash, salt)
+    return implode(scrypt(password, salt, **params), salt, params)
 
 def check_pw(password, pw_hash):
     """
     Checks whether the specified password and parameters match the given hash
 
+    Both scrypt hashes and legacy HMAC-SHA256 hashes are accepted.
+
     :param password: password to check
     :param pw_hash: hash string to compare with
     :returns: True if the password is correct, else False
     """
 
     hashvars = explode(pw_hash)
-    mac = base64.b64decode(pw_hash)
+
+    if len(hashvars) == 5 and hashvars[1] == 'scrypt':
+        params = dict(
+            (key, int(value)) for key, value in
+            (x.split('=') for x in hashvars[2].split(','))
+        )
+        return hmac.compare_digest(
+            hashvars[4].encode('utf8'),
+            scrypt(password, hashvars[3], **params).encode('utf8')
+        )
 
     return hmac.compare_digest(hashvars[2].encode('utf8'), base64.b64encode(hmac.new(
         key=hashvars[1].encode('utf8'),
@@ -91,6 +126,17 @@ def check_pw(password, pw_hash):
         digestmod='SHA256'
     ).digest()))
 
+def needs_rehash(pw_hash):
+    """
+    Checks whether the given hash was made with outdated parameters
+
+    :param pw_hash: hash string to check
+    :returns: True if the password should be hashed again
+    """
+    return not pw_hash.startswith(
+        '$scrypt$n={},r={},p={}$'.format(SCRYPT_N, SCRYPT_R, SCRYPT_P)
+    )
+
 def gen_rand_string(prefix=None):
     """
     Generates a random string of 24 characters (alphanumeric case-sensitive)
@@ -103,3 +149,15 @@ def gen_rand_string(prefix=None):
             string.ascii_letters + string.digits
         ) for _ in range(API_ID_LEN)
     )
+
+def username_allowed(username):
+    """
+    Checks that a new username can be told apart in a recipient field
+
+    :param username: username to verify
+    :returns: false for the reserved targets starting with `@` (such as
+              `@all`) and for usernames with commas or spaces
+    """
+    if not username or username.startswith('@'):
+        return False
+    return username.replace(',', ' ').split() == [username]
@@ -5,46 +5,136 @@
 #Remarque :
 #------------------------------
 
-import datetime as dt
+import datetime as dt, hashlib, hmac, json, os, queue
 
-from flask import render_template, request, flash, redirect, make_response
+from flask import render_template, request, flash, redirect, make_response, jsonify, Response
+from flask import session as flask_session, g
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 
-from messenger import APP
-from messenger.models import User, Session, Message, Model, get_current_timestamp
-from messenger.security import check_pw, hash_pw, gen_rand_string, pw_complexity
+from messenger import APP, DB, cache, database, ratelimit, outbox, metrics, security
+from messenger.models import User, Session, Message, Model, Delivery, MailboxStats, MessageIndex, get_current_timestamp
+from messenger.notify import NOTIFIER, TooManySubscribers
+from messenger.security import gen_rand_string, pw_complexity, needs_rehash, username_allowed
+from messenger.pwpool import check_pw, hash_pw, PoolBusy
 from messenger.decorators import is_logged_in, is_admin
-from messenger.jwt import jwt_decode, jwt_encode, get_current_jwt
+from messenger.auth import current_user, current_session
+from messenger.jwt import jwt_encode
+
+INBOX_PAGE_SIZE = 50
+SEARCH_PAGE_SIZE = 20
+SUGGEST_MAX = 10
+ADMIN_PAGE_SIZE = 50
+# recipient targeting every user, reserved to admins
+ALL_USERS = Delivery.ALL_USERS
+# hash of a random password, checked for unknown usernames
+DUMMY_PW_HASH = security.hash_pw(gen_rand_string())
 
 limiter = Limiter(
     APP,
     key_func=get_remote_address
 )
 
-def current_user():
-    # What is GEN ? Baby don't duplicate me, don't duplicate me, oh no
-
-    # check if session cookie is present
-    cookie = request.cookies.get('auth')
-    if not cookie:
+def templates_version() -> str:
+    """
+    Digest of the templates, so that pages cached by the browsers are
+    refreshed when a new version is deployed
+    """
+    digest = hashlib.sha256()
+    for root, _, files in sorted(os.walk(APP.jinja_loader.searchpath[0])):
+        for name in sorted(files):
+            with open(os.path.join(root, name), 'rb') as f:
+                digest.update(f.read())
+    return digest.hexdigest()
+
+TEMPLATES_VERSION = templates_version()
+
+def page_etag(user: User, *parts) -> str:
+    """
+    Build the entity tag of a page rendered for the given user
+
+    Pages showing pending flash messages are not tagged, so that they
+    are always rendered.
+
+    :param user: user the page is rendered for
+    :param parts: values the page content depends on
+    :return: entity tag, None if the page must not be cached
+    """
+    if flask_session.get('_flashes'):
         return None
+    key = '\0'.join(str(x) for x in (TEMPLATES_VERSION, user.username, user.admin) + parts)
+    return hashlib.sha256(key.encode()).hexdigest()[:32]
 
-    # check if a valid JWT came in the cookie
-    payload = jwt_decode(cookie)
-    if not payload:
-        return None
+def not_modified(etag: str):
+    """
+    Answer a conditional request whose cached page is still current
 
-    # check if the named session exists
-    session = Session.select(payload['session'])
-    if not session:
+    :param etag: entity tag of the current page, if any
+    :return: 304 response if the client's copy matches, else None
+    """
+    if etag is None or not request.if_none_match.contains(etag):
         return None
 
-    # check if the session has expired
-    if session.expiry <= dt.datetime.now():
-        return None
+    res = make_response('', 304)
+    res.set_etag(etag)
+    return res
 
-    return User.from_session(get_current_jwt()['session'])
+def with_etag(page: str, etag: str):
+    """
+    Make a response of a rendered page
+
+    :param page: rendered page
+    :param etag: entity tag of the page, if any
+    :return: response
+    """
+    res = make_response(page)
+    if etag is not None:
+        res.set_etag(etag)
+        # let the browser keep the page but always revalidate it
+        res.headers['Cache-Control'] = 'private, no-cache'
+    return res
+
+def mailbox():
+    """
+    Return the inbox summary of the logged in user, read once per request
+
+    :return: MailboxStats, None if nobody is logged in
+    """
+    if 'mailbox' not in g:
+        user = current_user()
+        g.mailbox = MailboxStats.select(user.username) if user else None
+    return g.mailbox
+
+def mailbox_version() -> tuple:
+    """
+    Values identifying the current content of the logged in user's inbox
+    """
+    stats = mailbox()
+    return stats.version, stats.count, stats.newest_id
+
+@APP.context_processor
+def inject_mailbox():
+    # message counter of the navigation bar
+    return {'mailbox': mailbox()}
+
+def get_user_or_address():
+    """
+    Rate limit key of the logged in user, or of the remote address
+    """
+    user = current_user()
+    return 'user:' + user.username if user else get_remote_address()
+
+@APP.errorhandler(PoolBusy)
+def pool_busy(e):
+    res = make_response('Server busy, please try again in a moment', 503)
+    res.headers['Retry-After'] = '1'
+    return res
+
+@APP.before_request
+def start_outbox_worker():
+    # resume the deliveries left pending by a previous process
+    if APP.config['OUTBOX_WORKER']:
+        outbox.start_worker()
 
 @APP.route('/')
 def index():
@@ -55,19 +145,123 @@ def index():
 def inbox():
     user = current_user()
 
-    senders = {}
-    if user.messages:
-        for msg in user.messages:
-            senders[msg.sender_name] = '{}'.format(User.select(msg.sender_name))
+    before = Message.parse_cursor(request.args.get('before', type=str))
 
-    return render_template(
+    etag = page_etag(user, 'inbox', before, *mailbox_version())
+    res = not_modified(etag)
+    if res:
+        return res
+
+    # fetch one extra message to know whether there is an older page
+    messages = user.inbox(INBOX_PAGE_SIZE + 1, before)
+    next_cursor = None
+    if len(messages) > INBOX_PAGE_SIZE:
+        messages = messages[:INBOX_PAGE_SIZE]
+        next_cursor = messages[-1].cursor
+
+    senders = User.display_names(msg.sender_name for msg in messages)
+
+    return with_etag(render_template(
         'inbox.html',
         title='Inbox',
         user=user,
-        senders=senders
+        messages=messages,
+        senders=senders,
+        first_page=before is None,
+        next_cursor=next_cursor
+    ), etag)
+
+@APP.route('/inbox/status')
+@is_logged_in
+def inbox_status():
+    # polled by the inbox page when the stream is disabled
+    stats = mailbox()
+    res = jsonify(version=stats.version, count=stats.count, newest=stats.newest_id)
+    res.headers['Cache-Control'] = 'no-cache'
+    return res
+
+@APP.route('/inbox/stream')
+@is_logged_in
+def inbox_stream():
+    if not APP.config['SSE_ENABLED']:
+        return make_response('Streaming is disabled', 404)
+
+    user = current_user()
+    session = current_session()
+
+    try:
+        events = NOTIFIER.subscribe(user.username, session.id)
+    except TooManySubscribers:
+        res = make_response('Too many open streams, please try again later', 503)
+        res.headers['Retry-After'] = '30'
+        return res
+
+    # the generator runs after the request context is gone
+    username, expiry = user.username, session.expiry
+    heartbeat = APP.config['SSE_HEARTBEAT']
+
+    def stream():
+        try:
+            yield 'retry: 5000\n\n'
+            # closed by the notifier once the session is logged out
+            while dt.datetime.now() < expiry and not events.closed:
+                try:
+                    event = events.get(timeout=heartbeat)
+                except queue.Empty:
+                    yield ': keepalive\n\n'
+                    continue
+                if event is None:
+                    break
+                yield 'event: message\ndata: {}\n\n'.format(json.dumps(event))
+        finally:
+            NOTIFIER.unsubscribe(username, events)
+
+    res = Response(stream(), mimetype='text/event-stream')
+    res.headers['Cache-Control'] = 'no-cache'
+    # let nginx pass the events through without buffering them
+    res.headers['X-Accel-Buffering'] = 'no'
+    return res
+
+@APP.route('/search')
+@is_logged_in
+def search():
+    user = current_user()
+
+    query = request.args.get('q', '', type=str)[:Model.TEXT_MAX_LEN]
+    page = max(request.args.get('page', 1, type=int), 1)
+
+    # fetch one extra message to know whether there is a next page
+    messages = MessageIndex.search(
+        user.username, query, SEARCH_PAGE_SIZE + 1, (page - 1) * SEARCH_PAGE_SIZE
+    )
+    has_next = len(messages) > SEARCH_PAGE_SIZE
+    messages = messages[:SEARCH_PAGE_SIZE]
+
+    senders = User.display_names(msg.sender_name for msg in messages)
+
+    return render_template(
+        'search.html',
+        title='Search',
+        user=user,
+        query=query,
+        messages=messages,
+        senders=senders,
+        page=page,
+        has_next=has_next
     )
 
+def parse_recipients(field: str) -> list:
+    """
+    Split a recipient field into distinct usernames
+
+    :param field: usernames separated by commas or spaces
+    :return: usernames, in order of first appearance
+    """
+    # dicts keep their insertion order
+    return list(dict.fromkeys(field.replace(',', ' ').split()))
+
 @APP.route('/compose', methods=['GET', 'POST'])
+@limiter.limit(APP.config['COMPOSE_RATE_LIMIT'], methods=['POST'], key_func=get_user_or_address)
 @is_logged_in
 def compose(msg_title=None, msg_recipient=None):
     user = current_user()
@@ -80,27 +274,52 @@ def compose(msg_title=None, msg_recipient=None):
             'body': request.form.get('body', type=str),
         }
 
+        recipients = parse_recipients(args['recipient'] or '')
+
         # ensure fields are present and within database limits
-        if any(x == None for x in args.values()):
+        if any(x == None for x in args.values()) or not recipients:
             flash('All fields are required', 'alert-danger')
-        elif any(len(x) > Model.TEXT_MAX_LEN for x in args.values()):
+        elif any(len(x) > Model.TEXT_MAX_LEN for x in recipients + [args['title'], args['body']]):
             flash(
                 'Fields may not exceed {} characters'.format(Model.TEXT_MAX_LEN),
                 'alert-danger'
             )
-        # check if recipient exists
-        elif not User.find(args['recipient']):
-            flash("Recipient doesn't exist", 'alert-danger')
-        # create new message
+        elif ALL_USERS in recipients and not user.admin:
+            flash('Only administrators may message all users', 'alert-danger')
         else:
-            message = Message.insert(
-                sender_name=user.username,
-                recipient_name=args['recipient'],
-                date=get_current_timestamp(),
-                title=args['title'],
-                body=args['body']
-            )
-            flash('Message successfully sent', 'alert-success')
+            if ALL_USERS in recipients:
+                recipients = ALL_USERS
+                missing = []
+            # check if recipients exist
+            else:
+                existing = User.existing(recipients)
+                missing = [x for x in recipients if x not in existing]
+
+            if missing:
+                flash("Recipient doesn't exist: {}".format(', '.join(missing)), 'alert-danger')
+            # create new messages
+            else:
+                delivery_id, delivered = outbox.send(
+                    sender_name=user.username,
+                    recipient_names=recipients,
+                    date=get_current_timestamp(),
+                    title=args['title'],
+                    body=args['body']
+                )
+                if recipients == ALL_USERS:
+                    metrics.MESSAGES.inc(target='all')
+                else:
+                    metrics.MESSAGES.inc(target='single' if len(recipients) == 1 else 'multiple')
+                    metrics.RECIPIENTS.inc(len(recipients))
+                if not delivered:
+                    flash(
+                        'Message queued for delivery, follow its progress at /outbox/{}'.format(delivery_id),
+                        'alert-success'
+                    )
+                elif len(recipients) == 1:
+                    flash('Message successfully sent', 'alert-success')
+                else:
+                    flash('Message successfully sent to {} recipients'.format(len(recipients)), 'alert-success')
 
     return render_template(
         'compose.html',
@@ -110,6 +329,39 @@ def compose(msg_title=None, msg_recipient=None):
         msg_recipient=msg_recipient
     )
 
+@APP.route('/users/suggest')
+@is_logged_in
+def users_suggest():
+    prefix = request.args.get('q', '', type=str).strip()[:Model.TEXT_MAX_LEN]
+    limit = min(max(request.args.get('k', SUGGEST_MAX, type=int), 1), SUGGEST_MAX)
+
+    res = jsonify(users=[
+        {'username': username, 'name': name}
+        for username, name in User.suggest(prefix, limit)
+    ])
+    # suggestions may lag behind new accounts for a little while
+    res.headers['Cache-Control'] = 'private, max-age=60'
+    return res
+
+@APP.route('/outbox/<string:delivery_id>')
+@is_logged_in
+def outbox_id(delivery_id):
+    user = current_user()
+
+    delivery = Delivery.select(delivery_id) if len(delivery_id) <= Model.TEXT_MAX_LEN else None
+    if not delivery or (delivery.sender_name != user.username and not user.admin):
+        return jsonify(error="Delivery doesn't exist"), 404
+
+    return jsonify(
+        id=delivery.id,
+        status=delivery.status,
+        total=delivery.total,
+        delivered=delivery.delivered,
+        skipped=delivery.skipped,
+        attempts=delivery.attempts,
+        error=delivery.error
+    )
+
 @APP.route('/message/<string:message_id>')
 @is_logged_in
 def message_id(message_id):
@@ -119,6 +371,13 @@ def message_id(message_id):
         flash('Bad message ID', 'alert-danger')
         return redirect('/inbox')
 
+    # messages never change, the inbox version only tells whether
+    # this one may have been deleted since
+    etag = page_etag(user, 'message', message_id, *mailbox_version())
+    res = not_modified(etag)
+    if res:
+        return res
+
     message = Message.select(message_id)
     if not message:
         flash("Message doesn't exist", 'alert-danger')
@@ -127,15 +386,15 @@ def message_id(message_id):
         flash("Can't view messages from other users", 'alert-danger')
         return redirect('/inbox')
 
-    sender = '{}'.format(User.select(message.sender_name))
+    sender = User.display_names([message.sender_name]).get(message.sender_name)
 
-    return render_template(
+    return with_etag(render_template(
         'message_id.html',
         title=message.title,
         user=user,
         message=message,
         sender=sender
-    )
+    ), etag)
 
 @APP.route('/message/<string:message_id>/reply')
 @is_logged_in
@@ -184,13 +443,82 @@ def message_delete(message_id):
 def admin():
     user = current_user()
 
+    def flag(name):
+        return {'yes': True, 'no': False}.get(request.args.get(name, type=str))
+
+    filters = {
+        'username': request.args.get('username', '', type=str).strip()[:Model.TEXT_MAX_LEN],
+        'name': request.args.get('name', '', type=str).strip()[:Model.TEXT_MAX_LEN],
+        'active': flag('active'),
+        'admin': flag('admin'),
+    }
+    order = request.args.get('sort', 'username', type=str)
+    if order not in User.LISTING_ORDERS:
+        order = 'username'
+    descending = request.args.get('desc', type=str) == '1'
+    page = max(request.args.get('page', 1, type=int), 1)
+
+    # fetch one extra user to know whether there is a next page
+    users = User.listing(
+        order=order, descending=descending,
+        limit=ADMIN_PAGE_SIZE + 1, offset=(page - 1) * ADMIN_PAGE_SIZE,
+        **filters
+    )
+    has_next = len(users) > ADMIN_PAGE_SIZE
+
+    # current query string, without the given keys
+    def args_without(*keys):
+        return {k: v for k, v in request.args.items() if k not in keys and v}
+
     return render_template(
         'admin.html',
         title='Administration',
         user=user,
-        users=User.all()
+        users=users[:ADMIN_PAGE_SIZE],
+        order=order,
+        descending=descending,
+        page=page,
+        has_next=has_next,
+        args_without=args_without
+    )
+
+@APP.route('/admin/stats')
+@is_admin
+def admin_stats():
+    return jsonify(
+        cache=cache.stats(),
+        pool=database.pool_stats(DB.engine.pool),
+        streams=NOTIFIER.stats()
     )
 
+@metrics.snapshot
+def process_metrics():
+    for name, stats in cache.stats().items():
+        metrics.CACHE_HITS.set_total(stats['hits'], cache=name)
+        metrics.CACHE_MISSES.set_total(stats['misses'], cache=name)
+        metrics.CACHE_EVICTIONS.set_total(stats['evictions'], cache=name)
+
+    pid = str(os.getpid())
+    for stat, value in database.pool_stats(DB.engine.pool).items():
+        if isinstance(value, (int, float)):
+            metrics.POOL.set(value, pid=pid, stat=stat)
+    metrics.STREAMS.set(NOTIFIER.stats()['subscribers'], pid=pid)
+
+@APP.route('/metrics')
+def metrics_export():
+    token = APP.config['METRICS_TOKEN']
+    if token:
+        if not hmac.compare_digest(request.headers.get('Authorization', ''), 'Bearer ' + token):
+            return make_response('Unauthorized', 401)
+    elif request.remote_addr not in ('127.0.0.1', '::1'):
+        return make_response('Forbidden', 403)
+
+    text = metrics.collect([
+        ('messenger_active_sessions', 'Unexpired sessions', [({}, Session.count_active())]),
+        ('messenger_users', 'Registered users', [({}, User.count())]),
+    ])
+    return Response(text, mimetype='text/plain; version=0.0.4')
+
 @APP.route('/user/<string:username>', methods=['GET', 'POST'])
 @is_admin
 def user_id(username):
@@ -292,6 +620,8 @@ def user_add():
                 'Fields may not exceed {} characters'.format(Model.TEXT_MAX_LEN),
                 'alert-danger'
             )
+        elif not username_allowed(args['username']):
+            flash('Usernames may not start with @ nor contain commas or spaces', 'alert-danger')
         elif (pw_complexity(args['password']) == False):
             flash("Password needs 8 characters minimum, with at least 1 digit, 1 minuscule and 1 majuscule.", 'alert-danger')
         elif args['password'] != args['password_confirm']:
@@ -345,7 +675,7 @@ def change_password():
         elif not check_pw(args['currentPassword'], user.password):
             flash('Current password is incorrect', 'alert-danger')
         else:
-            User.change_pass(user.username, args['newPassword'])
+            User.change_pass(user.username, hash_pw(args['newPassword']))
 
             flash('Password successfully changed', 'alert-success')
             return logout(False)
@@ -357,7 +687,7 @@ def change_password():
     )
 
 @APP.route('/login', methods=['GET', 'POST'])
-@limiter.limit("5 per minute")
+@limiter.limit(APP.config['LOGIN_RATE_LIMIT'])
 def login():
     # handle incoming form
     if request.method == 'POST':
@@ -378,11 +708,24 @@ def login():
                 'Fields may not exceed {} characters'.format(Model.TEXT_MAX_LEN),
                 'alert-danger'
             )
-        elif not (user and check_pw(args['password'], user.password)):
+        # unknown usernames are checked against a dummy hash, so that the
+        # response time does not tell whether they exist
+        elif not check_pw(args['password'], user.password if user else DUMMY_PW_HASH) or not user:
+            metrics.LOGINS.inc(result='failure')
             flash('Bad credentials', 'alert-danger')
         elif not user.active:
+            metrics.LOGINS.inc(result='disabled')
             flash('Account disabled, please contact an administrator', 'alert-danger')
         else:
+            metrics.LOGINS.inc(result='success')
+
+            # upgrade hashes made with outdated parameters
+            if needs_rehash(user.password):
+                try:
+                    User.update(user.username, {'password': hash_pw(args['password'])})
+                except PoolBusy:
+                    pass
+
             # generate new session
             expiry = get_current_timestamp()
             session_id = gen_rand_string()
@@ -399,7 +742,11 @@ def login():
             # TODO secure=True
             res.set_cookie(
                 key='auth',
-                value=jwt_encode({'session': session_id, 'exp': expiry}),
+                value=jwt_encode({
+                    'session': session_id,
+                    'sub': user.username,
+                    'exp': expiry
+                }),
                 expires=expiry,
                 samesite='Strict',
             )
@@ -415,7 +762,7 @@ def login():
 @is_logged_in
 def logout(do_flash=True):
     # delete session
-    Session.delete(get_current_jwt()['session'])
+    Session.delete(current_session().id)
 
     # force cookie expiry on client side
     res = make_response(redirect('/login'))
@@ -427,6 +774,7 @@ def logout(do_flash=True):
     return res
 
 @APP.route('/signup', methods=['GET', 'POST'])
+@limiter.limit(APP.config['SIGNUP_RATE_LIMIT'], methods=['POST'])
 def signup():
     # handle incoming form
     if request.method == 'POST':
@@ -447,6 +795,8 @@ def signup():
                 'Fields may not exceed {} characters'.format(Model.TEXT_MAX_LEN),
                 'alert-danger'
             )
+        elif not username_allowed(args['username']):
+            flash('Usernames may not start with @ nor contain commas or spaces', 'alert-danger')
         elif (pw_complexity(args['password']) == False):
             flash("Password needs 8 characters minimum, with at least 1 digit, 1 minuscule and 1 majuscule.", 'alert-danger')
         elif args['password'] != args['password_confirm']:
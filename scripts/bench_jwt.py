@@ -0,0 +1,82 @@
+# ---------------------------
+#Fichier : bench_jwt.py
+#Date : 14.10.2020
+#But : mesurer le nombre de JWT vérifiés par seconde
+#Remarque : compare avec l'ancienne vérification (re-sérialisation)
+#------------------------------
+
+import os, sys, inspect, argparse, time, hmac
+
+CWD = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+sys.path.insert(0, os.path.dirname(CWD))
+
+from messenger.jwt import jwt_encode, jwt_decode, b64unpack, VERIFIED_CACHE
+from messenger.models import get_current_timestamp
+
+def legacy_decode(jwt: str) -> dict:
+    """
+    Former `jwt_decode`: parses the token, re-encodes it and compares
+    whole strings
+    """
+    header, payload, signature = jwt.split('.')
+
+    header = b64unpack(header)
+    payload = b64unpack(payload)
+
+    own_jwt = jwt_encode(payload, header)
+
+    if hmac.compare_digest(own_jwt, jwt):
+        return payload
+    return None
+
+def bench(name: str, decode, tokens: list, duration: float) -> None:
+    """
+    Verify the given tokens in a loop and print the throughput
+
+    :param name: label of the measured implementation
+    :param decode: verification function
+    :param tokens: tokens to verify, in turn
+    :param duration: minimum measurement time, in seconds
+    """
+    count = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        for token in tokens:
+            decode(token)
+        count += len(tokens)
+    elapsed = time.perf_counter() - start
+    print('{:<28} {:>12,.0f} tokens/s'.format(name, count / elapsed))
+
+def main():
+    parser = argparse.ArgumentParser(description='JWT verification micro-benchmark')
+    parser.add_argument('--tokens', type=int, default=1000, help='distinct tokens')
+    parser.add_argument('--duration', type=float, default=2, help='seconds per run')
+    args = parser.parse_args()
+
+    tokens = [
+        jwt_encode({'session': 'bench_{}'.format(i), 'sub': 'user', 'exp': get_current_timestamp()})
+        for i in range(args.tokens)
+    ]
+    forged = [token[:-4] + 'AAA=' for token in tokens]
+    garbage = ['not-a-jwt'] * args.tokens
+
+    def uncached(token):
+        VERIFIED_CACHE.invalidate(token)
+        return jwt_decode(token)
+
+    def legacy_safe(token):
+        try:
+            return legacy_decode(token)
+        except ValueError:
+            return None
+
+    bench('legacy', legacy_decode, tokens, args.duration)
+    bench('legacy (forged)', legacy_decode, forged, args.duration)
+    bench('legacy (malformed)', legacy_safe, garbage, args.duration)
+    bench('fast path (uncached)', uncached, tokens, args.duration)
+    bench('fast path (cached)', jwt_decode, tokens, args.duration)
+    bench('fast path (forged)', jwt_decode, forged, args.duration)
+    bench('fast path (malformed)', jwt_decode, garbage, args.duration)
+
+if __name__ == '__main__':
+    main()
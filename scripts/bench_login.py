@@ -0,0 +1,88 @@
+# ---------------------------
+#Fichier : bench_login.py
+#Date : 14.10.2020
+#But : mesurer le nombre de connexions par seconde sous concurrence
+#Remarque : utilise une base SQLite temporaire
+#------------------------------
+
+import os, sys, inspect, argparse, tempfile, threading, time
+
+CWD = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+sys.path.insert(0, os.path.dirname(CWD))
+
+DB_FILE = os.path.join(tempfile.mkdtemp(), 'bench_login.sqlite')
+os.environ['STI_MSN_DB'] = 'sqlite:///' + DB_FILE
+
+from messenger import APP
+from messenger.models import MODELS, User
+from messenger.security import hash_pw
+
+USERNAME = 'bench'
+PASSWORD = 'Bench1234'
+
+def worker(stop: threading.Event, results: dict, lock: threading.Lock) -> None:
+    """
+    Log in repeatedly until told to stop, counting responses by status
+    """
+    client = APP.test_client()
+    counts = {}
+    while not stop.is_set():
+        res = client.post('/login', data={'username': USERNAME, 'password': PASSWORD})
+        counts[res.status_code] = counts.get(res.status_code, 0) + 1
+
+    with lock:
+        for status, count in counts.items():
+            results[status] = results.get(status, 0) + count
+
+def bench(concurrency: int, duration: float) -> None:
+    """
+    Run `concurrency` logging-in threads for `duration` seconds and
+    print the throughput
+
+    :param concurrency: number of concurrent clients
+    :param duration: measurement time, in seconds
+    """
+    stop, lock, results = threading.Event(), threading.Lock(), {}
+    threads = [
+        threading.Thread(target=worker, args=(stop, results, lock))
+        for _ in range(concurrency)
+    ]
+
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    ok = results.get(302, 0)
+    busy = results.get(503, 0)
+    print('{:>4} clients {:>10.1f} logins/s {:>8} rejected (503)'.format(
+        concurrency, ok / elapsed, busy
+    ))
+
+def main():
+    parser = argparse.ArgumentParser(description='Login throughput benchmark')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32])
+    parser.add_argument('--duration', type=float, default=5, help='seconds per run')
+    args = parser.parse_args()
+
+    APP.config['RATELIMIT_ENABLED'] = False
+    APP.extensions['limiter'].enabled = False
+
+    for model in reversed(MODELS):
+        model.drop_table()
+    for model in MODELS:
+        model.create_table()
+    User.insert(False, 'Bench', 'User', USERNAME, hash_pw(PASSWORD))
+
+    print('{} password workers, queue of {}'.format(
+        APP.config['PW_WORKERS'], APP.config['PW_QUEUE_MAX']
+    ))
+    for concurrency in args.concurrency:
+        bench(concurrency, args.duration)
+
+if __name__ == '__main__':
+    main()
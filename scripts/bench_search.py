@@ -0,0 +1,107 @@
+# ---------------------------
+#Fichier : bench_search.py
+#Date : 14.10.2020
+#But : comparer la recherche plein texte avec un parcours LIKE '%q%'
+#Remarque : utilise une base SQLite temporaire (FTS5)
+#------------------------------
+
+import os, sys, inspect, argparse, random, tempfile, time
+
+CWD = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+sys.path.insert(0, os.path.dirname(CWD))
+
+DB_FILE = os.path.join(tempfile.mkdtemp(), 'bench_search.sqlite')
+os.environ['STI_MSN_DB'] = 'sqlite:///' + DB_FILE
+
+from messenger import DB
+from messenger.models import MODELS, User, Message, MessageIndex, get_current_timestamp
+
+COMMON = (
+    'meeting report budget lunch project deadline review invoice holiday '
+    'server backup release password network planning weekly friday draft '
+    'contract client support update schedule training office printer'
+).split()
+# vocabulary following a Zipf distribution, as natural language does
+WORDS = COMMON + ['word{}'.format(i) for i in range(20000)]
+WEIGHTS = [1 / (rank + 1) for rank in range(len(WORDS))]
+
+def like_search(recipient_name: str, query: str, limit: int) -> list:
+    """
+    Naive search: scan the recipient's inbox with `LIKE '%q%'`
+    """
+    stmt = 'SELECT * FROM {} WHERE recipient_name=:recipient_name'.format(Message.__tablename__)
+    params = {'recipient_name': recipient_name, 'limit': limit}
+    for i, term in enumerate(MessageIndex.terms(query)):
+        stmt += ' AND (title LIKE :term{0} OR body LIKE :term{0})'.format(i)
+        params['term{}'.format(i)] = '%{}%'.format(term)
+    stmt += ' ORDER BY date DESC LIMIT :limit'
+    return DB.engine.execute(DB.text(stmt).bindparams(**params)).fetchall()
+
+def sentence(rnd: random.Random, words: int) -> str:
+    return ' '.join(rnd.choices(WORDS, WEIGHTS, k=words))
+
+def seed(users: int, messages: int, rnd: random.Random) -> list:
+    """
+    Create the tables and send `messages` random messages to each user
+
+    :return: usernames
+    """
+    for model in reversed(MODELS):
+        model.drop_table()
+    for model in MODELS:
+        model.create_table()
+
+    usernames = ['user{}'.format(i) for i in range(users)]
+    for username in usernames:
+        User.insert(False, 'Bench', 'User', username, 'x')
+
+    date = get_current_timestamp()
+    for _ in range(messages):
+        title = sentence(rnd, 3)
+        Message.insert_many(usernames[0], usernames, date, title, sentence(rnd, 25))
+    return usernames
+
+def bench(name: str, search, queries: list, duration: float) -> None:
+    """
+    Run the given queries in a loop and print the latency
+
+    :param name: label of the measured implementation
+    :param search: function of (recipient, query)
+    :param queries: (recipient, query) pairs, run in turn
+    :param duration: minimum measurement time, in seconds
+    """
+    count = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        for recipient_name, query in queries:
+            search(recipient_name, query)
+        count += len(queries)
+    elapsed = time.perf_counter() - start
+    print('{:<24} {:>10,.0f} queries/s {:>10.3f} ms/query'.format(
+        name, count / elapsed, elapsed / count * 1000
+    ))
+
+def main():
+    parser = argparse.ArgumentParser(description='Message search benchmark')
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--messages', type=int, default=5000, help='messages per user')
+    parser.add_argument('--duration', type=float, default=3, help='seconds per run')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    rnd = random.Random(args.seed)
+    start = time.perf_counter()
+    usernames = seed(args.users, args.messages, rnd)
+    print('Seeded {:,} messages in {:.1f}s ({} index)'.format(
+        args.users * args.messages, time.perf_counter() - start, MessageIndex.backend()
+    ))
+
+    queries = [
+        (rnd.choice(usernames), ' '.join(rnd.choices(WORDS, WEIGHTS, k=rnd.randint(1, 2))))
+        for _ in range(100)
+    ]
+    bench('LIKE scan', lambda r, q: like_search(r, q, 20), queries, args.duration)
+    bench('full-text index', lambda r, q: MessageIndex.search(r, q, 20), queries, args.duration)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,306 @@
+# ---------------------------
+#Fichier : bench_suite.py
+#Date : 14.10.2020
+#But : mesurer les modèles et les vues sur une base générée, comparer
+#      avec une référence enregistrée
+#Remarque : utilise une base SQLite temporaire
+#------------------------------
+
+import os, sys, inspect, argparse, json, platform, random, re, sqlite3, tempfile, time
+
+CWD = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+sys.path.insert(0, os.path.dirname(CWD))
+
+DB_FILE = os.path.join(tempfile.mkdtemp(), 'bench_suite.sqlite')
+os.environ['STI_MSN_DB'] = 'sqlite:///' + DB_FILE
+os.environ.setdefault('STI_MSN_RATELIMIT', '0')
+os.environ.setdefault('STI_MSN_OUTBOX_WORKER', '0')
+
+from messenger import APP, DB
+from messenger.models import (
+    MODELS, USER_CACHE, SESSION_CACHE, User, Session, Message, MessageIndex, MailboxStats,
+    get_current_timestamp
+)
+from messenger.security import hash_pw, check_pw, gen_rand_string
+from messenger.jwt import VERIFIED_CACHE, jwt_encode, jwt_decode
+
+PASSWORD = 'Bench1234'
+
+def seed(users: int, messages: int, sessions: int, rnd: random.Random) -> dict:
+    """
+    Create the tables and fill them with generated rows
+
+    :param users: number of users, the first one being an admin
+    :param messages: messages received by each user
+    :param sessions: sessions per user
+    :param rnd: random generator
+    :return: dict of the generated usernames, session and message IDs
+    """
+    for model in reversed(MODELS):
+        model.drop_table()
+    for model in MODELS:
+        model.create_table()
+
+    pw_hash = hash_pw(PASSWORD)
+    usernames = ['user{:07d}'.format(i) for i in range(users)]
+    date = get_current_timestamp()
+    session_ids, message_ids = [], []
+
+    with DB.engine.begin() as conn:
+        conn.execute(DB.text(
+            'INSERT INTO users (admin, active, firstname, lastname, username, password) '
+            'VALUES (:admin, 1, :firstname, :lastname, :username, :password)'
+        ), [{
+            'admin': i == 0, 'firstname': 'First{}'.format(i), 'lastname': 'Last{}'.format(i),
+            'username': username, 'password': pw_hash
+        } for i, username in enumerate(usernames)])
+
+        rows = []
+        for username in usernames:
+            for i in range(messages):
+                message_ids.append(gen_rand_string('me'))
+                rows.append({
+                    'id': message_ids[-1], 'sender_name': rnd.choice(usernames),
+                    'recipient_name': username, 'date': date - rnd.randrange(10 ** 7),
+                    'title': 'Title {}'.format(i), 'body': 'Body of message {}'.format(i)
+                })
+        conn.execute(DB.text(
+            'INSERT INTO messages (id, sender_name, recipient_name, date, title, body) '
+            'VALUES (:id, :sender_name, :recipient_name, :date, :title, :body)'
+        ), rows)
+
+        rows = []
+        for username in usernames:
+            for _ in range(sessions):
+                session_ids.append(gen_rand_string())
+                rows.append({
+                    'id': session_ids[-1], 'username': username, 'expiry': date,
+                    'ip': '127.0.0.1', 'user_agent': 'bench'
+                })
+        conn.execute(DB.text(
+            'INSERT INTO sessions (id, username, expiry, ip, user_agent) '
+            'VALUES (:id, :username, :expiry, :ip, :user_agent)'
+        ), rows)
+
+    MailboxStats.rebuild()
+    MessageIndex.rebuild()
+    return {'usernames': usernames, 'session_ids': session_ids, 'message_ids': message_ids}
+
+def percentile(values: list, pct: float) -> float:
+    """
+    Nearest-rank percentile of sorted values
+    """
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+def measure(fn, iterations: int, counts_queries: bool = False, setup=None) -> dict:
+    """
+    Call `fn(i)` the given number of times and summarize the latencies
+
+    :param counts_queries: `fn` returns the number of SQL queries it
+                           made, which is averaged
+    :param setup: function called before each call, outside the timing
+    :return: dict of latency statistics, in milliseconds
+    """
+    timings, queries = [], []
+    for i in range(iterations):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        count = fn(i)
+        timings.append((time.perf_counter() - start) * 1000)
+        if counts_queries and count is not None:
+            queries.append(count)
+
+    timings.sort()
+    result = {
+        'n': iterations,
+        'mean': sum(timings) / len(timings),
+        'p50': percentile(timings, 50),
+        'p95': percentile(timings, 95),
+        'p99': percentile(timings, 99),
+        'max': timings[-1],
+    }
+    if queries:
+        result['queries'] = sum(queries) / len(queries)
+    return result
+
+def best_of(repeat: int, fn, iterations: int, **kwargs) -> dict:
+    """
+    Measure `fn` several times and keep the round with the lowest median,
+    the other rounds being slowed down by unrelated activity
+
+    :param repeat: number of rounds
+    :return: statistics of the best round, see `measure`
+    """
+    rounds = [measure(fn, iterations, **kwargs) for _ in range(repeat)]
+    return min(rounds, key=lambda x: x['p50'])
+
+def clear_caches() -> None:
+    USER_CACHE.clear()
+    SESSION_CACHE.clear()
+    VERIFIED_CACHE.clear()
+
+def query_count(res) -> int:
+    """
+    Read the number of SQL queries of a response from its Server-Timing
+    header
+    """
+    for value in res.headers.getlist('Server-Timing'):
+        match = re.match(r'db;.*desc="(\d+) queries"', value)
+        if match:
+            return int(match.group(1))
+    return None
+
+def login(username: str):
+    client = APP.test_client()
+    res = client.post('/login', data={'username': username, 'password': PASSWORD})
+    if res.status_code != 302:
+        raise RuntimeError('Could not log in as {}'.format(username))
+    return client
+
+def view(client, method: str, path, data=None, status: int = 200):
+    """
+    Build a benchmark function requesting the given path, which may be
+    a function of the iteration number
+    """
+    def run(i):
+        url = path(i) if callable(path) else path
+        res = client.open(url, method=method, data=data)
+        if res.status_code != status:
+            raise RuntimeError('{} {} answered {}'.format(method, url, res.status_code))
+        return query_count(res)
+    return run
+
+def run_benchmarks(data: dict, iterations: int, pw_iterations: int, repeat: int,
+                   rnd: random.Random) -> dict:
+    """
+    Run every benchmark
+
+    :param repeat: rounds of each benchmark, the best one being kept
+    :return: mapping of benchmark names to their statistics
+    """
+    usernames, session_ids = data['usernames'], data['session_ids']
+    admin, user = usernames[0], usernames[len(usernames) // 2]
+    user_messages = [x.id for x in Message.from_recipient(user, 100)]
+    tokens = [
+        jwt_encode({'session': gen_rand_string(), 'sub': user, 'exp': get_current_timestamp()})
+        for _ in range(iterations)
+    ]
+    pw_hash = hash_pw(PASSWORD)
+
+    benchmarks = {
+        'model.User.select': lambda i: User.select(rnd.choice(usernames)),
+        'model.Session.select': lambda i: Session.select(rnd.choice(session_ids)),
+        'model.Message.from_recipient': lambda i: Message.from_recipient(rnd.choice(usernames), 50),
+        'jwt.encode': lambda i: jwt_encode({'session': 'bench', 'sub': user, 'exp': i}),
+        'jwt.decode': lambda i: jwt_decode(tokens[i]),
+    }
+    # measure the database and the signatures, not the per-process caches
+    results = {
+        name: best_of(repeat, fn, iterations, setup=clear_caches)
+        for name, fn in benchmarks.items()
+    }
+    results['security.hash_pw'] = best_of(repeat, lambda i: hash_pw(PASSWORD), pw_iterations)
+    results['security.check_pw'] = best_of(repeat, lambda i: check_pw(PASSWORD, pw_hash), pw_iterations)
+
+    user_client, admin_client = login(user), login(admin)
+    views = {
+        'view.inbox': view(user_client, 'GET', '/inbox'),
+        'view.message': view(
+            user_client, 'GET', lambda i: '/message/' + user_messages[i % len(user_messages)]
+        ),
+        'view.compose': view(
+            user_client, 'POST', '/compose',
+            data={'recipient': admin, 'title': 'Bench', 'body': 'Benchmark message'}
+        ),
+        'view.admin': view(admin_client, 'GET', '/admin'),
+    }
+    for name, fn in views.items():
+        # warm up the templates
+        fn(0)
+        results[name] = best_of(repeat, fn, iterations, counts_queries=True)
+    return results
+
+def compare(results: dict, baseline: dict, tolerance: float, min_delta: float) -> list:
+    """
+    Print the results next to the baseline and return the regressions
+
+    :param tolerance: allowed relative increase of the median
+    :param min_delta: increases of the median below this many ms are
+                      ignored, being within the timing noise
+    :return: names of the benchmarks slower than the baseline
+    """
+    regressions = []
+    print('{:<30} {:>10} {:>10} {:>10} {:>9} {:>10}'.format(
+        'benchmark', 'p50 ms', 'p95 ms', 'p99 ms', 'queries', 'vs base'
+    ))
+    for name, stats in results.items():
+        change = ''
+        base = baseline.get(name)
+        if base:
+            ratio = stats['p50'] / base['p50'] if base['p50'] else 1
+            change = '{:+.0%}'.format(ratio - 1)
+            if ratio > 1 + tolerance and stats['p50'] - base['p50'] > min_delta:
+                regressions.append(name)
+                change += ' !'
+        print('{:<30} {:>10.3f} {:>10.3f} {:>10.3f} {:>9} {:>10}'.format(
+            name, stats['p50'], stats['p95'], stats['p99'],
+            '{:.1f}'.format(stats['queries']) if 'queries' in stats else '', change
+        ))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Model and view benchmark suite')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--messages', type=int, default=20, help='messages per user')
+    parser.add_argument('--sessions', type=int, default=1, help='sessions per user')
+    parser.add_argument('--iterations', type=int, default=500)
+    parser.add_argument('--pw-iterations', type=int, default=5, help='iterations of the password hashes')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='rounds of each benchmark, the one with the lowest median is kept')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='save the results to this JSON file')
+    parser.add_argument('--baseline', help='compare with the results saved in this JSON file')
+    # two runs of the same code differ by up to 40% (about 1 ms) on the
+    # views, even with the best of 5 rounds
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help='allowed relative increase of a median before failing')
+    parser.add_argument('--min-delta', type=float, default=1.0,
+                        help='ignore increases of a median below this many ms')
+    args = parser.parse_args()
+
+    rnd = random.Random(args.seed)
+    start = time.perf_counter()
+    data = seed(args.users, args.messages, args.sessions, rnd)
+    print('Seeded {} users, {} messages and {} sessions in {:.1f}s'.format(
+        len(data['usernames']), len(data['message_ids']), len(data['session_ids']),
+        time.perf_counter() - start
+    ))
+
+    results = run_benchmarks(data, args.iterations, args.pw_iterations, args.repeat, rnd)
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+    regressions = compare(results, baseline, args.tolerance, args.min_delta)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'scale': {'users': args.users, 'messages': args.messages, 'sessions': args.sessions},
+                'iterations': args.iterations,
+                'repeat': args.repeat,
+                'seed': args.seed,
+                'python': platform.python_version(),
+                'sqlite': sqlite3.sqlite_version,
+                'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'results': results,
+            }, f, indent=2)
+
+    if regressions:
+        print('Regressions: {}'.format(', '.join(regressions)))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
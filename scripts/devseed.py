@@ -1,28 +1,217 @@
 # ---------------------------
-#Fichier : models.py
+#Fichier : devseed.py
 #Date : 14.10.2020
-#But : Supprimer et recréer les tables puis créer un admin
-#Remarque :
+#But : Supprimer et recréer les tables puis créer un admin, et
+#      optionnellement générer un grand volume de données
+#Remarque : les données générées sont reproductibles (--seed)
 #------------------------------
 
-import os, sys, inspect
-import datetime as dt
+import os, sys, inspect, argparse, itertools, random, time
 
 CWD = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
 sys.path.insert(0, os.path.dirname(CWD))
 
+from messenger import DB
 from messenger.models import *
 from messenger.security import hash_pw
 
-# clean tables
-Session.drop_table()
-Message.drop_table()
-User.drop_table()
+# password of every generated user
+USER_PASSWORD = 'Passw0rd1'
 
-# create tables
-User.create_table()
-Session.create_table()
-Message.create_table()
+WORDS = (
+    'hello meeting report budget lunch project deadline review invoice '
+    'holiday server backup release password network planning weekly '
+    'friday draft contract client support update schedule training office'
+).split()
 
-# create one admin
-User.insert(True, 'admin', 'admin', 'admin', hash_pw('admin'))
\ No newline at end of file
+def reset_tables() -> None:
+    """
+    Drop and create again every table
+    """
+    for model in reversed(MODELS):
+        model.drop_table()
+    for model in MODELS:
+        model.create_table()
+
+def create_admin(password: str = 'admin') -> None:
+    """
+    Create the `admin` account
+    """
+    User.insert(True, 'admin', 'admin', 'admin', hash_pw(password))
+
+def zipf_weights(count: int, skew: float) -> list:
+    """
+    Cumulative weights of a Zipf distribution over `count` ranks, for
+    `random.choices`: the first ranks are drawn far more often
+
+    :param skew: Zipf exponent, 0 for a uniform distribution
+    """
+    return list(itertools.accumulate(1 / (rank + 1) ** skew for rank in range(count)))
+
+def bulk_insert(table: str, columns: tuple, rows, batch_size: int) -> int:
+    """
+    Insert rows with multi-row inserts through the DBAPI, committing
+    every `batch_size` rows
+
+    On SQLite the secondary indexes of the table are dropped during the
+    load and built again afterwards, which is several times faster than
+    updating them row by row. On MySQL/MariaDB the unique and foreign key
+    checks are disabled for the connection. The settings of the
+    connection are restored before it goes back to the pool.
+
+    :param table: table name
+    :param columns: column names
+    :param rows: iterable of row tuples
+    :param batch_size: rows per transaction
+    :return: number of inserted rows
+    """
+    sqlite = DB.engine.dialect.name == 'sqlite'
+    stmt = 'INSERT INTO {} ({}) VALUES ({})'.format(
+        table, ', '.join(columns), ', '.join(['?' if sqlite else '%s'] * len(columns))
+    )
+
+    inserted = 0
+    indexes = []
+    restore = []
+    conn = DB.engine.raw_connection()
+    cursor = conn.cursor()
+    try:
+        if sqlite:
+            cursor.execute('PRAGMA synchronous')
+            restore.append('PRAGMA synchronous={}'.format(cursor.fetchone()[0]))
+            cursor.execute('PRAGMA cache_size')
+            restore.append('PRAGMA cache_size={}'.format(cursor.fetchone()[0]))
+            # throwaway data: trade durability for speed on this connection
+            cursor.execute('PRAGMA synchronous=OFF')
+            cursor.execute('PRAGMA cache_size=-262144')
+            cursor.execute(
+                "SELECT name, sql FROM sqlite_master "
+                "WHERE type='index' AND tbl_name=? AND sql IS NOT NULL", (table,)
+            )
+            indexes = cursor.fetchall()
+            for name, _ in indexes:
+                cursor.execute('DROP INDEX {}'.format(name))
+        else:
+            cursor.execute('SELECT @@SESSION.unique_checks, @@SESSION.foreign_key_checks')
+            restore.append('SET SESSION unique_checks={}, foreign_key_checks={}'.format(*cursor.fetchone()))
+            cursor.execute('SET SESSION unique_checks=0, foreign_key_checks=0')
+
+        rows = iter(rows)
+        while True:
+            batch = list(itertools.islice(rows, batch_size))
+            if not batch:
+                break
+            # PyMySQL sends executemany of an INSERT as multi-row statements
+            cursor.executemany(stmt, batch)
+            conn.commit()
+            inserted += len(batch)
+    finally:
+        for _, sql in indexes:
+            cursor.execute(sql)
+        conn.commit()
+        for sql in restore:
+            cursor.execute(sql)
+        conn.close()
+    return inserted
+
+def generate(users: int, messages: int, sessions: int, skew: float = 1.0,
+             seed: int = 1, batch_size: int = 50000, log=print) -> dict:
+    """
+    Fill the tables with generated users, messages and sessions
+
+    Recipients follow a Zipf distribution of exponent `skew`: a few users
+    receive most of the messages and the others a long tail. Every user
+    has the password `USER_PASSWORD`, hashed once. The same seed gives
+    the same rows, dates and expiries being relative to the current time.
+
+    :param users: number of users, named user0000000, user0000001...
+    :param messages: total number of messages
+    :param sessions: number of sessions, half of them expired
+    :param skew: Zipf exponent of the recipients, 0 for uniform
+    :param seed: seed of the random generator
+    :param batch_size: rows per transaction
+    :param log: function printing the progress
+    :return: number of rows inserted per table
+    """
+    rnd = random.Random(seed)
+    pw_hash = hash_pw(USER_PASSWORD)
+    now = int(time.time())
+    usernames = ['user{:07d}'.format(i) for i in range(users)]
+    counts = {}
+
+    def timed(name, fn, *args):
+        start = time.perf_counter()
+        counts[name] = fn(*args)
+        elapsed = time.perf_counter() - start
+        log('{:>12,} {:<20} {:>8.1f}s {:>10,.0f} rows/s'.format(
+            counts[name], name, elapsed, counts[name] / elapsed if elapsed else 0
+        ))
+
+    timed('users', bulk_insert, User.__tablename__,
+          ('admin', 'active', 'firstname', 'lastname', 'username', 'password'),
+          ((False, True, 'First{}'.format(i), 'Last{}'.format(i % 1000), username, pw_hash)
+           for i, username in enumerate(usernames)),
+          batch_size)
+
+    if users and messages:
+        recipients = zipf_weights(users, skew)
+        senders = zipf_weights(users, skew / 2)
+        # a pool of texts is much cheaper than drawing words per message
+        texts = []
+        for _ in range(4096):
+            words = rnd.sample(WORDS, 8)
+            texts.append((' '.join(words[:3]), ' '.join(words)))
+
+        def message_rows():
+            for start in range(0, messages, batch_size):
+                count = min(batch_size, messages - start)
+                batch = zip(
+                    rnd.choices(usernames, cum_weights=senders, k=count),
+                    rnd.choices(usernames, cum_weights=recipients, k=count),
+                    rnd.choices(texts, k=count),
+                )
+                for i, (sender, recipient, (title, body)) in enumerate(batch, start):
+                    yield (
+                        'me_{:012d}'.format(i), sender, recipient,
+                        now - rnd.randrange(365 * 24 * 3600), title, body,
+                    )
+
+        timed('messages', bulk_insert, Message.__tablename__,
+              ('id', 'sender_name', 'recipient_name', 'date', 'title', 'body'),
+              message_rows(), batch_size)
+
+    if users and sessions:
+        timed('sessions', bulk_insert, Session.__tablename__,
+              ('id', 'username', 'expiry', 'ip', 'user_agent'),
+              (('se_{:012d}'.format(i), usernames[rnd.randrange(users)],
+                now + rnd.randrange(-3600, 3600), '127.0.0.1', 'devseed')
+               for i in range(sessions)),
+              batch_size)
+
+    # derived tables, computed with set-based statements
+    timed('mailbox summaries', MailboxStats.rebuild)
+    timed('search index', MessageIndex.rebuild)
+    return counts
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Reset the database and create the admin account, '
+                    'optionally generating a large data set'
+    )
+    parser.add_argument('--users', type=int, default=0, help='number of generated users')
+    parser.add_argument('--messages', type=int, default=0, help='total number of generated messages')
+    parser.add_argument('--sessions', type=int, default=0, help='number of generated sessions')
+    parser.add_argument('--skew', type=float, default=1.0,
+                        help='Zipf exponent of the message recipients, 0 for uniform')
+    parser.add_argument('--seed', type=int, default=1, help='seed of the random generator')
+    parser.add_argument('--batch-size', type=int, default=50000, help='rows per transaction')
+    args = parser.parse_args()
+
+    reset_tables()
+    create_admin()
+
+    if args.users:
+        generate(args.users, args.messages, args.sessions, args.skew, args.seed, args.batch_size)
+
+if __name__ == '__main__':
+    main()
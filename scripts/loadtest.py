@@ -0,0 +1,305 @@
+# ---------------------------
+#Fichier : loadtest.py
+#Date : 14.10.2020
+#But : test de charge HTTP rejouant des parcours d'utilisateurs
+#      (connexion, boîte de réception, lecture, réponse, envoi,
+#      déconnexion) avec une concurrence croissante
+#Remarque : s'utilise contre un serveur lancé à part, sur une base
+#           remplie avec scripts/devseed.py --users N --messages M
+#------------------------------
+
+import argparse, http.client, json, random, re, sys, threading, time
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+MESSAGE_LINK = re.compile(r'href="/message/([^"/]+)"')
+
+# steps of each journey, see `Client.run`
+JOURNEYS = {
+    'read': ('login', 'inbox', 'message', 'logout'),
+    'reply': ('login', 'inbox', 'message', 'reply', 'send', 'logout'),
+    'compose': ('login', 'inbox', 'compose', 'send', 'logout'),
+    'browse': ('login', 'inbox', 'inbox', 'inbox', 'logout'),
+}
+
+class StepError(Exception):
+    """
+    Unexpected answer to a request
+    """
+
+class Client(object):
+    """
+    Virtual user with its own keep-alive connection and cookies
+    """
+
+    def __init__(self, host: str, port: int, timeout: float, args, rnd: random.Random, samples: list):
+        """
+        :param args: command line options
+        :param rnd: random generator of this client
+        :param samples: list receiving (route, ms, ok) tuples
+        """
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.args = args
+        self.rnd = rnd
+        self.samples = samples
+        self.conn = None
+        self.cookies = {}
+
+    def request(self, route: str, method: str, path: str, data: dict = None, expect=(200,)):
+        """
+        Send a request, record its latency under `route` and return the
+        response and its body
+
+        :param route: label of the measured route
+        :param expect: accepted status codes
+        """
+        headers = {'User-Agent': 'loadtest'}
+        if self.cookies:
+            headers['Cookie'] = '; '.join('{}={}'.format(k, v) for k, v in self.cookies.items())
+        body = None
+        if data is not None:
+            body = urlencode(data)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+
+        start = time.perf_counter()
+        try:
+            for attempt in (0, 1):
+                if self.conn is None:
+                    self.conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+                try:
+                    self.conn.request(method, path, body, headers)
+                    res = self.conn.getresponse()
+                    content = res.read()
+                    break
+                except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+                    # keep-alive connection closed by the server, retry once
+                    self.conn.close()
+                    self.conn = None
+                    if attempt:
+                        raise
+        except (OSError, http.client.HTTPException) as e:
+            if self.conn:
+                self.conn.close()
+                self.conn = None
+            self.samples.append((route, (time.perf_counter() - start) * 1000, False))
+            raise StepError('{} {}: {}'.format(method, path, e))
+
+        ok = res.status in expect
+        self.samples.append((route, (time.perf_counter() - start) * 1000, ok))
+        if res.getheader('Connection', '').lower() == 'close' or res.version == 10:
+            self.conn.close()
+            self.conn = None
+        for header, value in res.getheaders():
+            if header.lower() == 'set-cookie':
+                name, _, rest = value.partition('=')
+                value = rest.split(';', 1)[0]
+                if value:
+                    self.cookies[name] = value
+                else:
+                    self.cookies.pop(name, None)
+        if not ok:
+            raise StepError('{} {} answered {}'.format(method, path, res.status))
+        return res, content.decode(errors='replace')
+
+    def username(self) -> str:
+        return self.args.user_format.format(self.rnd.randrange(self.args.users))
+
+    def run(self, journey: str) -> None:
+        """
+        Play the steps of a journey, stopping at the first failure
+        """
+        self.cookies = {}
+        message_ids, compose_form = [], None
+
+        for step in JOURNEYS[journey]:
+            if self.args.think:
+                time.sleep(self.rnd.uniform(0, 2 * self.args.think))
+
+            if step == 'login':
+                self.request('POST /login', 'POST', '/login', {
+                    'username': self.username(), 'password': self.args.password
+                }, expect=(302,))
+                if 'auth' not in self.cookies:
+                    raise StepError('log in failed')
+            elif step == 'inbox':
+                _, page = self.request('GET /inbox', 'GET', '/inbox')
+                message_ids = MESSAGE_LINK.findall(page)
+            elif step == 'message':
+                if not message_ids:
+                    continue
+                message_id = self.rnd.choice(message_ids)
+                self.request('GET /message/<id>', 'GET', '/message/' + message_id)
+            elif step == 'reply':
+                if not message_ids:
+                    continue
+                # the reply link redirects to the prefilled compose form
+                res, _ = self.request(
+                    'GET /message/<id>/reply', 'GET', '/message/{}/reply'.format(message_id), expect=(302,)
+                )
+                location = urlsplit(res.getheader('Location', ''))
+                query = parse_qs(location.query)
+                compose_form = {
+                    'recipient': query.get('recipient', [self.username()])[0],
+                    'title': query.get('title', ['Re:'])[0],
+                }
+                self.request('GET /compose', 'GET', '{}?{}'.format(location.path, location.query))
+            elif step == 'compose':
+                compose_form = {'recipient': self.username(), 'title': 'Load test'}
+                self.request('GET /compose', 'GET', '/compose')
+            elif step == 'send':
+                if compose_form is None:
+                    continue
+                self.request('POST /compose', 'POST', '/compose', {
+                    'recipient': compose_form['recipient'],
+                    'title': compose_form['title'],
+                    'body': 'Message sent by scripts/loadtest.py',
+                })
+            elif step == 'logout':
+                self.request('GET /logout', 'GET', '/logout', expect=(302,))
+
+    def close(self) -> None:
+        if self.conn:
+            self.conn.close()
+
+def percentile(values: list, pct: float) -> float:
+    """
+    Nearest-rank percentile of sorted values
+    """
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+def parse_mix(text: str) -> dict:
+    """
+    Parse journey weights such as `read=5,reply=2`
+    """
+    mix = {}
+    for item in text.split(','):
+        name, _, weight = item.partition('=')
+        if name not in JOURNEYS:
+            raise argparse.ArgumentTypeError('unknown journey {!r}, expected one of {}'.format(
+                name, ', '.join(JOURNEYS)
+            ))
+        mix[name] = float(weight or 1)
+    return mix
+
+def run_stage(concurrency: int, duration: float, args, seed: int) -> dict:
+    """
+    Run `concurrency` virtual users playing random journeys for
+    `duration` seconds
+
+    :return: statistics of the stage
+    """
+    url = urlsplit(args.url)
+    deadline = time.monotonic() + duration
+    names, weights = list(args.mix), list(args.mix.values())
+    samples, journeys, failures = [], [], []
+
+    def worker(i):
+        rnd = random.Random(seed * 100003 + i)
+        client = Client(url.hostname, url.port or 80, args.timeout, args, rnd, samples)
+        try:
+            while time.monotonic() < deadline:
+                journey = rnd.choices(names, weights)[0]
+                try:
+                    client.run(journey)
+                    journeys.append(journey)
+                except StepError as e:
+                    failures.append(str(e))
+        finally:
+            client.close()
+
+    threads = [threading.Thread(target=worker, args=(i,), daemon=True) for i in range(concurrency)]
+    start = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - start
+
+    routes = {}
+    for route, ms, ok in samples:
+        routes.setdefault(route, ([], [0]))
+        routes[route][0].append(ms)
+        if not ok:
+            routes[route][1][0] += 1
+
+    stats = {}
+    for route, (timings, errors) in sorted(routes.items()):
+        timings.sort()
+        stats[route] = {
+            'n': len(timings),
+            'rps': len(timings) / elapsed,
+            'p50': percentile(timings, 50),
+            'p95': percentile(timings, 95),
+            'p99': percentile(timings, 99),
+            'errors': errors[0] / len(timings),
+        }
+    return {
+        'concurrency': concurrency,
+        'seconds': elapsed,
+        'requests': len(samples),
+        'rps': len(samples) / elapsed,
+        'journeys': len(journeys),
+        'failed_journeys': len(failures),
+        'errors': sum(not ok for _, _, ok in samples) / len(samples) if samples else 0,
+        'failures': sorted(set(failures))[:10],
+        'routes': stats,
+    }
+
+def report(stage: dict) -> None:
+    print('\nconcurrency {concurrency}: {rps:,.1f} req/s, {journeys:,} journeys, '
+          '{failed_journeys:,} failed, {errors:.2%} errors'.format(**stage))
+    print('{:<26} {:>8} {:>8} {:>9} {:>9} {:>9} {:>8}'.format(
+        'route', 'n', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'errors'
+    ))
+    for route, stats in stage['routes'].items():
+        print('{:<26} {:>8} {:>8.1f} {:>9.1f} {:>9.1f} {:>9.1f} {:>8.2%}'.format(
+            route, stats['n'], stats['rps'], stats['p50'], stats['p95'], stats['p99'], stats['errors']
+        ))
+    for failure in stage['failures']:
+        print('  ' + failure)
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='HTTP load test replaying weighted user journeys against a running server'
+    )
+    parser.add_argument('--url', default='http://127.0.0.1:5000', help='base URL of the server')
+    parser.add_argument('--users', type=int, default=1000,
+                        help='number of seeded users to log in as, see scripts/devseed.py')
+    parser.add_argument('--user-format', default='user{:07d}', help='username of the n-th seeded user')
+    parser.add_argument('--password', default='Passw0rd1', help='password of the seeded users')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix('read=5,reply=2,compose=1,browse=2'),
+                        help='weights of the journeys ({})'.format(', '.join(JOURNEYS)))
+    parser.add_argument('--ramp', default='1,2,4,8',
+                        help='comma-separated concurrency of the successive stages')
+    parser.add_argument('--duration', type=float, default=30, help='seconds per stage')
+    parser.add_argument('--think', type=float, default=0, help='mean pause between steps, in seconds')
+    parser.add_argument('--timeout', type=float, default=30, help='request timeout, in seconds')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='save the results to this JSON file')
+    parser.add_argument('--max-errors', type=float, default=0.01,
+                        help='fail when a stage has a higher error rate')
+    args = parser.parse_args()
+
+    stages = []
+    for i, concurrency in enumerate(int(x) for x in args.ramp.split(',')):
+        stages.append(run_stage(concurrency, args.duration, args, args.seed + i))
+        report(stages[-1])
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'url': args.url,
+                'mix': args.mix,
+                'duration': args.duration,
+                'think': args.think,
+                'seed': args.seed,
+                'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'stages': stages,
+            }, f, indent=2)
+
+    if any(stage['errors'] > args.max_errors for stage in stages):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -14,6 +14,12 @@ setup(
     extras_require={
         'staging': [
             'uwsgi',
+        ],
+        'streaming': [
+            'gevent',
+        ],
+        'test': [
+            'pytest',
         ]
     }
 )
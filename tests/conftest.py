@@ -0,0 +1,75 @@
+# ---------------------------
+#Fichier : conftest.py
+#Date : 14.10.2020
+#But : configuration des tests, base SQLite temporaire
+#Remarque : les tables sont recréées avant chaque test
+#------------------------------
+
+import os, sys, inspect, tempfile
+
+import pytest
+
+CWD = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+sys.path.insert(0, os.path.dirname(CWD))
+
+# must be set before the application is imported
+DB_FILE = os.path.join(tempfile.mkdtemp(), 'tests.sqlite')
+os.environ['STI_MSN_DB'] = 'sqlite:///' + DB_FILE
+os.environ['STI_MSN_CONFIG'] = 'development'
+os.environ['STI_MSN_SECRET_KEY'] = 'test-secret'
+os.environ['STI_MSN_OUTBOX_WORKER'] = '0'
+os.environ.pop('STI_MSN_SECRET_KEYS', None)
+os.environ.pop('STI_MSN_SECRET_KEYS_FILE', None)
+
+from messenger import APP
+from messenger.models import MODELS, User, Revocation, USER_CACHE, SESSION_CACHE
+from messenger.security import hash_pw
+from messenger.views import limiter
+
+PASSWORD = 'Passw0rd1'
+# hashed once, scrypt being slow on purpose
+PW_HASH = hash_pw(PASSWORD)
+
+@pytest.fixture(autouse=True)
+def database():
+    """
+    Start every test with empty tables and caches
+    """
+    for model in reversed(MODELS):
+        model.drop_table()
+    for model in MODELS:
+        model.create_table()
+    USER_CACHE.clear()
+    SESSION_CACHE.clear()
+    Revocation._ids = frozenset()
+    Revocation._loaded_at = None
+    limiter.enabled = False
+    yield
+    limiter.enabled = APP.config['RATELIMIT_ENABLED']
+
+@pytest.fixture
+def client():
+    return APP.test_client()
+
+def create_user(username: str, admin: bool = False) -> None:
+    User.insert(admin, username.capitalize(), 'Test', username, PW_HASH)
+
+def login(client, username: str) -> str:
+    """
+    Log the given user in and consume the flashed message
+
+    :return: JWT of the `auth` cookie
+    """
+    res = client.post('/login', data={'username': username, 'password': PASSWORD})
+    assert res.status_code == 302
+    client.get('/inbox')
+    for header in res.headers.getlist('Set-Cookie'):
+        if header.startswith('auth='):
+            return header.split(';', 1)[0][len('auth='):]
+    raise AssertionError('no auth cookie')
+
+def replay(token: str, path: str):
+    """
+    Request a page with the given JWT, from a new client
+    """
+    return APP.test_client().get(path, headers={'Cookie': 'auth=' + token})
@@ -0,0 +1,101 @@
+# ---------------------------
+#Fichier : test_auth.py
+#Date : 14.10.2020
+#But : tests des sessions, de la déconnexion et des révocations
+#Remarque :
+#------------------------------
+
+import time
+
+from messenger import APP, DB
+from messenger.models import User, Session, Revocation, USER_CACHE, SESSION_CACHE
+
+from conftest import create_user, login, replay, PASSWORD
+
+def test_login_creates_session(client):
+    create_user('alice')
+    login(client, 'alice')
+
+    assert len(Session.from_user('alice')) == 1
+    assert client.get('/inbox').status_code == 200
+
+def test_bad_password_is_refused(client):
+    create_user('alice')
+    res = client.post('/login', data={'username': 'alice', 'password': 'nope'})
+
+    assert res.status_code == 200
+    assert Session.from_user('alice') == []
+
+def test_logout_deletes_session(client):
+    create_user('alice')
+    token = login(client, 'alice')
+
+    assert client.get('/logout').status_code == 302
+    assert Session.from_user('alice') == []
+
+    # replaying the old token does not log in again
+    res = replay(token, '/inbox')
+    assert res.status_code == 302
+    assert res.headers['Location'].endswith('/login')
+
+def test_logout_records_no_revocation(client):
+    create_user('alice')
+    login(client, 'alice')
+
+    client.get('/logout')
+    assert DB.engine.execute('SELECT COUNT(*) FROM revocations').scalar() == 0
+
+def test_stateless_logout_revokes_token(client, monkeypatch):
+    monkeypatch.setitem(APP.config, 'AUTH_STATELESS', True)
+    create_user('alice')
+    token = login(client, 'alice')
+    session_id = Session.from_user('alice')[0].id
+
+    client.get('/logout')
+    assert Revocation.is_revoked(session_id)
+    assert replay(token, '/inbox').status_code == 302
+
+def test_deactivated_user_loses_access(client):
+    create_user('admin', admin=True)
+    create_user('alice')
+    login(client, 'alice')
+
+    other = APP.test_client()
+    login(other, 'admin')
+    res = other.post('/user/alice', data={'username': 'alice'})
+    assert res.status_code == 302
+
+    assert client.get('/inbox').status_code == 302
+
+def test_changes_from_other_processes_expire(client, monkeypatch):
+    assert APP.config['AUTH_CACHE_TTL'] <= 5
+    for cache in (USER_CACHE, SESSION_CACHE):
+        monkeypatch.setattr(cache, 'ttl', 0.05)
+    create_user('admin', admin=True)
+    login(client, 'admin')
+    assert client.get('/admin').status_code == 200
+
+    # changed by another process, whose invalidation stays there
+    DB.engine.execute("UPDATE users SET admin=0 WHERE username='admin'")
+    time.sleep(0.1)
+    assert client.get('/admin').status_code == 302
+
+    DB.engine.execute("DELETE FROM sessions WHERE username='admin'")
+    time.sleep(0.1)
+    res = client.get('/inbox')
+    assert res.status_code == 302
+    assert res.headers['Location'].endswith('/login')
+
+def test_reserved_usernames_are_refused(client):
+    create_user('admin', admin=True)
+    form = {'firstname': 'A', 'lastname': 'B', 'password': PASSWORD, 'password_confirm': PASSWORD}
+    for username in ('@all', 'bob,carol', 'bob carol'):
+        client.post('/signup', data=dict(form, username=username))
+        assert not User.find(username)
+
+    login(client, 'admin')
+    client.post('/userAdd', data=dict(form, username='@all'))
+    assert not User.find('@all')
+
+    client.post('/userAdd', data=dict(form, username='bob'))
+    assert User.find('bob')
@@ -0,0 +1,64 @@
+# ---------------------------
+#Fichier : test_cli.py
+#Date : 14.10.2020
+#But : tests des commandes de maintenance
+#Remarque :
+#------------------------------
+
+import pytest
+from sqlalchemy import inspect
+
+from messenger import APP, DB
+from messenger.cli import init_db
+from messenger.models import MODELS, Message, MessageIndex, MailboxStats, User
+
+from conftest import create_user
+
+def test_init_db_upgrades_old_database():
+    for name in ('alice', 'bob'):
+        create_user(name)
+    Message.insert('alice', 'bob', 100, 'Budget', 'Body')
+    # tables and indexes added after the first version
+    for model in MODELS:
+        if model not in (User, Message):
+            model.drop_table()
+    DB.engine.execute('DROP INDEX idx_messages_recipient_date')
+
+    result = APP.test_cli_runner().invoke(init_db)
+    assert result.exit_code == 0, result.output
+
+    tables = set(inspect(DB.engine).get_table_names())
+    assert {'sessions', 'mailbox_stats', 'rate_limits', 'revocations', 'outbox', 'outbox_recipients', 'notifications'} <= tables
+    indexes = {x['name'] for x in inspect(DB.engine).get_indexes('messages')}
+    assert 'idx_messages_recipient_date' in indexes
+    indexes = {x['name'] for x in inspect(DB.engine).get_indexes('mailbox_stats')}
+    assert {'idx_mailbox_stats_count', 'idx_mailbox_stats_newest'} <= indexes
+    assert MailboxStats.select('bob').count == 1
+    assert [x.title for x in MessageIndex.search('bob', 'budget', 10)] == ['Budget']
+
+def test_init_db_is_idempotent():
+    create_user('alice')
+
+    for _ in range(2):
+        result = APP.test_cli_runner().invoke(init_db)
+        assert result.exit_code == 0, result.output
+    assert User.find('alice')
+
+@pytest.mark.parametrize('columns', [
+    # keyed by the rowid of the messages
+    'recipient_name, title, body',
+    # storing the message ID in an unindexed column
+    'id UNINDEXED, recipient_name, title, body',
+])
+def test_init_db_upgrades_search_index(columns):
+    for name in ('alice', 'bob'):
+        create_user(name)
+    Message.insert('alice', 'bob', 100, 'Budget', 'Body')
+    MessageIndex.drop_table()
+    DB.engine.execute('CREATE VIRTUAL TABLE messages_fts USING fts5({})'.format(columns))
+    assert MessageIndex.outdated()
+
+    result = APP.test_cli_runner().invoke(init_db)
+    assert result.exit_code == 0, result.output
+    assert not MessageIndex.outdated()
+    assert [x.title for x in MessageIndex.search('bob', 'budget', 10)] == ['Budget']
@@ -0,0 +1,46 @@
+# ---------------------------
+#Fichier : test_config.py
+#Date : 14.10.2020
+#But : tests des profils de configuration
+#Remarque : chaque profil est chargé dans un nouveau processus
+#------------------------------
+
+import os, subprocess, sys
+
+from messenger.config import KEY_VARIABLES
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def start(config: str, **env):
+    """
+    Import the application in a new process with the given profile
+    """
+    env = dict(
+        {k: v for k, v in os.environ.items() if k not in KEY_VARIABLES + ('STI_MSN_METRICS_TOKEN',)},
+        STI_MSN_CONFIG=config, STI_MSN_OUTBOX_WORKER='0', **env
+    )
+    return subprocess.run(
+        [sys.executable, '-c', 'import messenger'],
+        cwd=ROOT, env=env, capture_output=True, text=True
+    )
+
+def test_production_requires_a_key():
+    res = start('production', STI_MSN_METRICS_TOKEN='token')
+    assert res.returncode != 0
+    assert 'No signing key configured' in res.stderr
+
+    assert start('production', STI_MSN_SECRET_KEY='shared', STI_MSN_METRICS_TOKEN='token').returncode == 0
+    # as passed by docker-compose when the variable is unset
+    assert start('production', STI_MSN_SECRET_KEY='', STI_MSN_METRICS_TOKEN='token').returncode != 0
+
+def test_production_requires_a_metrics_token():
+    res = start('production', STI_MSN_SECRET_KEY='shared')
+    assert res.returncode != 0
+    assert 'No metrics token configured' in res.stderr
+
+    assert start('production', STI_MSN_SECRET_KEY='shared', STI_MSN_METRICS_TOKEN='').returncode != 0
+
+def test_development_warns_about_random_key():
+    res = start('development')
+    assert res.returncode == 0
+    assert 'No signing key configured' in res.stderr
@@ -0,0 +1,33 @@
+# ---------------------------
+#Fichier : test_inbox.py
+#Date : 14.10.2020
+#But : tests de la lecture paresseuse et paginée des messages reçus
+#Remarque :
+#------------------------------
+
+from messenger.models import Message, User
+
+from conftest import create_user
+
+def test_messages_are_read_on_access():
+    for name in ('alice', 'bob'):
+        create_user(name)
+    bob = User.select('bob')
+    assert bob.messages == []
+
+    # not loaded with the user, so later messages are seen
+    Message.insert('alice', 'bob', 100, 'Title', 'Body')
+    assert [x.title for x in bob.messages] == ['Title']
+
+def test_inbox_pages_newest_first():
+    for name in ('alice', 'bob'):
+        create_user(name)
+    for date in range(5):
+        Message.insert('alice', 'bob', date, 'Title {}'.format(date), 'Body')
+    bob = User.select('bob')
+
+    page = bob.inbox(2)
+    assert [x.title for x in page] == ['Title 4', 'Title 3']
+    last = page[-1]
+    page = bob.inbox(2, (last.timestamp, last.id))
+    assert [x.title for x in page] == ['Title 2', 'Title 1']
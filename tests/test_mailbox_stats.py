@@ -0,0 +1,104 @@
+# ---------------------------
+#Fichier : test_mailbox_stats.py
+#Date : 14.10.2020
+#But : tests des résumés de boîte de réception (mailbox_stats)
+#Remarque :
+#------------------------------
+
+from messenger import DB
+from messenger.models import Message, MailboxStats, User
+
+from conftest import create_user, login
+
+def snapshot() -> dict:
+    return {
+        row.username: (row.count, row.newest_date, row.newest_id)
+        for row in DB.engine.execute('SELECT * FROM mailbox_stats')
+    }
+
+def test_new_user_has_empty_inbox():
+    create_user('alice')
+    stats = MailboxStats.select('alice')
+
+    assert (stats.count, stats.newest_id, stats.version) == (0, None, 0)
+
+def test_insert_and_delete_keep_counts():
+    for name in ('alice', 'bob', 'carol'):
+        create_user(name)
+    Message.insert_many('alice', ['bob', 'carol'], 100, 'First', 'Body')
+    Message.insert('alice', 'bob', 200, 'Second', 'Body')
+
+    newest = Message.from_recipient('bob', 1)[0]
+    stats = MailboxStats.select('bob')
+    assert (stats.count, stats.newest_date, stats.newest_id) == (2, 200, newest.id)
+    assert MailboxStats.select('carol').count == 1
+
+    # deleting the newest message moves the summary to the previous one
+    version = stats.version
+    Message.delete(newest.id)
+    stats = MailboxStats.select('bob')
+    assert (stats.count, stats.newest_date) == (1, 100)
+    assert stats.version > version
+
+def test_delete_for_recipient_resets():
+    for name in ('alice', 'bob'):
+        create_user(name)
+    Message.insert_many('alice', ['bob'] * 3, 100, 'Title', 'Body')
+
+    Message.delete_for_recipient('bob')
+    stats = MailboxStats.select('bob')
+    assert (stats.count, stats.newest_date, stats.newest_id) == (0, None, None)
+
+def test_user_delete_removes_summary():
+    for name in ('alice', 'bob'):
+        create_user(name)
+    Message.insert('alice', 'bob', 100, 'Title', 'Body')
+
+    User.delete('bob')
+    assert 'bob' not in snapshot()
+
+def test_rebuild_matches_incremental_updates():
+    for name in ('alice', 'bob', 'carol'):
+        create_user(name)
+    for date in range(10):
+        Message.insert_many('alice', ['bob', 'carol'], date, 'Title', 'Body')
+    Message.delete(Message.from_recipient('carol', 1)[0].id)
+
+    incremental = snapshot()
+    MailboxStats.rebuild()
+    assert snapshot() == incremental
+
+def test_missing_summary_is_rebuilt():
+    for name in ('alice', 'bob'):
+        create_user(name)
+    Message.insert('alice', 'bob', 100, 'Title', 'Body')
+    DB.engine.execute('DELETE FROM mailbox_stats')
+
+    assert MailboxStats.select('bob').count == 1
+
+def test_missing_user_has_empty_summary():
+    assert MailboxStats.select('ghost').count == 0
+
+def test_user_deleted_during_rebuild(client, monkeypatch):
+    for name in ('alice', 'bob'):
+        create_user(name)
+    login(client, 'bob')
+    DB.engine.execute('DELETE FROM mailbox_stats')
+
+    # bob disappears between the rebuild and the second read
+    monkeypatch.setattr(MailboxStats, 'rebuild', lambda username=None: None)
+    res = client.get('/inbox/status')
+    assert res.status_code == 200
+    assert res.get_json()['count'] == 0
+
+def test_listing_orders_by_summary():
+    for name in ('alice', 'bob', 'carol'):
+        create_user(name)
+    Message.insert_many('alice', ['bob', 'bob', 'carol'], 100, 'Title', 'Body')
+    Message.insert('alice', 'carol', 50, 'Title', 'Body')
+    Message.insert('bob', 'alice', 200, 'Title', 'Body')
+
+    names = lambda **kwargs: [x['username'] for x in User.listing(**kwargs)]
+    assert names(order='messages', descending=True) == ['carol', 'bob', 'alice']
+    assert names(order='last') == ['bob', 'carol', 'alice']
+    assert names(order='messages', username='bo') == ['bob']
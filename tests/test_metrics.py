@@ -0,0 +1,19 @@
+# ---------------------------
+#Fichier : test_metrics.py
+#Date : 14.10.2020
+#But : tests des métriques (/metrics)
+#Remarque :
+#------------------------------
+
+from messenger import cache
+
+from conftest import create_user, login
+
+def test_cache_counters_are_exported(client):
+    create_user('alice')
+    login(client, 'alice')
+    client.get('/inbox')
+
+    text = client.get('/metrics').get_data(as_text=True)
+    for name, stats in cache.stats().items():
+        assert 'messenger_cache_misses_total{{cache="{}"}} {}'.format(name, stats['misses']) in text
@@ -0,0 +1,91 @@
+# ---------------------------
+#Fichier : test_notify.py
+#Date : 14.10.2020
+#But : tests des notifications de nouveaux messages
+#Remarque :
+#------------------------------
+
+from messenger import APP, DB
+from messenger.models import Message, Session
+from messenger.notify import Notifier
+
+from conftest import create_user, login
+
+def test_inbox_polls_when_streaming_is_disabled(client):
+    for name in ('alice', 'bob'):
+        create_user(name)
+    login(client, 'bob')
+
+    page = client.get('/inbox').get_data(as_text=True)
+    assert '/inbox/status' in page
+    assert 'EventSource' not in page
+    assert client.get('/inbox/stream').status_code == 404
+
+    before = client.get('/inbox/status').get_json()
+    Message.insert('alice', 'bob', 100, 'Hello', 'Body')
+    after = client.get('/inbox/status').get_json()
+    assert after['count'] == before['count'] + 1
+    assert after['version'] != before['version']
+
+def test_inbox_streams_when_enabled(client, monkeypatch):
+    monkeypatch.setitem(APP.config, 'SSE_ENABLED', True)
+    create_user('bob')
+    login(client, 'bob')
+
+    assert 'EventSource' in client.get('/inbox').get_data(as_text=True)
+
+def test_logged_out_subscriptions_are_closed():
+    create_user('bob')
+    for session_id in ('s1', 's2'):
+        Session.insert(session_id, 'bob', 2 ** 31 - 1, '127.0.0.1', 'pytest')
+    notifier = Notifier(10, 3600, 3600)
+    kept, ended = notifier.subscribe('bob', 's1'), notifier.subscribe('bob', 's2')
+
+    Session.delete('s2')
+    notifier.check_sessions()
+    assert not kept.closed
+    assert ended.closed
+    # the stream is woken up
+    assert ended.get_nowait() is None
+
+class Recorder(Notifier):
+    """
+    Notifier keeping the published events instead of queueing them
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(10, 3600, 3600, **kwargs)
+        self.events = []
+
+    def publish(self, username, event):
+        self.events.append(event['id'])
+
+def notify(id):
+    DB.engine.execute(DB.text(
+        "INSERT INTO notifications (id, recipient_name, message_id, sender_name, title, expiry) "
+        "VALUES (:id, 'bob', :message_id, 'alice', 'Title', 0)"
+    ).bindparams(id=id, message_id='m{}'.format(id)))
+
+def test_late_commits_are_dispatched():
+    notifier = Recorder()
+    notifier.poll()
+
+    # the transaction holding the second ID commits after the third
+    notify(1)
+    notify(3)
+    notifier.poll()
+    notify(2)
+    notifier.poll()
+    notifier.poll()
+    assert notifier.events == ['m1', 'm3', 'm2']
+
+def test_skipped_ids_are_given_up():
+    notifier = Recorder(gap_grace=0)
+    notifier.poll()
+
+    notify(2)
+    notifier.poll()
+    notify(1)
+    notifier.poll()
+    assert notifier.events == ['m2']
+    assert notifier._gaps == {}
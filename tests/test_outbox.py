@@ -0,0 +1,152 @@
+# ---------------------------
+#Fichier : test_outbox.py
+#Date : 14.10.2020
+#But : tests de la file d'envoi (baux, lots, échecs)
+#Remarque :
+#------------------------------
+
+import time
+
+import pytest
+
+from messenger import DB, outbox
+from messenger.models import User, Delivery, DeliveryRecipient, Message, LeaseLost
+
+from conftest import create_user
+
+def queue(recipients, sender='alice'):
+    return Delivery.insert(sender, recipients, int(time.time()), 'Title', 'Body')
+
+def test_claim_is_exclusive():
+    for name in ('alice', 'bob'):
+        create_user(name)
+    delivery_id = queue(['bob'])
+
+    assert Delivery.claim('worker1', 60).id == delivery_id
+    assert Delivery.claim('worker2', 60) is None
+    assert Delivery.claim('worker2', 60, delivery_id) is None
+
+def test_expired_lease_can_be_claimed_again():
+    for name in ('alice', 'bob'):
+        create_user(name)
+    delivery_id = queue(['bob'])
+
+    Delivery.claim('worker1', 0)
+    assert Delivery.claim('worker2', 60).owner == 'worker2'
+
+    # the first worker lost the delivery, its chunk is rolled back
+    stale = Delivery.select(delivery_id)
+    stale.owner = 'worker1'
+    with pytest.raises(LeaseLost):
+        stale.deliver_chunk(10, 60)
+    assert Message.from_recipient('bob') == []
+
+def test_delivery_in_chunks():
+    create_user('alice')
+    recipients = ['user{}'.format(i) for i in range(5)]
+    for name in recipients:
+        create_user(name)
+    delivery = Delivery.claim('worker', 60, queue(recipients))
+
+    assert not delivery.deliver_chunk(2, 60)
+    assert Delivery.select(delivery.id).last_recipient == 'user1'
+    assert not delivery.deliver_chunk(2, 60)
+    assert delivery.deliver_chunk(2, 60)
+
+    done = Delivery.select(delivery.id)
+    assert (done.status, done.delivered, done.owner) == (Delivery.DONE, 5, None)
+    assert all(len(Message.from_recipient(x)) == 1 for x in recipients)
+
+def test_delivery_to_all_users():
+    for name in ('alice', 'bob', 'carol'):
+        create_user(name)
+    delivery = Delivery.claim('worker', 60, queue(Delivery.ALL_USERS))
+
+    assert outbox.process(delivery)
+    assert Delivery.select(delivery.id).total == 3
+
+def test_fail_backs_off_then_gives_up():
+    for name in ('alice', 'bob'):
+        create_user(name)
+    delivery_id = queue(['bob'])
+
+    before = int(time.time())
+    delivery = Delivery.claim('worker', 60)
+    delivery.fail('boom', max_attempts=3, backoff=10)
+    failed = Delivery.select(delivery_id)
+    assert (failed.status, failed.attempts, failed.owner) == (Delivery.PENDING, 1, None)
+    assert failed.next_attempt >= before + 10
+    # not due before its next attempt
+    assert Delivery.claim('worker', 60) is None
+
+    delivery = Delivery.claim('worker', 60, delivery_id)
+    delivery.fail('boom', max_attempts=3, backoff=10)
+    assert Delivery.select(delivery_id).next_attempt >= before + 20
+
+    delivery = Delivery.claim('worker', 60, delivery_id)
+    delivery.fail('boom', max_attempts=3, backoff=10)
+    failed = Delivery.select(delivery_id)
+    assert (failed.status, failed.attempts, failed.error) == (Delivery.FAILED, 3, 'boom')
+
+def test_recipients_are_stored_per_row():
+    create_user('alice')
+    recipients = ['user{:04d}'.format(i) for i in range(300)]
+    for name in recipients:
+        create_user(name)
+    delivery_id = queue(reversed(recipients))
+
+    delivery = Delivery.select(delivery_id)
+    assert (delivery.target, delivery.total) == (Delivery.RECIPIENT_LIST, 300)
+    assert DeliveryRecipient.usernames(delivery_id) == recipients
+
+    delivery = Delivery.claim('worker', 60, delivery_id)
+    assert outbox.process(delivery)
+    assert Delivery.select(delivery_id).delivered == 300
+    assert len(Message.from_recipient('user0299')) == 1
+
+def test_purge_deletes_recipients():
+    for name in ('alice', 'bob'):
+        create_user(name)
+    delivery = Delivery.claim('worker', 60, queue(['bob']))
+    assert outbox.process(delivery)
+
+    DB.engine.execute('UPDATE outbox SET expiry=0')
+    assert Delivery.purge_expired() == 1
+    assert DeliveryRecipient.usernames(delivery.id) == []
+
+def test_delivery_queued_by_older_version():
+    for name in ('alice', 'bob', 'carol'):
+        create_user(name)
+    delivery_id = queue(['bob'])
+    DB.engine.execute("UPDATE outbox SET target='bob,carol', total=2")
+
+    assert outbox.process(Delivery.claim('worker', 60, delivery_id))
+    assert len(Message.from_recipient('carol')) == 1
+
+def test_deleted_recipient_is_skipped():
+    for name in ('alice', 'bob', 'carol', 'dave'):
+        create_user(name)
+    delivery_id = queue(['bob', 'carol', 'dave'])
+
+    User.delete('carol')
+    delivery = Delivery.claim('worker', 60, delivery_id)
+    assert not delivery.deliver_chunk(2, 60)
+    assert delivery.deliver_chunk(2, 60)
+
+    done = Delivery.select(delivery_id)
+    assert (done.status, done.total, done.delivered, done.skipped) == (Delivery.DONE, 3, 2, 1)
+    assert len(Message.from_recipient('dave')) == 1
+
+def test_init_db_adds_skipped_column():
+    DB.engine.execute('DROP TABLE outbox')
+    DB.engine.execute('CREATE TABLE outbox (id VARCHAR(200) PRIMARY KEY, sender_name VARCHAR(200) NOT NULL, '
+                      'target TEXT NOT NULL, date INTEGER NOT NULL, title VARCHAR(200) NOT NULL, '
+                      'body VARCHAR(200) NOT NULL, status VARCHAR(16) NOT NULL, total INTEGER NOT NULL, '
+                      'delivered INTEGER NOT NULL, last_recipient VARCHAR(200), owner VARCHAR(200), '
+                      'lease_expiry INTEGER NOT NULL, attempts INTEGER NOT NULL, '
+                      'next_attempt INTEGER NOT NULL, error VARCHAR(200), expiry INTEGER NOT NULL)')
+    Delivery.create_table()
+    for name in ('alice', 'bob'):
+        create_user(name)
+
+    assert Delivery.select(queue(['bob'])).skipped == 0
@@ -0,0 +1,37 @@
+# ---------------------------
+#Fichier : test_pwpool.py
+#Date : 14.10.2020
+#But : tests du pool de hachage des mots de passe
+#Remarque :
+#------------------------------
+
+import time
+
+import pytest
+
+from messenger import APP, pwpool
+
+from conftest import create_user, PASSWORD
+
+def test_slow_job_raises_pool_busy(monkeypatch):
+    monkeypatch.setitem(APP.config, 'PW_TIMEOUT', 0.01)
+
+    with pytest.raises(pwpool.PoolBusy):
+        pwpool.run(time.sleep, 0.5)
+
+def test_login_times_out_with_503(client, monkeypatch):
+    monkeypatch.setitem(APP.config, 'PW_TIMEOUT', 0.01)
+    create_user('alice')
+    monkeypatch.setattr(pwpool.security, 'check_pw', lambda *args: time.sleep(0.5))
+
+    res = client.post('/login', data={'username': 'alice', 'password': PASSWORD})
+    assert res.status_code == 503
+
+def test_unknown_username_is_hashed(client, monkeypatch):
+    checked = []
+    check_pw = pwpool.security.check_pw
+    monkeypatch.setattr(pwpool.security, 'check_pw', lambda *args: checked.append(args) or check_pw(*args))
+
+    res = client.post('/login', data={'username': 'nobody', 'password': PASSWORD})
+    assert res.status_code == 200
+    assert len(checked) == 1
@@ -0,0 +1,118 @@
+# ---------------------------
+#Fichier : test_views.py
+#Date : 14.10.2020
+#But : tests des pages (ETag, recherche, limites de débit)
+#Remarque :
+#------------------------------
+
+import time
+
+from messenger import DB
+from messenger.models import Message, MessageIndex
+from messenger.views import limiter, parse_recipients
+
+from conftest import create_user, login, PASSWORD
+
+def test_inbox_not_modified(client):
+    for name in ('alice', 'bob'):
+        create_user(name)
+    Message.insert('alice', 'bob', 100, 'Hello', 'Body')
+    login(client, 'bob')
+
+    res = client.get('/inbox')
+    etag = res.headers['ETag']
+    res = client.get('/inbox', headers={'If-None-Match': etag})
+    assert res.status_code == 304
+    assert res.data == b''
+
+    # a new message changes the page
+    Message.insert('alice', 'bob', 200, 'Again', 'Body')
+    res = client.get('/inbox', headers={'If-None-Match': etag})
+    assert res.status_code == 200
+    assert res.headers['ETag'] != etag
+
+def test_message_not_modified_until_deleted(client):
+    for name in ('alice', 'bob'):
+        create_user(name)
+    Message.insert('alice', 'bob', 100, 'Hello', 'Body')
+    message_id = Message.from_recipient('bob')[0].id
+    login(client, 'bob')
+
+    etag = client.get('/message/' + message_id).headers['ETag']
+    assert client.get('/message/' + message_id, headers={'If-None-Match': etag}).status_code == 304
+
+    Message.delete(message_id)
+    assert client.get('/message/' + message_id, headers={'If-None-Match': etag}).status_code == 302
+
+def test_pages_with_flashes_are_not_tagged(client):
+    create_user('alice')
+    client.post('/login', data={'username': 'alice', 'password': PASSWORD})
+
+    res = client.get('/inbox')
+    assert res.status_code == 200
+    assert 'ETag' not in res.headers
+
+def test_search_only_returns_own_messages(client):
+    for name in ('alice', 'bob', 'carol'):
+        create_user(name)
+    Message.insert('alice', 'bob', 100, 'Budget meeting', 'About the budget')
+    Message.insert('alice', 'bob', 200, 'Lunch', 'Friday')
+    Message.insert('alice', 'carol', 300, 'Budget', 'Not for bob')
+    login(client, 'bob')
+
+    page = client.get('/search?q=budget').get_data(as_text=True)
+    assert 'Budget meeting' in page
+    assert 'Lunch' not in page
+    assert 'Not for bob' not in page
+
+def test_search_forgets_deleted_messages(client):
+    for name in ('alice', 'bob'):
+        create_user(name)
+    Message.insert('alice', 'bob', 100, 'Budget meeting', 'Body')
+    login(client, 'bob')
+
+    Message.delete(Message.from_recipient('bob')[0].id)
+    assert 'Budget meeting' not in client.get('/search?q=budget').get_data(as_text=True)
+
+def test_search_keeps_other_messages_after_delete(client):
+    for name in ('alice', 'bob'):
+        create_user(name)
+    Message.insert_many('alice', ['bob'] * 3, 100, 'Budget meeting', 'Body')
+    login(client, 'bob')
+
+    Message.delete(Message.from_recipient('bob')[0].id)
+    assert len(MessageIndex.search('bob', 'budget', 10)) == 2
+    assert DB.engine.execute('SELECT COUNT(*) FROM messages_fts').scalar() == 2
+
+def test_search_survives_renumbered_rows(client):
+    for name in ('alice', 'bob'):
+        create_user(name)
+    Message.insert('alice', 'bob', 100, 'Budget meeting', 'Body')
+    Message.insert('alice', 'bob', 200, 'Lunch', 'Friday')
+    login(client, 'bob')
+
+    # as VACUUM may do for tables without an INTEGER PRIMARY KEY
+    DB.engine.execute('UPDATE messages SET rowid = rowid + 100')
+    page = client.get('/search?q=budget').get_data(as_text=True)
+    assert 'Budget meeting' in page
+    assert 'Lunch' not in page
+
+def test_login_rate_limit(client):
+    limiter.enabled = True
+    limiter.reset()
+    create_user('alice')
+
+    statuses = [
+        client.post('/login', data={'username': 'alice', 'password': 'wrong'}).status_code
+        for _ in range(6)
+    ]
+    assert statuses == [200] * 5 + [429]
+
+def test_parse_large_recipient_field():
+    names = ['user{}'.format(i) for i in range(20000)]
+    field = ', '.join(names + names[::-1]) + ' ' + ' '.join(names)
+
+    start = time.perf_counter()
+    recipients = parse_recipients(field)
+    assert time.perf_counter() - start < 1
+    assert recipients == names